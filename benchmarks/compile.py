@@ -0,0 +1,132 @@
+"""
+Compiled execution: training steps of the eager `TrainerModel` versus the same model compiled with
+`--compile` (`torch.compile` with dynamic shapes), for GIN, HIMP and HOIMP on batches of the
+packed Polaris training molecules. Re-initializes the compiled model as for a new fold, checks
+that it starts from the initial weights of the eager model and predicts the same as its
+uncompiled `forward` on batches of every size, and reports the time to compile, the time per
+training step of each and the number of graphs compiled in total.
+
+    python -m benchmarks.compile --batch_size 64
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+import torch
+import torch._dynamo
+
+from src.data import PolarisDataset
+from src.loader import PackedDataset
+from src.trainer import Trainer
+
+CONFIGS = {
+    "GIN": {"repr_model": "GIN"},
+    "HIMP": {"repr_model": "HIMP"},
+    "HOIMP": {"repr_model": "HOIMP", "use_jt": True, "jt_coarsity": 2, "use_erg": True},
+}
+
+PARAMS = {
+    "hidden_channels": 32,
+    "out_channels": 32,
+    "num_layers": 3,
+    "dropout": 0.1,
+    "encoding_dim": 8,
+    "radius": 2,
+    "out_dim": 1,
+    "proj_hidden_dim": 32,
+    "rg_embedding_dim": 8,
+    "lr": 1e-3,
+    "weight_decay": 1e-4,
+    "use_jt": False,
+    "jt_coarsity": 1,
+    "use_erg": False,
+    "seed": 42,
+}
+
+
+def step_time(trainer, batches) -> float:
+    start = time.perf_counter()
+    trainer._train_loop(batches)
+    return (time.perf_counter() - start) / len(batches)
+
+
+def predictions(model, batches, compiled: bool = True) -> list:
+    # Calling `forward` directly bypasses the compiled graphs of a compiled model
+    model.eval()
+    forward = model if compiled else model.forward
+    with torch.inference_mode():
+        return [forward(data) for data in batches]
+
+
+def main(params: dict) -> None:
+    mismatches = 0
+    for name, config in CONFIGS.items():
+        dataset = PackedDataset(
+            PolarisDataset(
+                root=Path(params["root"]) / params["task"],
+                task=params["task"],
+                target_task=params["target_task"],
+                train=True,
+                log_transform=params["task"] == "admet",
+                cache_dir=None,
+                use_jt=config.get("use_jt", False),
+                jt_coarsity=config.get("jt_coarsity", 1),
+                use_erg=config.get("use_erg", False),
+            )
+        )
+        generator = torch.Generator().manual_seed(params["seed"])
+        order = torch.randperm(len(dataset), generator=generator)
+        batches = dataset.batches(order, params["batch_size"])
+        warmup, timed = batches[:2], batches[2 : params["num_steps"] + 2]
+
+        trainer_params = dict(PARAMS, **config, batch_size=params["batch_size"])
+        eager = Trainer(trainer_params, init_dataset=False)
+        eager_time = step_time(eager, timed)
+
+        torch._dynamo.reset()
+        torch._dynamo.utils.counters.clear()
+        compiled = Trainer(dict(trainer_params, compile=True), init_dataset=False)
+        start = time.perf_counter()
+        compiled._train_loop(warmup)
+        predictions(compiled.model, warmup)
+        compile_time = time.perf_counter() - start
+        compiled_time = step_time(compiled, timed)
+
+        # A new fold re-initializes the compiled model, which has to run without recompiling and
+        # start from the initial weights of the eager model
+        compiled._init_model()
+        compiled._init_optimizer()
+        eager._init_model()
+        initial = eager.model.state_dict()
+        wrong = sum(
+            not torch.equal(tensor, initial[key])
+            for key, tensor in compiled.model.state_dict().items()
+        )
+        compiled._train_loop(timed)
+        expected = predictions(compiled.model, batches, compiled=False)
+        actual = predictions(compiled.model, batches)
+        graphs = torch._dynamo.utils.counters["stats"]["unique_graphs"]
+
+        wrong += sum(
+            not torch.allclose(exp, act, rtol=1e-4, atol=1e-4) for exp, act in zip(expected, actual)
+        )
+        mismatches += wrong
+        print(
+            f"{name:>5}: compile {compile_time:5.1f}s, eager {eager_time * 1e3:6.2f}ms, "
+            f"compiled {compiled_time * 1e3:6.2f}ms per step ({eager_time / compiled_time:4.2f}x), "
+            f"{graphs} graphs, {wrong} mismatches"
+        )
+    if mismatches > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--root", default="./data/polaris")
+    parser.add_argument("--task", default="potency")
+    parser.add_argument("--target_task", default="pIC50 (MERS-CoV Mpro)")
+    parser.add_argument("--batch_size", default=64, type=int)
+    parser.add_argument("--num_steps", default=30, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    main(vars(parser.parse_args()))
@@ -0,0 +1,123 @@
+"""
+Categorical embeddings: one `Embedding` lookup per column, summed or concatenated, versus a single
+lookup into the fused table of `FusedEmbedding`, for the atom and bond encoders of HIMP and HOIMP
+and the `CategoricalEmbeddingModel` of GIN, GCN, GAT and SAGE on batches of the packed Polaris
+training molecules. Checks that both embed identically and backpropagate the same gradients, up to
+the order of accumulating repeated categories, and reports the best time of a forward and backward
+pass over interleaved trials.
+
+    python -m benchmarks.embedding --batch_size 128
+"""
+
+import argparse
+import math
+import time
+from pathlib import Path
+
+import torch
+
+from src.data import PolarisDataset
+from src.himp import AtomEncoder, BondEncoder
+from src.loader import PackedDataset
+from src.models import CategoricalEmbeddingModel
+
+ENCODERS = {
+    "atoms": (lambda: AtomEncoder(64), "x"),
+    "bonds": (lambda: BondEncoder(64), "edge_attr"),
+    "node categories": (lambda: CategoricalEmbeddingModel("node"), "x"),
+    "edge categories": (lambda: CategoricalEmbeddingModel("edge"), "edge_attr"),
+}
+
+
+class PerColumnEmbedding(torch.nn.Module):
+    """
+    The previous lookup per column, with the tables of a `FusedEmbedding`.
+    """
+
+    def __init__(self, fused):
+        super().__init__()
+        self.reduce = fused.reduce
+        self.embeddings = torch.nn.ModuleList(
+            [torch.nn.Embedding.from_pretrained(table, freeze=False) for table in fused.tables()]
+        )
+
+    def forward(self, x):
+        embedded_vars = [self.embeddings[i](x[:, i]) for i in range(x.size(1))]
+        if self.reduce == "cat":
+            return torch.cat(embedded_vars, dim=-1)
+
+        out = 0
+        for embedded in embedded_vars:
+            out += embedded
+        return out
+
+
+def pass_time(encoder, x, grad_out, repeats: int):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = encoder(x)
+        out.backward(grad_out)
+    return (time.perf_counter() - start) / repeats, out
+
+
+def gradient(encoder, x, grad_out):
+    encoder.zero_grad()
+    encoder(x).backward(grad_out)
+    if isinstance(encoder, PerColumnEmbedding):
+        return torch.cat([embedding.weight.grad for embedding in encoder.embeddings])
+    return encoder.weight.grad
+
+
+def main(params: dict) -> None:
+    dataset = PackedDataset(
+        PolarisDataset(
+            root=Path(params["root"]) / params["task"],
+            task=params["task"],
+            target_task=params["target_task"],
+            train=True,
+            log_transform=params["task"] == "admet",
+            cache_dir=None,
+        )
+    )
+    generator = torch.Generator().manual_seed(params["seed"])
+    data = dataset.batch(torch.randperm(len(dataset), generator=generator)[: params["batch_size"]])
+
+    mismatches = 0
+    for name, (create_encoder, key) in ENCODERS.items():
+        torch.manual_seed(params["seed"])
+        fused = create_encoder()
+        per_column = PerColumnEmbedding(fused)
+        x = data[key]
+        # Gradients of all ones would be accumulated exactly in any order
+        grad_out = torch.randn_like(fused(x))
+
+        per_column_time, fused_time = math.inf, math.inf
+        for _ in range(params["trials"]):
+            elapsed, expected = pass_time(per_column, x, grad_out, params["repeats"])
+            per_column_time = min(per_column_time, elapsed)
+            elapsed, actual = pass_time(fused, x, grad_out, params["repeats"])
+            fused_time = min(fused_time, elapsed)
+
+        wrong = int(not torch.equal(expected, actual))
+        expected, actual = gradient(per_column, x, grad_out), gradient(fused, x, grad_out)
+        wrong += int(not torch.allclose(expected, actual, rtol=1e-4, atol=1e-4))
+        mismatches += wrong
+        print(
+            f"{name:>15} ({x.size(1)} columns): per column {per_column_time * 1e3:6.3f}ms, "
+            f"fused {fused_time * 1e3:6.3f}ms ({per_column_time / fused_time:4.2f}x), "
+            f"{wrong} mismatches"
+        )
+    if mismatches > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--root", default="./data/polaris")
+    parser.add_argument("--task", default="potency")
+    parser.add_argument("--target_task", default="pIC50 (MERS-CoV Mpro)")
+    parser.add_argument("--batch_size", default=128, type=int)
+    parser.add_argument("--repeats", default=50, type=int)
+    parser.add_argument("--trials", default=3, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    main(vars(parser.parse_args()))
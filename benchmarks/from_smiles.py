@@ -0,0 +1,92 @@
+"""
+Molecular graph construction: PyG's `from_rdmol`, one molecule at a time, versus the bulk
+`mols_to_data_list` of `src.chem`, in chunks as used by featurization. Checks that both encode
+every molecule of the raw Polaris data identically and reports the time spent per implementation
+(RDKit parsing excluded).
+
+    python -m benchmarks.from_smiles --chunk_size 64
+"""
+
+import argparse
+import csv
+import time
+from pathlib import Path
+
+import torch
+from torch_geometric.utils import from_rdmol
+
+from src.chem import get_mol, mols_to_data_list
+
+# Charges, radicals, isotopes, stereo bonds, dummy atoms, mixtures and molecules without bonds
+EXTRA_SMILES = [
+    "[Na+].[Cl-]",
+    "[CH3]",
+    "[13CH4]",
+    "C/C=C/C",
+    "F/C=C\\Cl",
+    "*c1ccccc1",
+    "[O-][N+](=O)c1ccccc1",
+    "C[C@H](N)C(=O)O",
+    "[Fe+3]",
+    "O",
+]
+
+
+def attempt(fn, *args):
+    # Unknown feature values raise in both implementations; both have to fail alike then
+    try:
+        return fn(*args)
+    except ValueError:
+        return None
+
+
+def equal(a, b) -> bool:
+    if a is None or b is None:
+        return a is None and b is None
+    return all(
+        a[key].dtype == b[key].dtype
+        and a[key].shape == b[key].shape
+        and torch.equal(a[key], b[key])
+        for key in ("x", "edge_index", "edge_attr")
+    )
+
+
+def main(params: dict) -> None:
+    smiles = list(EXTRA_SMILES)
+    for path in sorted(Path(params["root"]).glob("*/raw/*_polaris.csv")):
+        with open(path, "r") as file:
+            lines = csv.reader(file)
+            next(lines)  # skip header
+            smiles.extend(line[0] for line in lines)
+
+    mols = [mol for mol in map(get_mol, smiles) if mol is not None]
+    chunks = [mols[i : i + params["chunk_size"]] for i in range(0, len(mols), params["chunk_size"])]
+
+    start = time.perf_counter()
+    expected = [attempt(from_rdmol, mol) for mol in mols]
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = []
+    for chunk in chunks:
+        data_list = attempt(mols_to_data_list, chunk)
+        # A failing chunk is repeated molecule by molecule, to locate the failing ones
+        if data_list is None:
+            data_list = [attempt(mols_to_data_list, [mol]) for mol in chunk]
+            data_list = [data if data is None else data[0] for data in data_list]
+        actual.extend(data_list)
+    bulk_time = time.perf_counter() - start
+
+    mismatches = sum(not equal(exp, act) for exp, act in zip(expected, actual))
+    print(f"{len(mols)} molecules, chunks of {params['chunk_size']}, {mismatches} mismatches")
+    print(f"from_rdmol:        {reference_time:6.3f}s")
+    print(f"mols_to_data_list: {bulk_time:6.3f}s ({reference_time / bulk_time:4.1f}x)")
+    if mismatches > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--root", default="./data/polaris")
+    parser.add_argument("--chunk_size", default=64, type=int)
+    main(vars(parser.parse_args()))
@@ -0,0 +1,88 @@
+"""
+Junction tree coarsening: the per-leaf reference implementation (`add_feature_tree_with_lower_res`)
+versus the vectorized `coarsen_junction_tree`. Checks that both produce identical levels for every
+molecule of the raw Polaris data and reports the time spent per implementation.
+
+    python -m benchmarks.jt_coarsening --levels 3
+"""
+
+import argparse
+import csv
+import time
+from pathlib import Path
+
+import torch
+from torch_geometric.utils import tree_decomposition
+
+from src.chem import get_mol
+from src.transform import ReducedGraphData, add_feature_tree_with_lower_res, coarsen_junction_tree
+
+# Large ring systems and natural products, where trees get deep
+EXTRA_SMILES = [
+    "CC[C@H]1OC(=O)[C@H](C)[C@@H](O[C@H]2C[C@@](C)(OC)[C@@H](O)[C@H](C)O2)[C@H](C)[C@@H](O[C@@H]2O[C@H](C)C[C@H](N(C)C)[C@H]2O)[C@](C)(O)C[C@@H](C)C(=O)[C@H](C)[C@@H](O)[C@]1(C)O",
+    "CC(C)C[C@@H]1NC(=O)[C@H](CC(C)C)N(C)C(=O)[C@H](C)N(C)C(=O)[C@@H](C)NC(=O)[C@H](C)N(C)C1=O",
+    "CCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCCC(C)(C)CC(CC)CC(C)(C)C",
+    "Cc1ccccc1.CCC(C)CC",
+    "[Na+].[Cl-]",
+]
+
+
+def attempt(fn, *args, **kwargs):
+    # Some mixtures make the reference implementation fail; both have to fail alike then
+    try:
+        return fn(*args, **kwargs)
+    except IndexError as e:
+        return str(e)
+
+
+def reference_levels(out, num_levels):
+    tree = ReducedGraphData()
+    tree.rg_edge_index_0, tree.mapping_0, tree.rg_num_atoms_0, tree.rg_atom_features_0 = out
+    tree.raw_num_atoms_0 = 0
+    for i in range(1, num_levels + 1):
+        tree = add_feature_tree_with_lower_res(tree, i)
+    keys = ["rg_edge_index", "mapping", "rg_num_atoms", "rg_atom_features"]
+    return [tuple(getattr(tree, f"{key}_{i}") for key in keys) for i in range(1, num_levels + 1)]
+
+
+def equal(a, b) -> bool:
+    if isinstance(a, str) or isinstance(b, str):
+        return a == b
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(equal(x, y) for x, y in zip(a, b))
+    if isinstance(a, torch.Tensor):
+        return a.dtype == b.dtype and a.shape == b.shape and torch.equal(a, b)
+    return a == b
+
+
+def main(params: dict) -> None:
+    smiles = list(EXTRA_SMILES)
+    for path in sorted(Path(params["root"]).glob("*/raw/*_polaris.csv")):
+        with open(path, "r") as file:
+            lines = csv.reader(file)
+            next(lines)  # skip header
+            smiles.extend(line[0] for line in lines)
+
+    trees = [tree_decomposition(get_mol(s), return_vocab=True) for s in smiles]
+
+    start = time.perf_counter()
+    expected = [attempt(reference_levels, out, params["levels"]) for out in trees]
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = [attempt(coarsen_junction_tree, *out, num_levels=params["levels"]) for out in trees]
+    vectorized_time = time.perf_counter() - start
+
+    mismatches = sum(not equal(exp, act) for exp, act in zip(expected, actual))
+    print(f"{len(trees)} molecules, {params['levels']} levels, {mismatches} mismatches")
+    print(f"reference:  {reference_time:6.3f}s")
+    print(f"vectorized: {vectorized_time:6.3f}s")
+    if mismatches > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--root", default="./data/polaris")
+    parser.add_argument("--levels", default=3, type=int)
+    main(vars(parser.parse_args()))
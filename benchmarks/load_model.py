@@ -0,0 +1,118 @@
+"""
+Loading trained models: a checkpoint of the `state_dict`, unpickled weight by weight and copied
+into a new `TrainerModel`, versus `load_model` on the file of `save_model`, whose weights are
+packed into one tensor per data type and taken over memory-mapped, for GIN, HIMP and HOIMP.
+Checks that the loaded models predict the same as the saved ones on a batch of the packed Polaris
+training molecules and reports the best time to load each over interleaved trials.
+
+    python -m benchmarks.load_model --hidden_channels 128
+"""
+
+import argparse
+import math
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import torch
+
+from src.data import PolarisDataset
+from src.loader import PackedDataset
+from src.models import TrainerModel, create_proj_model, create_repr_model, load_model, save_model
+
+CONFIGS = {
+    "GIN": {"repr_model": "GIN"},
+    "HIMP": {"repr_model": "HIMP"},
+    "HOIMP": {"repr_model": "HOIMP", "use_jt": True, "jt_coarsity": 2, "use_erg": True},
+}
+
+PARAMS = {
+    "out_channels": 64,
+    "num_layers": 3,
+    "dropout": 0.1,
+    "encoding_dim": 8,
+    "radius": 2,
+    "out_dim": 1,
+    "proj_hidden_dim": 64,
+    "rg_embedding_dim": 8,
+    "use_jt": False,
+    "jt_coarsity": 1,
+    "use_erg": False,
+}
+
+
+def load_checkpoint(path: Path):
+    checkpoint = torch.load(path, weights_only=True)
+    params = checkpoint["params"]
+    model = TrainerModel(create_repr_model(params), create_proj_model(params))
+    model.load_state_dict(checkpoint["state_dict"])
+    return model.eval(), params
+
+
+def load_time(load, path: Path, repeats: int):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model, _ = load(path)
+    return (time.perf_counter() - start) / repeats, model
+
+
+def main(params: dict) -> None:
+    directory = Path(tempfile.mkdtemp())
+    mismatches = 0
+    for name, config in CONFIGS.items():
+        dataset = PackedDataset(
+            PolarisDataset(
+                root=Path(params["root"]) / params["task"],
+                task=params["task"],
+                target_task=params["target_task"],
+                train=True,
+                log_transform=params["task"] == "admet",
+                cache_dir=None,
+                use_jt=config.get("use_jt", False),
+                jt_coarsity=config.get("jt_coarsity", 1),
+                use_erg=config.get("use_erg", False),
+            )
+        )
+        data = dataset.batch(torch.arange(params["batch_size"]))
+
+        model_params = dict(PARAMS, **config, hidden_channels=params["hidden_channels"])
+        torch.manual_seed(params["seed"])
+        model = TrainerModel(create_repr_model(model_params), create_proj_model(model_params))
+        model(data)  # Batch norm statistics other than the initial ones
+        model.eval()
+        checkpoint_path, saved_path = directory / f"{name}.ckpt", directory / f"{name}.pt"
+        torch.save({"params": model_params, "state_dict": model.state_dict()}, checkpoint_path)
+        save_model(model, model_params, saved_path)
+
+        checkpoint_time, saved_time = math.inf, math.inf
+        for _ in range(params["trials"]):
+            elapsed, _ = load_time(load_checkpoint, checkpoint_path, params["repeats"])
+            checkpoint_time = min(checkpoint_time, elapsed)
+            elapsed, loaded = load_time(load_model, saved_path, params["repeats"])
+            saved_time = min(saved_time, elapsed)
+
+        with torch.inference_mode():
+            wrong = int(not torch.equal(model(data), loaded(data)))
+        mismatches += wrong
+        print(
+            f"{name:>5} ({len(model.state_dict())} tensors): checkpoint "
+            f"{checkpoint_time * 1e3:6.2f}ms, load_model {saved_time * 1e3:6.2f}ms "
+            f"({checkpoint_time / saved_time:4.2f}x), {wrong} mismatches"
+        )
+    shutil.rmtree(directory)
+    if mismatches > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--root", default="./data/polaris")
+    parser.add_argument("--task", default="potency")
+    parser.add_argument("--target_task", default="pIC50 (MERS-CoV Mpro)")
+    parser.add_argument("--hidden_channels", default=64, type=int)
+    parser.add_argument("--batch_size", default=128, type=int)
+    parser.add_argument("--repeats", default=10, type=int)
+    parser.add_argument("--trials", default=3, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    main(vars(parser.parse_args()))
@@ -0,0 +1,134 @@
+"""
+Inter message passing between atoms and clusters: `scatter(x[row], col, reduce="mean")` and its
+reverse in every layer versus the `ClusterMapping` built once per batch, with a single sparse
+matrix product per direction, in HIMP (junction trees) and HOIMP (reduced graphs) on batches of the
+packed Polaris training molecules. Checks that both predict the same and reports the time of a
+forward pass with autograd recording and the memory it allocates.
+
+    python -m benchmarks.mapping --batch_size 128
+"""
+
+import argparse
+import math
+import time
+from pathlib import Path
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+from torch_geometric.utils import scatter
+
+import src.himp
+import src.hoimp
+from src.data import PolarisDataset
+from src.loader import PackedDataset
+from src.mapping import ClusterMapping
+from src.models import create_repr_model
+
+CONFIGS = {
+    "HIMP": {"repr_model": "HIMP"},
+    "HOIMP": {"repr_model": "HOIMP", "use_jt": True, "jt_coarsity": 2, "use_erg": True},
+}
+
+PARAMS = {
+    "hidden_channels": 64,
+    "out_channels": 64,
+    "num_layers": 3,
+    "dropout": 0.0,
+    "rg_embedding_dim": 8,
+    "use_jt": False,
+    "jt_coarsity": 1,
+    "use_erg": False,
+}
+
+
+class ScatterMapping(object):
+    """
+    The previous scatter means of every layer, behind the interface of `ClusterMapping`.
+    """
+
+    def __init__(self, index, num_atoms: int, num_clusters: int, dtype=None):
+        self.index, self.num_atoms, self.num_clusters = index, num_atoms, num_clusters
+
+    def to_clusters(self, x):
+        row, col = self.index
+        return scatter(x[row], col, dim=0, dim_size=self.num_clusters, reduce="mean")
+
+    def to_atoms(self, x_cluster):
+        row, col = self.index
+        return scatter(x_cluster[col], row, dim=0, dim_size=self.num_atoms, reduce="mean")
+
+
+def use_mapping(mapping) -> None:
+    src.himp.ClusterMapping = mapping
+    src.hoimp.ClusterMapping = mapping
+
+
+def forward_time(model, data, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model(data)
+    return (time.perf_counter() - start) / repeats
+
+
+def allocated_bytes(model, data) -> int:
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        model(data)
+    return sum(max(event.self_cpu_memory_usage, 0) for event in prof.events())
+
+
+def main(params: dict) -> None:
+    mismatches = 0
+    for name, config in CONFIGS.items():
+        dataset = PackedDataset(
+            PolarisDataset(
+                root=Path(params["root"]) / params["task"],
+                task=params["task"],
+                target_task=params["target_task"],
+                train=True,
+                log_transform=params["task"] == "admet",
+                cache_dir=None,
+                use_jt=config.get("use_jt", False),
+                jt_coarsity=config.get("jt_coarsity", 1),
+                use_erg=config.get("use_erg", False),
+            )
+        )
+        generator = torch.Generator().manual_seed(params["seed"])
+        data = dataset.batch(
+            torch.randperm(len(dataset), generator=generator)[: params["batch_size"]]
+        )
+        torch.manual_seed(params["seed"])
+        model = create_repr_model(dict(PARAMS, **config)).model
+
+        scatter_time, sparse_time = math.inf, math.inf
+        for _ in range(params["trials"]):
+            use_mapping(ScatterMapping)
+            scatter_time = min(scatter_time, forward_time(model, data, params["repeats"]))
+            use_mapping(ClusterMapping)
+            sparse_time = min(sparse_time, forward_time(model, data, params["repeats"]))
+
+        use_mapping(ScatterMapping)
+        expected, scatter_bytes = model(data), allocated_bytes(model, data)
+        use_mapping(ClusterMapping)
+        actual, sparse_bytes = model(data), allocated_bytes(model, data)
+
+        wrong = int(not torch.allclose(expected, actual, rtol=1e-4, atol=1e-5))
+        mismatches += wrong
+        print(
+            f"{name:>5}: scatter {scatter_time * 1e3:6.2f}ms, {scatter_bytes / 2**20:6.1f}MiB, "
+            f"sparse {sparse_time * 1e3:6.2f}ms, {sparse_bytes / 2**20:6.1f}MiB per forward pass "
+            f"({scatter_time / sparse_time:4.2f}x), {wrong} mismatches"
+        )
+    if mismatches > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--root", default="./data/polaris")
+    parser.add_argument("--task", default="potency")
+    parser.add_argument("--target_task", default="pIC50 (MERS-CoV Mpro)")
+    parser.add_argument("--batch_size", default=128, type=int)
+    parser.add_argument("--repeats", default=10, type=int)
+    parser.add_argument("--trials", default=3, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    main(vars(parser.parse_args()))
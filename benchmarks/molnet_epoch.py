@@ -0,0 +1,87 @@
+"""
+Epoch time of MoleculeNet training with reduced graphs computed by a per-item `transform`
+(before) versus reduced graphs materialized once on disk (after).
+
+    python -m benchmarks.molnet_epoch --target_task ESOL
+    python -m benchmarks.molnet_epoch --target_task Lipophilicity --epochs 3
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+import torch
+from torch import nn
+from torch.optim import Adam
+
+from src.data import MoleculeNetDataset
+from src.loader import DataLoader
+from src.models import TrainerModel, create_proj_model, create_repr_model
+
+
+def time_epochs(dataset, params: dict) -> list[float]:
+    torch.manual_seed(params["seed"])
+    model = TrainerModel(create_repr_model(params), create_proj_model(params))
+    optimizer = Adam(model.parameters(), lr=params["lr"])
+    loss_fn = nn.L1Loss()
+    dataloader = DataLoader(dataset, batch_size=params["batch_size"], shuffle=True)
+
+    times = []
+    for _ in range(params["epochs"]):
+        start = time.perf_counter()
+        for data in dataloader:
+            loss = loss_fn(model(data), data.y)
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main(params: dict) -> None:
+    for materialize in (False, True):
+        start = time.perf_counter()
+        dataset = MoleculeNetDataset(
+            root=Path(params["root"]),
+            target_task=params["target_task"],
+            use_erg=params["use_erg"],
+            use_jt=params["use_jt"],
+            jt_coarsity=params["jt_coarsity"],
+            materialize=materialize,
+        ).create_dataset()
+        setup = time.perf_counter() - start
+
+        times = time_epochs(dataset, params)
+        mode = "materialized" if materialize else "transform"
+        print(
+            f"{params['target_task']:>14} {mode:>12}: setup {setup:6.2f}s, "
+            f"epoch {sum(times) / len(times):6.3f}s (mean of {len(times)})"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--root", default="./data/molecule_net")
+    parser.add_argument("--target_task", default="ESOL")
+    parser.add_argument("--epochs", default=3, type=int)
+    parser.add_argument("--batch_size", default=32, type=int)
+    args = parser.parse_args()
+
+    main(
+        {
+            **vars(args),
+            "repr_model": "HOIMP",
+            "use_erg": True,
+            "use_jt": True,
+            "jt_coarsity": 2,
+            "rg_embedding_dim": 8,
+            "hidden_channels": 32,
+            "out_channels": 64,
+            "proj_hidden_dim": 64,
+            "out_dim": 1,
+            "num_layers": 3,
+            "dropout": 0.0,
+            "lr": 1.0e-4,
+            "seed": 42,
+        }
+    )
@@ -0,0 +1,148 @@
+"""
+HOIMP inter message passing between reduced graphs: scatter means for every pair of reduced
+graphs versus `Hoimp._rg2rg`, with the `ClusterMapping` of every reduced graph built once per
+batch, in both orders of `sequential_rg2rg`. In the original order every pair sends from the
+reduced graphs as updated by the pairs before it; otherwise all pairs send from the reduced graphs
+entering the layer, whose virtual nodes `Hoimp._rg2rg` computes once per layer and gathers in
+one pass. Runs junction trees of increasing coarsity with and without ErG, on batches of the
+packed Polaris training molecules. Checks that both implementations send the same messages and
+reports the best time of a forward and backward pass of one layer over interleaved trials.
+
+    python -m benchmarks.rg2rg --batch_size 128
+"""
+
+import argparse
+import math
+import time
+from pathlib import Path
+
+import torch
+from torch_geometric.utils import scatter
+
+from src.data import PolarisDataset
+from src.loader import PackedDataset
+from src.mapping import ClusterMapping
+from src.models import create_repr_model
+
+CONFIGS = [(1, True), (2, False), (2, True), (3, False), (3, True)]
+
+PARAMS = {
+    "repr_model": "HOIMP",
+    "hidden_channels": 64,
+    "out_channels": 64,
+    "num_layers": 1,
+    "dropout": 0.0,
+    "rg_embedding_dim": 8,
+    "use_jt": True,
+}
+
+
+def pairwise_rg2rg(model, rgs, mappings, layer, num_atoms):
+    out = list(rgs)
+    for j, k, lin_j, lin_k in model.rg2rg_pairs[layer]:
+        # Sending from the updated reduced graphs in the original order
+        sources = out if model.sequential_rg2rg else rgs
+        row_j, col_j = mappings[j]
+        row_k, col_k = mappings[k]
+        x_virt_j = scatter(sources[j][col_j], row_j, dim=0, dim_size=num_atoms, reduce="mean")
+        x_virt_k = scatter(sources[k][col_k], row_k, dim=0, dim_size=num_atoms, reduce="mean")
+        out[j] = (
+            out[j]
+            + model.rg2rg_lins[lin_j](
+                scatter(x_virt_k[row_j], col_j, dim=0, dim_size=rgs[j].size(0), reduce="mean")
+            ).relu()
+        )
+        out[k] = (
+            out[k]
+            + model.rg2rg_lins[lin_k](
+                scatter(x_virt_j[row_k], col_k, dim=0, dim_size=rgs[k].size(0), reduce="mean")
+            ).relu()
+        )
+    return out
+
+
+def shared_rg2rg(model, rgs, mappings, layer, num_atoms):
+    operators = [
+        ClusterMapping(mapping, num_atoms, rg.size(0), dtype=rgs[0].dtype)
+        for mapping, rg in zip(mappings, rgs)
+    ]
+    return type(model)._rg2rg(model, rgs, operators, layer)
+
+
+def pass_time(rg2rg, model, rgs, mappings, num_atoms, repeats: int):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = rg2rg(model, rgs, mappings, 0, num_atoms)
+        torch.stack([rg.sum() for rg in out]).sum().backward()
+    return (time.perf_counter() - start) / repeats, out
+
+
+def main(params: dict) -> None:
+    mismatches = 0
+    for jt_coarsity, use_erg in CONFIGS:
+        dataset = PackedDataset(
+            PolarisDataset(
+                root=Path(params["root"]) / params["task"],
+                task=params["task"],
+                target_task=params["target_task"],
+                train=True,
+                log_transform=params["task"] == "admet",
+                cache_dir=None,
+                use_jt=True,
+                jt_coarsity=jt_coarsity,
+                use_erg=use_erg,
+            )
+        )
+        generator = torch.Generator().manual_seed(params["seed"])
+        data = dataset.batch(
+            torch.randperm(len(dataset), generator=generator)[: params["batch_size"]]
+        )
+
+        torch.manual_seed(params["seed"])
+        model = create_repr_model(dict(PARAMS, jt_coarsity=jt_coarsity, use_erg=use_erg)).model
+        rg_num = model.rg_num
+        mappings = [getattr(data, f"mapping_{i}") for i in range(rg_num)]
+        rgs = [
+            torch.randn(getattr(data, f"rg_atom_features_{i}").numel(), PARAMS["hidden_channels"])
+            for i in range(rg_num)
+        ]
+        rgs = [rg.requires_grad_() for rg in rgs]
+        num_atoms = data.num_nodes
+
+        for sequential in (True, False):
+            model.sequential_rg2rg = sequential
+            pairwise_time, shared_time = math.inf, math.inf
+            for _ in range(params["trials"]):
+                elapsed, expected = pass_time(
+                    pairwise_rg2rg, model, rgs, mappings, num_atoms, params["repeats"]
+                )
+                pairwise_time = min(pairwise_time, elapsed)
+                elapsed, actual = pass_time(
+                    shared_rg2rg, model, rgs, mappings, num_atoms, params["repeats"]
+                )
+                shared_time = min(shared_time, elapsed)
+            wrong = sum(
+                not torch.allclose(exp, act, rtol=1e-5, atol=1e-6)
+                for exp, act in zip(expected, actual)
+            )
+            mismatches += wrong
+            print(
+                f"{rg_num} reduced graphs (coarsity {jt_coarsity}{', ErG' if use_erg else ''}, "
+                f"{'sequential' if sequential else 'layer input'}): "
+                f"pairwise {pairwise_time * 1e3:6.2f}ms, _rg2rg {shared_time * 1e3:6.2f}ms "
+                f"({pairwise_time / shared_time:4.2f}x), {wrong} mismatches"
+            )
+    if mismatches > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--root", default="./data/polaris")
+    parser.add_argument("--task", default="potency")
+    parser.add_argument("--target_task", default="pIC50 (MERS-CoV Mpro)")
+    parser.add_argument("--batch_size", default=128, type=int)
+    parser.add_argument("--repeats", default=20, type=int)
+    parser.add_argument("--trials", default=3, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    main(vars(parser.parse_args()))
@@ -0,0 +1,121 @@
+"""
+Training step: the previous training loop (per-parameter Adam, `loss.item()` on every batch)
+versus the lean `Trainer._train_loop` (on-tensor loss, foreach or fused Adam, gradients set to
+None), for GIN and HOIMP on batches of the packed Polaris training molecules. Checks that the
+previous loop and the foreach one end up with identical weights and reports the steps per second
+of each.
+
+    python -m benchmarks.train_step --batch_sizes 64 128
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+import torch
+from torch.optim import Adam
+
+from src.data import PolarisDataset
+from src.loader import PackedDataset
+from src.trainer import Trainer
+
+CONFIGS = {
+    "GIN": {"repr_model": "GIN"},
+    "HOIMP": {"repr_model": "HOIMP", "use_jt": True, "jt_coarsity": 2, "use_erg": True},
+}
+
+PARAMS = {
+    "hidden_channels": 32,
+    "out_channels": 32,
+    "num_layers": 3,
+    "dropout": 0.1,
+    "encoding_dim": 8,
+    "radius": 2,
+    "out_dim": 1,
+    "proj_hidden_dim": 32,
+    "rg_embedding_dim": 8,
+    "lr": 1e-3,
+    "weight_decay": 1e-4,
+    "use_jt": False,
+    "jt_coarsity": 1,
+    "use_erg": False,
+    "seed": 42,
+}
+
+
+def previous_train_loop(trainer, dataloader) -> None:
+    trainer.model.train()
+    epoch_loss = 0
+    for data in dataloader:
+        out = trainer.model(data)
+        loss = trainer.loss_fn(out, data.y)
+        loss.backward()
+        trainer.optimizer.step()
+        trainer.optimizer.zero_grad()
+        epoch_loss += loss.item()
+
+
+def steps_per_sec(params: dict, batches, train_loop, optimizer=None):
+    trainer = Trainer(params, init_dataset=False)
+    if optimizer is not None:
+        trainer.optimizer = optimizer(trainer.model.parameters())
+    torch.manual_seed(params["seed"])  # Same dropout masks for every loop
+    start = time.perf_counter()
+    train_loop(trainer, batches)
+    elapsed = time.perf_counter() - start
+    weights = torch.cat([param.detach().view(-1) for param in trainer.model.parameters()])
+    return len(batches) / elapsed, weights
+
+
+def main(params: dict) -> None:
+    mismatches = 0
+    for name, config in CONFIGS.items():
+        dataset = PackedDataset(
+            PolarisDataset(
+                root=Path(params["root"]) / params["task"],
+                task=params["task"],
+                target_task=params["target_task"],
+                train=True,
+                log_transform=params["task"] == "admet",
+                cache_dir=None,
+                use_jt=config.get("use_jt", False),
+                jt_coarsity=config.get("jt_coarsity", 1),
+                use_erg=config.get("use_erg", False),
+            )
+        )
+        for batch_size in params["batch_sizes"]:
+            generator = torch.Generator().manual_seed(params["seed"])
+            order = torch.randperm(len(dataset), generator=generator)
+            batches = dataset.batches(order[: params["num_steps"] * batch_size], batch_size)
+
+            trainer_params = dict(PARAMS, **config, batch_size=batch_size)
+            previous, expected = steps_per_sec(
+                trainer_params,
+                batches,
+                previous_train_loop,
+                lambda parameters: Adam(parameters, lr=1e-3, weight_decay=1e-4, foreach=False),
+            )
+            lean, actual = steps_per_sec(trainer_params, batches, Trainer._train_loop)
+            fused, _ = steps_per_sec(
+                dict(trainer_params, fused_optimizer=True), batches, Trainer._train_loop
+            )
+            wrong = int(not torch.equal(expected, actual))
+            mismatches += wrong
+            print(
+                f"{name:>5}, batches of {batch_size:3d}: previous {previous:6.1f}, "
+                f"lean {lean:6.1f} ({lean / previous:4.2f}x), "
+                f"fused {fused:6.1f} ({fused / previous:4.2f}x) steps/s, {wrong} mismatches"
+            )
+    if mismatches > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--root", default="./data/polaris")
+    parser.add_argument("--task", default="potency")
+    parser.add_argument("--target_task", default="pIC50 (MERS-CoV Mpro)")
+    parser.add_argument("--batch_sizes", default=[64, 128], type=int, nargs="+")
+    parser.add_argument("--num_steps", default=50, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    main(vars(parser.parse_args()))
@@ -0,0 +1,72 @@
+"""
+Junction tree decomposition: PyG's `tree_decomposition` versus the one of `src.decomposition`.
+Checks that both produce identical trees, mappings and vocabularies for every molecule of the raw
+Polaris data and a set of bridged and caged ring systems, and reports the time spent per
+implementation.
+
+    python -m benchmarks.tree_decomposition
+"""
+
+import argparse
+import csv
+import time
+from pathlib import Path
+
+import torch
+from torch_geometric.utils import tree_decomposition as reference_tree_decomposition
+
+from src.chem import get_mol
+from src.decomposition import tree_decomposition
+
+# Bridged, caged, spiro and fused ring systems, where rings are merged and singletons added
+EXTRA_SMILES = [
+    "C1C2CC3CC1CC(C2)C3",
+    "C12C3C4C1C5C2C3C45",
+    "CC1(C)C2CCC1(C)C(=O)C2",
+    "C1CCC2(CC1)CCCC2",
+    "C12(C3CC(C1)C2)CC3",
+    "CC12CCC3C(CCC4=CC(=O)CCC34C)C1CCC2O",
+    "C1CC2CCC3CCC4CCC1C1C2C3C41",
+    "CC(C)(C)C(C)(C)C",
+    "c1ccc2c(c1)ccc1ccccc12",
+    "[Na+].[Cl-]",
+]
+
+
+def equal(a, b) -> bool:
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(equal(x, y) for x, y in zip(a, b))
+    if isinstance(a, torch.Tensor):
+        return a.dtype == b.dtype and a.shape == b.shape and torch.equal(a, b)
+    return a == b
+
+
+def main(params: dict) -> None:
+    smiles = list(EXTRA_SMILES)
+    for path in sorted(Path(params["root"]).glob("*/raw/*_polaris.csv")):
+        with open(path, "r") as file:
+            lines = csv.reader(file)
+            next(lines)  # skip header
+            smiles.extend(line[0] for line in lines)
+    mols = [mol for mol in map(get_mol, smiles) if mol is not None]
+
+    start = time.perf_counter()
+    expected = [reference_tree_decomposition(mol, return_vocab=True) for mol in mols]
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = [tree_decomposition(mol, return_vocab=True) for mol in mols]
+    new_time = time.perf_counter() - start
+
+    mismatches = sum(not equal(exp, act) for exp, act in zip(expected, actual))
+    print(f"{len(mols)} molecules, {mismatches} mismatches")
+    print(f"torch_geometric: {reference_time:6.3f}s")
+    print(f"src:             {new_time:6.3f}s ({reference_time / new_time:4.1f}x)")
+    if mismatches > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--root", default="./data/polaris")
+    main(vars(parser.parse_args()))
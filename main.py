@@ -56,10 +56,109 @@ if __name__ == "__main__":
         "--use_jt", help="Use Junction Tree", default=False, type=str2bool, const=True, nargs="?"
     )
     parser.add_argument("--jt_coarsity", help="Junction tree coarsity", default=1, type=int)
+    parser.add_argument(
+        "--jt_max_coarsity",
+        help="Junction tree levels to featurize, shared by every jt_coarsity up to it",
+        default=3,
+        type=int,
+    )
     parser.add_argument(
         "--rg_embedding_dim", help="Reduced graph embedding dimension", default=8, type=int
     )
+    parser.add_argument(
+        "--sequential_rg2rg",
+        help="Exchange messages between reduced graph pairs one after another, as in the original "
+        "model (false: all from the reduced graphs entering the layer, faster for three or more)",
+        default=True,
+        type=str2bool,
+        const=True,
+        nargs="?",
+    )
     parser.add_argument("--seed", help="Seed to set", default=42, type=int)
+    parser.add_argument(
+        "--cache_dir",
+        help="Directory of the persistent featurization cache (empty string to disable)",
+        default="./data/cache",
+    )
+    parser.add_argument(
+        "--num_workers",
+        help="Number of featurization processes (0 to use all CPUs)",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--packed_store",
+        help="Train on a memory-mapped packed store of the dataset shared by all runs",
+        default=True,
+        type=str2bool,
+        const=True,
+        nargs="?",
+    )
+    parser.add_argument(
+        "--shard_size",
+        help="Stream the training data from featurized shards of this many molecules (0 to load "
+        "it into memory)",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--shuffle_buffer",
+        help="Number of molecules shuffled together when streaming from shards",
+        default=50_000,
+        type=int,
+    )
+    parser.add_argument(
+        "--cv_workers",
+        help="Number of cross-validation folds trained concurrently in worker processes (0 for "
+        "one per fold)",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--fold_threads",
+        help="Intra-op threads of each fold worker (0 to split the available threads evenly)",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--patience",
+        help="Stop training after this many validations without improvement and restore the best "
+        "weights (0 to train all epochs)",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--valid_every", help="Validate every this many epochs", default=1, type=int
+    )
+    parser.add_argument(
+        "--epoch_grid",
+        help="Comma separated epoch values evaluated in one run of the largest, one results row "
+        "each (replaces --epochs)",
+        default="",
+    )
+    parser.add_argument(
+        "--compile",
+        help="Experimental, measured slower than eager on CPU: compile the model once and reuse it "
+        "for every fold",
+        default=False,
+        type=str2bool,
+        const=True,
+        nargs="?",
+    )
+    parser.add_argument(
+        "--fused_optimizer",
+        help="Use the fused Adam implementation, faster but not bitwise identical to the default",
+        default=False,
+        type=str2bool,
+        const=True,
+        nargs="?",
+    )
+    parser.add_argument(
+        "--save_model",
+        help="Save the weights and configuration of the final model to this file, to be loaded "
+        "for inference with src.models.load_model",
+        default="",
+    )
 
     input_args = parser.parse_args()
     input_args_dict = vars(input_args)
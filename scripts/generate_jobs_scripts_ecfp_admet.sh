@@ -21,6 +21,7 @@ RADIUS=(2 3 4)
 DROPOUT=(0.1)
 PROJ_HIDDEN_DIM=(16 32)
 EPOCHS=(50 100 150)
+EPOCH_GRID=$(IFS=,; echo "${EPOCHS[*]}")  # all evaluated by one job, see --epoch_grid
 
 REPR_MODEL=("ECFP")
 
@@ -49,7 +50,7 @@ for tgt in "${TARGET_TASKS[@]}"; do
             for rd in "${RADIUS[@]}";   do
               #for fr in "${FT_RESOLUTIONS[@]}"; do
                 for rm in "${REPR_MODEL[@]}"; do
-                  for ep in "${EPOCHS[@]}"; do
+                  for ep in "${EPOCH_GRID}"; do
                     for phd in "${PROJ_HIDDEN_DIM[@]}"; do
                       for dout in "${DROPOUT[@]}"; do
 
@@ -76,7 +77,7 @@ python ${PYTHON_SCRIPT} \
   --task ${TASK} \
   --target_task "${tgt}" \
   --batch_size ${bs} \
-  --epochs ${ep} \
+  --epoch_grid ${ep} \
   --lr ${lr} \
   --weight_decay ${wd} \
   --num_cv_folds ${NUM_CV_FOLDS} \
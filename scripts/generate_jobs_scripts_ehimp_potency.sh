@@ -22,6 +22,7 @@ RG_EMBEDDING_DIMS=(16 32)
 DROPOUT=(0.1)
 PROJ_HIDDEN_DIM=(16 32)
 EPOCHS=(50 100 150)
+EPOCH_GRID=$(IFS=,; echo "${EPOCHS[*]}")  # all evaluated by one job, see --epoch_grid
 
 USE_JT=(True) # False combinations need to be ran seperately with JT_COARSITY adjusted accordingly to avoid sampling bias
 USE_ERG=(True) # False
@@ -52,7 +53,7 @@ for tgt in "${TARGET_TASKS[@]}"; do
             for nl in "${NUM_LAYERS[@]}";   do
               for jc in "${JT_COARSITY[@]}"; do
                 for rg in "${RG_EMBEDDING_DIMS[@]}"; do
-                  for ep in "${EPOCHS[@]}"; do
+                  for ep in "${EPOCH_GRID}"; do
                     for phd in "${PROJ_HIDDEN_DIM[@]}"; do
                       for dout in "${DROPOUT[@]}"; do
                         for USE_JT in "${USE_JT[@]}"; do
@@ -82,7 +83,7 @@ python ${PYTHON_SCRIPT} \
   --task ${TASK} \
   --target_task "${tgt}" \
   --batch_size ${bs} \
-  --epochs ${ep} \
+  --epoch_grid ${ep} \
   --lr ${lr} \
   --weight_decay ${wd} \
   --num_cv_folds ${NUM_CV_FOLDS} \
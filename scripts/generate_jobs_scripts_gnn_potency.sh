@@ -22,6 +22,7 @@ NUM_LAYERS=(1 2 3)
 DROPOUT=(0.1)
 PROJ_HIDDEN_DIM=(16 32)
 EPOCHS=(50 100 150)
+EPOCH_GRID=$(IFS=,; echo "${EPOCHS[*]}")  # all evaluated by one job, see --epoch_grid
 
 REPR_MODEL=("GIN" "GCN" "GAT" "GraphSAGE" "HIMP")
 
@@ -51,7 +52,7 @@ for tgt in "${TARGET_TASKS[@]}"; do
             for nl in "${NUM_LAYERS[@]}";   do
               #for fr in "${FT_RESOLUTIONS[@]}"; do
                 for rm in "${REPR_MODEL[@]}"; do
-                  for ep in "${EPOCHS[@]}"; do
+                  for ep in "${EPOCH_GRID}"; do
                     for phd in "${PROJ_HIDDEN_DIM[@]}"; do
                       for dout in "${DROPOUT[@]}"; do
 
@@ -78,7 +79,7 @@ python ${PYTHON_SCRIPT} \
   --task ${TASK} \
   --target_task "${tgt}" \
   --batch_size ${bs} \
-  --epochs ${ep} \
+  --epoch_grid ${ep} \
   --lr ${lr} \
   --weight_decay ${wd} \
   --num_cv_folds ${NUM_CV_FOLDS} \
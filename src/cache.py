@@ -0,0 +1,132 @@
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import torch
+from rdkit import Chem
+
+from src.chem import get_mol
+from src.transform import JunctionTreeData, ReducedGraphData
+
+DEFAULT_CACHE_DIR = Path("./data") / "cache"
+
+_DATA_CLASSES = {cls.__name__: cls for cls in (JunctionTreeData, ReducedGraphData)}
+
+
+def config_hash(config: dict) -> str:
+    """
+    Stable short hash of a featurizer configuration.
+    """
+    payload = json.dumps(config, sort_keys=True).encode()
+    return hashlib.sha1(payload).hexdigest()[:16]
+
+
+def file_hash(path) -> str:
+    """
+    Stable short hash of the contents of the file `path`, read in blocks.
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as file:
+        while block := file.read(1 << 20):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def canonical_smiles(smiles: str) -> str:
+    """
+    Return the RDKit canonical form of a SMILES string, or the string itself if it cannot be
+    parsed (it then yields no atoms, and the molecule is skipped by the datasets).
+    """
+    mol = get_mol(smiles)
+    if mol is None:
+        return smiles
+    return Chem.MolToSmiles(mol)
+
+
+def _sha1(text: str) -> str:
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def atomic_save(obj, path: Path) -> None:
+    """
+    Write `obj` to `path` such that concurrent readers either see the complete file or no file.
+    The object is first written to a temporary file in the same directory and then renamed,
+    which is atomic on POSIX file systems (including the NFS/Lustre mounts of our clusters).
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            torch.save(obj, file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_path)
+        raise
+
+
+class FeaturizationCache:
+    """
+    Persistent, content-addressed store of featurized molecules shared by all runs and processes.
+
+    Entries are keyed by the canonical SMILES of a molecule and live in a directory named after the
+    hash of the featurizer configuration:
+
+        <cache_dir>/<config_hash>/entries/<key[:2]>/<key>.pt     key = sha1(canonical SMILES)
+        <cache_dir>/<config_hash>/aliases/<key[:2]>/<key>         key = sha1(SMILES as given)
+
+    The alias files point from the SMILES spelling found in the raw data to the canonical entry,
+    so that a lookup of an already seen molecule does not need RDKit at all. Labels are not part
+    of an entry, hence one entry serves every target of a task. All writes are atomic, so any
+    number of `main_batch.py` workers or SLURM jobs may populate the cache concurrently; a
+    duplicated write of the same entry is harmless since both writers produce the same content.
+    """
+
+    def __init__(self, cache_dir, config: dict):
+        self.config = config
+        self.directory = Path(cache_dir) / config_hash(config)
+
+    def _entry_path(self, key: str) -> Path:
+        return self.directory / "entries" / key[:2] / f"{key}.pt"
+
+    def _alias_path(self, key: str) -> Path:
+        return self.directory / "aliases" / key[:2] / key
+
+    def get(self, smiles: str):
+        """
+        Return the cached featurization of `smiles`, or None on a cache miss.
+        """
+        alias_path = self._alias_path(_sha1(smiles))
+        try:
+            key = alias_path.read_text().strip()
+        except OSError:
+            key = _sha1(canonical_smiles(smiles))
+
+        try:
+            entry = torch.load(self._entry_path(key), weights_only=True)
+        except Exception:
+            return None  # Missing, or written by an incompatible version: recompute
+
+        if not alias_path.exists():
+            self._write_alias(alias_path, key)
+
+        data = _DATA_CLASSES[entry.pop("__class__")](**entry)
+        data.smiles = smiles
+        return data
+
+    def put(self, smiles: str, data) -> None:
+        key = _sha1(canonical_smiles(smiles))
+        entry = {k: v for k, v in data if k != "y"}
+        entry["__class__"] = data.__class__.__name__
+        atomic_save(entry, self._entry_path(key))
+        self._write_alias(self._alias_path(_sha1(smiles)), key)
+
+    def _write_alias(self, alias_path: Path, key: str) -> None:
+        alias_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=alias_path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w") as file:
+            file.write(key)
+        os.replace(tmp_path, alias_path)
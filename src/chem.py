@@ -0,0 +1,180 @@
+from collections import OrderedDict
+
+import torch
+from rdkit import Chem, RDLogger
+from torch_geometric.data import Data
+from torch_geometric.utils import cumsum
+from torch_geometric.utils.smiles import e_map, x_map
+
+DEFAULT_MOL_CACHE_SIZE = 50_000
+
+
+class MolCache:
+    """
+    Bounded LRU cache of parsed RDKit molecules keyed by SMILES.
+
+    Featurization, scaffold splitting and the ECFP model all start from the SMILES string of a
+    molecule. Going through this cache, each unique molecule is parsed once per process and the
+    same `Mol` is shared by every stage. The cached molecules must be treated as read-only.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MOL_CACHE_SIZE):
+        self.max_size = max_size
+        self._mols: OrderedDict[str, Chem.Mol | None] = OrderedDict()
+
+    def get(self, smiles: str) -> Chem.Mol | None:
+        """
+        Return the parsed molecule, or None if `smiles` is not a valid SMILES string.
+        """
+        try:
+            self._mols.move_to_end(smiles)
+            return self._mols[smiles]
+        except KeyError:
+            pass
+
+        RDLogger.DisableLog("rdApp.*")
+        mol = Chem.MolFromSmiles(smiles)
+        self._mols[smiles] = mol
+        if len(self._mols) > self.max_size:
+            self._mols.popitem(last=False)
+        return mol
+
+    def clear(self) -> None:
+        self._mols.clear()
+
+    def __len__(self) -> int:
+        return len(self._mols)
+
+
+mol_cache = MolCache()
+
+
+def get_mol(smiles: str) -> Chem.Mol | None:
+    """
+    Parse `smiles` through the process-wide molecule cache.
+    """
+    return mol_cache.get(smiles)
+
+
+def _encoding(categories: list, enum=None) -> tuple[int, torch.Tensor]:
+    # Offset and table mapping a raw feature value (minus the offset) to its index in
+    # `categories`, or to -1 if it is not one of them. Enum values are matched by name.
+    if enum is not None:
+        names = {value: str(member) for value, member in enum.values.items()}
+        table = [categories.index(names[v]) if names[v] in categories else -1 for v in names]
+        return 0, torch.tensor(table)
+    offset = int(min(categories))
+    table = torch.full((int(max(categories)) - offset + 1,), -1)
+    for i, value in enumerate(categories):
+        table[int(value) - offset] = i
+    return offset, table
+
+
+_ATOM_ENCODINGS = [
+    ("atomic_num", _encoding(x_map["atomic_num"])),
+    ("chirality", _encoding(x_map["chirality"], Chem.rdchem.ChiralType)),
+    ("degree", _encoding(x_map["degree"])),
+    ("formal_charge", _encoding(x_map["formal_charge"])),
+    ("num_hs", _encoding(x_map["num_hs"])),
+    ("num_radical_electrons", _encoding(x_map["num_radical_electrons"])),
+    ("hybridization", _encoding(x_map["hybridization"], Chem.rdchem.HybridizationType)),
+    ("is_aromatic", _encoding(x_map["is_aromatic"])),
+    ("is_in_ring", _encoding(x_map["is_in_ring"])),
+]
+_BOND_ENCODINGS = [
+    ("bond_type", _encoding(e_map["bond_type"], Chem.rdchem.BondType)),
+    ("stereo", _encoding(e_map["stereo"], Chem.rdchem.BondStereo)),
+    ("is_conjugated", _encoding(e_map["is_conjugated"])),
+]
+
+
+def _encode(values: torch.Tensor, encodings) -> torch.Tensor:
+    # Encode the raw feature values (one column per feature) through their tables
+    columns = []
+    for i, (name, (offset, table)) in enumerate(encodings):
+        value = values[:, i] - offset
+        valid = (value >= 0) & (value < len(table))
+        index = torch.where(valid, table[value.clamp(0, len(table) - 1)], -1)
+        if bool((index < 0).any()):
+            raise ValueError(f"{int(values[:, i][index < 0][0])} is not a valid {name}")
+        columns.append(index)
+    return torch.stack(columns, dim=1).view(-1, len(encodings))
+
+
+def mols_to_graphs(mols: list[Chem.Mol]):
+    """
+    Molecular graphs of `mols`, encoded exactly like `torch_geometric.utils.from_rdmol` but built
+    in bulk: RDKit is queried once per atom and bond for its raw values, and the lookup of their
+    categories, the reverse edges and the edge sorting are tensor operations over all molecules.
+
+    Returns the concatenated `x`, `edge_index` (indices local to their molecule) and `edge_attr`
+    together with the pointers `node_ptr` and `edge_ptr` of where each molecule starts.
+    """
+    atoms, bonds, num_nodes, num_bonds = [], [], [], []
+    for mol in mols:
+        num_nodes.append(mol.GetNumAtoms())
+        num_bonds.append(mol.GetNumBonds())
+        # Indexed access, as iterating `GetAtoms()` goes through a Python-level sequence wrapper
+        for atom in map(mol.GetAtomWithIdx, range(num_nodes[-1])):
+            atoms.append(
+                (
+                    atom.GetAtomicNum(),
+                    int(atom.GetChiralTag()),
+                    atom.GetTotalDegree(),
+                    atom.GetFormalCharge(),
+                    atom.GetTotalNumHs(),
+                    atom.GetNumRadicalElectrons(),
+                    int(atom.GetHybridization()),
+                    atom.GetIsAromatic(),
+                    atom.IsInRing(),
+                )
+            )
+        for bond in map(mol.GetBondWithIdx, range(num_bonds[-1])):
+            bonds.append(
+                (
+                    bond.GetBeginAtomIdx(),
+                    bond.GetEndAtomIdx(),
+                    int(bond.GetBondType()),
+                    int(bond.GetStereo()),
+                    bond.GetIsConjugated(),
+                )
+            )
+
+    x = _encode(torch.tensor(atoms, dtype=torch.long).view(-1, 9), _ATOM_ENCODINGS)
+    bonds = torch.tensor(bonds, dtype=torch.long).view(-1, 5)
+    bond_attr = _encode(bonds[:, 2:], _BOND_ENCODINGS)
+
+    # Both directions of every bond, with indices offset by the first atom of their molecule
+    node_ptr = cumsum(torch.tensor(num_nodes, dtype=torch.long))
+    num_bonds = torch.tensor(num_bonds, dtype=torch.long)
+    offset = torch.repeat_interleave(node_ptr[:-1], num_bonds)
+    row = torch.stack((bonds[:, 0], bonds[:, 1]), dim=1).view(-1) + offset.repeat_interleave(2)
+    col = torch.stack((bonds[:, 1], bonds[:, 0]), dim=1).view(-1) + offset.repeat_interleave(2)
+    edge_attr = bond_attr.repeat_interleave(2, dim=0)
+
+    # Sorting by global indices sorts the edges of every molecule, and keeps molecules in order
+    perm = (row * max(int(node_ptr[-1]), 1) + col).argsort()
+    offset = offset.repeat_interleave(2)[perm]
+    edge_index = torch.stack((row[perm] - offset, col[perm] - offset))
+    edge_attr = edge_attr[perm]
+    return x, edge_index, edge_attr, node_ptr, cumsum(2 * num_bonds)
+
+
+def mols_to_data_list(mols: list[Chem.Mol]) -> list[Data]:
+    """
+    The `from_rdmol` graphs of `mols`, built in bulk by `mols_to_graphs`.
+    """
+    x, edge_index, edge_attr, node_ptr, edge_ptr = mols_to_graphs(mols)
+    data_list = []
+    for i in range(len(mols)):
+        # Cloned, so that no graph keeps the storage of the whole batch alive (or pickles it)
+        nodes = slice(int(node_ptr[i]), int(node_ptr[i + 1]))
+        edges = slice(int(edge_ptr[i]), int(edge_ptr[i + 1]))
+        data_list.append(
+            Data(
+                x=x[nodes].clone(),
+                edge_index=edge_index[:, edges].clone(),
+                edge_attr=edge_attr[edges].clone(),
+            )
+        )
+    return data_list
@@ -1,6 +1,7 @@
 import atexit
 import csv
 import os
+import re
 import shutil
 import socket
 import time
@@ -12,9 +13,12 @@ from typing import List
 import torch
 from torch_geometric.data import Data, InMemoryDataset
 from torch_geometric.datasets import MoleculeNet
-from torch_geometric.utils import from_smiles
 
-from src.transform import JunctionTree, ReducedGraph
+from src.cache import DEFAULT_CACHE_DIR, FeaturizationCache, config_hash, file_hash
+from src.featurize import featurize_smiles
+from src.loader import PackedDataset, open_packed
+from src.shards import DEFAULT_SHARD_SIZE, DEFAULT_SHUFFLE_BUFFER, ShardedDataset, build_shards
+from src.transform import DEFAULT_JT_MAX_COARSITY, MoleculeFeaturizer
 from src.utils import scaffold_split
 
 # Ignore FutureWarnings from torch.load about weightsOnly bool != True
@@ -31,25 +35,63 @@ class MoleculeNetDataset:
         use_erg=False,
         use_jt=False,
         jt_coarsity=0,
+        materialize=True,
+        cache_dir=DEFAULT_CACHE_DIR,
+        num_workers=1,
+        jt_max_coarsity=DEFAULT_JT_MAX_COARSITY,
     ):
+        """
+        With `materialize` (the default) the reduced graphs are computed once while processing the
+        raw data, on `num_workers` processes, and stored on disk keyed by the featurizer
+        configuration. Otherwise they are recomputed by a PyG `transform` on every access, i.e. in
+        every batch of every epoch. Junction trees are featurized at `jt_max_coarsity` levels, so
+        the stored reduced graphs serve every `jt_coarsity` up to it.
+        """
         self.root = root
         self.target_task = target_task
         self.force_reload = force_reload
-        self.junction_tree = JunctionTree()
-        self.reduced_graph = ReducedGraph(use_erg=use_erg, use_jt=use_jt, jt_coarsity=jt_coarsity)
-        self.use_himp_preprocessing = not (use_jt or use_erg)
+        self.materialize = materialize
+        self.num_workers = num_workers
+        self.featurizer = MoleculeFeaturizer(
+            use_erg=use_erg,
+            use_jt=use_jt,
+            jt_coarsity=jt_coarsity,
+            jt_max_coarsity=jt_max_coarsity,
+        )
+        self.cache = (
+            FeaturizationCache(cache_dir, self.featurizer.config) if cache_dir is not None else None
+        )
 
     def _transform(self, data):
-        if self.use_himp_preprocessing:
-            # HIMP Graph
-            data = self.junction_tree(data)
-        else:
-            # Extended IMP Graphs
-            data = self.reduced_graph(data)
+        return self.featurizer.view(self.featurizer.transform(data))
 
-        return data
+    def create_packed_dataset(self) -> PackedDataset:
+        """
+        The materialized dataset packed into a memory-mapped store shared by all runs with the same
+        raw data, featurizer configuration and `jt_coarsity`, see `open_packed`.
+        """
+        directory = Path(self.root) / self.target_task.lower()
+        raw_path = directory / "raw" / f"{MoleculeNet.names[self.target_task.lower()][2]}.csv"
+        dataset = None
+        if not raw_path.exists():
+            dataset = self.create_dataset()  # Downloads the raw data
+        source = file_hash(raw_path)
+        path = directory / "packed" / _packed_name(self.featurizer, source=source)
+        return open_packed(
+            path, self.create_dataset if dataset is None else lambda: dataset, source=source
+        )
 
     def create_dataset(self):
+        if self.materialize:
+            return MaterializedMoleculeNet(
+                root=self.root,
+                name=self.target_task,
+                featurizer=self.featurizer,
+                cache=self.cache,
+                force_reload=self.force_reload,
+                num_workers=self.num_workers,
+            )
+
         return MoleculeNet(
             root=self.root,
             name=self.target_task,
@@ -58,33 +100,126 @@ class MoleculeNetDataset:
         )
 
 
+def _packed_name(featurizer, **settings) -> str:
+    # Packed graphs are views of the featurized ones, hence also depend on the served jt_coarsity.
+    # `settings` include the hash of the raw data as `source`, so changed data is packed anew
+    key = dict(featurizer.config, **settings)
+    if featurizer.view is not None:
+        key["jt_coarsity"] = featurizer.jt_coarsity
+    return f"{config_hash(key)}.pt"
+
+
+class MaterializedMoleculeNet(MoleculeNet):
+    """
+    MoleculeNet dataset whose samples are featurized once while processing the raw data and
+    stored in a processed directory per featurizer configuration:
+    <root>/<name>/processed/<config_hash>/. Accessing a sample is then pure tensor slicing, plus
+    the selection of the requested junction tree levels by the featurizer's view.
+    """
+
+    def __init__(self, root, name, featurizer, cache=None, force_reload=False, num_workers=1):
+        self.featurizer = featurizer
+        self.cache = cache
+        self.num_workers = num_workers
+        super().__init__(root=root, name=name, transform=featurizer.view, force_reload=force_reload)
+
+    @property
+    def processed_dir(self) -> str:
+        return os.path.join(self.root, self.name, "processed", config_hash(self.featurizer.config))
+
+    def process(self):
+        # Same parsing as MoleculeNet.process, featurization is delegated to featurize_smiles
+        with open(self.raw_paths[0], "r") as file:
+            lines = file.read().split("\n")[1:-1]
+            lines = [line for line in lines if len(line) > 0]
+
+        smiles_list, ys = [], []
+        for line in lines:
+            line = re.sub(r"\".*\"", "", line)  # Replace ".*" strings.
+            values = line.split(",")
+
+            smiles_list.append(values[self.names[self.name][3]])
+            labels = values[self.names[self.name][4]]
+            labels = labels if isinstance(labels, list) else [labels]
+            ys.append([float(y) if len(y) > 0 else float("NaN") for y in labels])
+
+        featurized = featurize_smiles(
+            smiles_list, self.featurizer, num_workers=self.num_workers, cache=self.cache
+        )
+
+        data_list = []
+        for smiles, y, data in zip(smiles_list, ys, featurized):
+            if data is None:
+                warnings.warn(f"Skipping molecule '{smiles}' since it resulted in zero atoms")
+                continue
+            data.y = torch.tensor(y, dtype=torch.float).view(1, -1)
+            data_list.append(data)
+
+        self.save(data_list, self.processed_paths[0])
+
+
+def log_transform_labels(y, target_tasks: list[str]):
+    """
+    The log10 of the labels `y` (one column per target of `target_tasks`) of every target but
+    LogD, with 0 in place of infinite values. Missing labels (NaN) stay NaN.
+    """
+    logged = torch.tensor([target_task != "LogD" for target_task in target_tasks])
+    y = y.clone()
+    y_logged = torch.log10(y[:, logged])
+    y_logged[y_logged.isinf()] = 0.0
+    y[:, logged] = y_logged
+    return y
+
+
 class PolarisDataset(InMemoryDataset):
+    """
+    Polaris training or test molecules. The training set holds the labels of `target_task`, or
+    with `target_task=None` those of every target of the task: `y` then has one column per target
+    (NaN where missing) and the boolean `y_mask` marks the present labels. Such a multi-target
+    dataset featurizes each molecule once for all targets; `PackedDataset.select_target` selects
+    one of them.
+    """
+
     def __init__(
         self,
         root,
         task: str,
-        target_task: str,
+        target_task: str | None,
         train=True,
         force_reload=True,
         log_transform=True,
         use_erg=False,
         use_jt=False,
         jt_coarsity=0,
+        cache_dir=DEFAULT_CACHE_DIR,
+        num_workers=1,
+        jt_max_coarsity=DEFAULT_JT_MAX_COARSITY,
     ):
         self.target_task = target_task
         self.train = train
+        self.num_workers = num_workers
         self.force_reload = force_reload
         self.log_transform = log_transform
-        self.junctionTree = JunctionTree()
-        self.use_himp_preprocessing = not (use_jt or use_erg)
-        self.reducedGraph = ReducedGraph(use_erg=use_erg, use_jt=use_jt, jt_coarsity=jt_coarsity)
+        # The test set is always featurized as a HIMP graph
+        self.featurizer = (
+            MoleculeFeaturizer(
+                use_erg=use_erg,
+                use_jt=use_jt,
+                jt_coarsity=jt_coarsity,
+                jt_max_coarsity=jt_max_coarsity,
+            )
+            if train
+            else MoleculeFeaturizer()
+        )
+        # Featurized molecules are shared across runs through a persistent cache, so only the
+        # cheap collation into the per-instance processed directory below is repeated
+        self.cache = (
+            FeaturizationCache(cache_dir, self.featurizer.config) if cache_dir is not None else None
+        )
 
-        if task == "admet":
-            self.target_col = self._admet_target_to_col_mapping(target_task)
-        elif task == "potency":
-            self.target_col = self._potency_target_to_col_mapping(target_task)
-        else:
+        if task not in ("admet", "potency"):
             raise ValueError(f"Unknown task: {task}")
+        self.target_col = None if target_task is None else self.target_to_col(task, target_task)
 
         # TODO Would be smarter to generate all combinations only once.
         # Easiest solution would be to just do it OTF.
@@ -97,9 +232,58 @@ class PolarisDataset(InMemoryDataset):
         # Register the same cleanup routine for both __del__ and atexit
         atexit.register(self._cleanup_processed_dir)
 
-        super().__init__(root, force_reload=force_reload)
+        super().__init__(root, transform=self.featurizer.view, force_reload=force_reload)
         self.load(self.processed_paths[0] if train else self.processed_paths[1])
 
+    @classmethod
+    def packed(
+        cls,
+        root,
+        task: str,
+        target_task: str,
+        log_transform=True,
+        use_erg=False,
+        use_jt=False,
+        jt_coarsity=0,
+        cache_dir=DEFAULT_CACHE_DIR,
+        num_workers=1,
+        jt_max_coarsity=DEFAULT_JT_MAX_COARSITY,
+    ) -> PackedDataset:
+        """
+        Training set packed into a memory-mapped store <root>/packed/<hash>.pt shared by all runs
+        with the same raw training data, featurizer configuration and `jt_coarsity`, see
+        `open_packed`. The store holds the labels of all targets of the task, and `target_task` is
+        selected as a view of it. The molecules are only featurized (through the cache) by the
+        run creating it.
+        """
+        target_col = cls.target_to_col(task, target_task)
+        featurizer = MoleculeFeaturizer(
+            use_erg=use_erg,
+            use_jt=use_jt,
+            jt_coarsity=jt_coarsity,
+            jt_max_coarsity=jt_max_coarsity,
+        )
+        source = file_hash(Path(root) / "raw" / "train_polaris.csv")
+        name = _packed_name(featurizer, source=source, log_transform=log_transform)
+        packed = open_packed(
+            Path(root) / "packed" / name,
+            lambda: cls(
+                root=root,
+                task=task,
+                target_task=None,
+                train=True,
+                log_transform=log_transform,
+                use_erg=use_erg,
+                use_jt=use_jt,
+                jt_coarsity=jt_coarsity,
+                cache_dir=cache_dir,
+                num_workers=num_workers,
+                jt_max_coarsity=jt_max_coarsity,
+            ),
+            source=source,
+        )
+        return packed.select_target(target_col - 1)
+
     @property
     def raw_file_names(self):
         return ["train_polaris.csv", "test_polaris.csv"]
@@ -122,7 +306,10 @@ class PolarisDataset(InMemoryDataset):
         self.process_train() if self.train else self.process_test()
 
     def process_train(self):
-        data_list: list[Data] = []
+        if self.target_col is None:
+            return self.process_train_all()
+
+        smiles_list, ys = [], []
         with open(self.raw_paths[0], "r") as file:
             lines = csv.reader(file)
             next(lines)  # skip header
@@ -140,34 +327,61 @@ class PolarisDataset(InMemoryDataset):
                     if y.isinf():
                         y = torch.zeros_like(y)
 
-                data = from_smiles(smiles)
-                data.y = y
+                smiles_list.append(smiles)
+                ys.append(y)
+
+        data_list: list[Data] = []
+        for y, data in zip(ys, self._featurize(smiles_list)):
+            if data is None:
+                continue  # SMILES without atoms
+            data.y = y
+            data_list.append(data)
+
+        self.save(data_list, self.processed_paths[0])
 
-                if self.use_himp_preprocessing:
-                    # HIMP Graph
-                    data = self.junctionTree(data)
-                else:
-                    # Extended HIMP Graphs
-                    data = self.reducedGraph(data)
+    def process_train_all(self):
+        with open(self.raw_paths[0], "r") as file:
+            lines = csv.reader(file)
+            target_tasks = next(lines)[1:]
+            rows = list(lines)
+
+        smiles_list = [row[0] for row in rows]
+        y = torch.tensor(
+            [
+                [float(label) if len(label) > 0 else float("NaN") for label in row[1:]]
+                for row in rows
+            ],
+            dtype=torch.float,
+        ).view(len(rows), len(target_tasks))
+        y_mask = ~y.isnan()
+        if self.log_transform:
+            y = log_transform_labels(y, target_tasks)
 
-                data_list.append(data)
+        data_list: list[Data] = []
+        for i, data in enumerate(self._featurize(smiles_list)):
+            if data is None:
+                continue  # SMILES without atoms
+            data.y = y[i].view(1, -1)
+            data.y_mask = y_mask[i].view(1, -1)
+            data_list.append(data)
 
         self.save(data_list, self.processed_paths[0])
 
     def process_test(self):
-        data_list: list[Data] = []
         with open(self.raw_paths[1], "r") as file:
             lines = csv.reader(file)
             next(lines)  # skip header
+            smiles_list = [line[0] for line in lines]
 
-            for line in lines:
-                smiles = line[0]
-                data = from_smiles(smiles)
-                data = self.junctionTree(data)
-                data_list.append(data)
+        data_list: list[Data] = [data for data in self._featurize(smiles_list) if data is not None]
 
         self.save(data_list, self.processed_paths[1])
 
+    def _featurize(self, smiles_list: list[str]) -> list[Data]:
+        return featurize_smiles(
+            smiles_list, self.featurizer, num_workers=self.num_workers, cache=self.cache
+        )
+
     def _cleanup_processed_dir(self):
         try:
             shutil.rmtree(self.processed_dir, ignore_errors=True)
@@ -177,6 +391,14 @@ class PolarisDataset(InMemoryDataset):
     def __del__(self):
         self._cleanup_processed_dir()
 
+    @classmethod
+    def target_to_col(cls, task: str, target_task: str) -> int:
+        if task == "admet":
+            return cls._admet_target_to_col_mapping(target_task)
+        if task == "potency":
+            return cls._potency_target_to_col_mapping(target_task)
+        raise ValueError(f"Unknown task: {task}")
+
     @staticmethod
     def _admet_target_to_col_mapping(target_task: str) -> int:
         match target_task:
@@ -202,3 +424,57 @@ class PolarisDataset(InMemoryDataset):
                 return 2
             case _:
                 raise ValueError(f"Unknown target task: {target_task}")
+
+
+class ShardedPolarisDataset(ShardedDataset):
+    """
+    Polaris training data streamed from featurized shards instead of being held in memory, for
+    libraries that do not fit into RAM. The raw CSV is read `shard_size` rows at a time and written
+    to <root>/shards/<config_hash>/ once per featurizer configuration; the shards then serve every
+    target of the task and every `jt_coarsity` up to `jt_max_coarsity`. Labels are transformed as
+    in `PolarisDataset`.
+    """
+
+    def __init__(
+        self,
+        root,
+        task: str,
+        target_task: str,
+        log_transform=True,
+        use_erg=False,
+        use_jt=False,
+        jt_coarsity=0,
+        num_workers=1,
+        jt_max_coarsity=DEFAULT_JT_MAX_COARSITY,
+        shard_size=DEFAULT_SHARD_SIZE,
+        buffer_size=DEFAULT_SHUFFLE_BUFFER,
+    ):
+        self.target_task = target_task
+        self.log_transform = log_transform
+        self.featurizer = MoleculeFeaturizer(
+            use_erg=use_erg,
+            use_jt=use_jt,
+            jt_coarsity=jt_coarsity,
+            jt_max_coarsity=jt_max_coarsity,
+        )
+        target_col = PolarisDataset.target_to_col(task, target_task)
+        directory = Path(root) / "shards" / config_hash(self.featurizer.config)
+        build_shards(
+            Path(root) / "raw" / "train_polaris.csv",
+            directory,
+            self.featurizer,
+            shard_size=shard_size,
+            num_workers=num_workers,
+        )
+        super().__init__(
+            directory,
+            label_col=target_col - 1,
+            label_transform=self._transform_labels,
+            transform=self.featurizer.view,
+            buffer_size=buffer_size,
+        )
+
+    def _transform_labels(self, y):
+        if self.log_transform:
+            y = log_transform_labels(y.view(-1, 1), [self.target_task]).view(-1)
+        return y
@@ -0,0 +1,174 @@
+from collections import OrderedDict
+
+import torch
+from rdkit import Chem
+
+from src.chem import DEFAULT_MOL_CACHE_SIZE, get_mol
+
+
+def _union_find_root(parent: list[int], node: int) -> int:
+    while parent[node] != node:
+        parent[node] = parent[parent[node]]
+        node = parent[node]
+    return node
+
+
+def _spanning_tree(edges: dict, num_cliques: int) -> torch.Tensor:
+    # Minimum spanning tree (forest) of the clique graph with edge weights `100 - edges[(c1, c2)]`,
+    # as both directions of each tree edge sorted by (row, col). Kruskal over the edges in the
+    # order scipy's `minimum_spanning_tree` processes them: by weight, ties broken by (row, col)
+    if len(edges) == 0:
+        return torch.empty((2, 0), dtype=torch.long)
+
+    order = sorted(edges, key=lambda edge: (-edges[edge], edge))
+    parent = list(range(num_cliques))
+    tree = []
+    for c1, c2 in order:
+        r1, r2 = _union_find_root(parent, c1), _union_find_root(parent, c2)
+        if r1 != r2:
+            parent[r2] = r1
+            tree.append((c1, c2))
+    tree.extend([(c2, c1) for c1, c2 in tree])
+    tree.sort()
+    return torch.tensor(tree, dtype=torch.long).t().contiguous()
+
+
+def _cliques(mol: Chem.Mol) -> tuple[list[list[int]], list[int]]:
+    # Rings and bonds, with rings sharing more than 2 atoms merged as they form bridged compounds
+    cliques = [list(ring) for ring in Chem.GetSymmSSSR(mol)]
+    num_rings = len(cliques)
+    xs = [0] * num_rings
+    for bond in map(mol.GetBondWithIdx, range(mol.GetNumBonds())):
+        if not bond.IsInRing():
+            cliques.append([bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()])
+            xs.append(1)
+
+    _merge_bridged_rings(cliques, xs, num_rings, mol.GetNumAtoms())
+    if -1 in xs:
+        cliques = [c for c in cliques if len(c) > 0]
+        xs = [x for x in xs if x >= 0]
+    return cliques, xs
+
+
+def _merge_bridged_rings(cliques: list[list[int]], xs: list[int], num_rings: int, num_atoms: int):
+    # Bond cliques never take part in merging, so only the rings are scanned, in the same order
+    # as all cliques would be. Merged rings are left empty, of kind -1
+    atom2rings = [[] for _ in range(num_atoms)]
+    for c in range(num_rings):
+        for atom in cliques[c]:
+            atom2rings[atom].append(c)
+    for c1 in range(num_rings):
+        for atom in cliques[c1]:
+            for c2 in atom2rings[atom]:
+                if c1 >= c2 or len(cliques[c1]) <= 2 or len(cliques[c2]) <= 2:
+                    continue
+                if len(set(cliques[c1]) & set(cliques[c2])) > 2:
+                    cliques[c1] = list(set(cliques[c1]) | set(cliques[c2]))
+                    xs[c1] = 2
+                    cliques[c2] = []
+                    xs[c2] = -1
+
+
+def _clique_graph(cliques: list[list[int]], atom2cliques: list[list[int]]):
+    # Singleton cliques of atoms in more than 2 intersecting cliques, and the weighted edges of
+    # the "initial" clique graph
+    clique_sets = [set(clique) for clique in cliques]
+    edges, singletons = {}, []
+    for atom, cs in enumerate(atom2cliques):
+        if len(cs) <= 1:
+            continue
+
+        num_bonds = sum(len(cliques[c]) == 2 for c in cs)
+        num_rings = sum(len(cliques[c]) > 4 for c in cs)
+
+        if num_bonds > 2 or (num_bonds == 2 and len(cs) > 2) or num_rings > 2:
+            weight = 1 if num_bonds > 2 or (num_bonds == 2 and len(cs) > 2) else 99
+            c2 = len(cliques) + len(singletons)
+            singletons.append(atom)
+            for c1 in cs:
+                edges[(c1, c2)] = weight
+        else:
+            for i in range(len(cs)):
+                for j in range(i + 1, len(cs)):
+                    c1, c2 = cs[i], cs[j]
+                    count = len(clique_sets[c1] & clique_sets[c2])
+                    edges[(c1, c2)] = min(count, edges.get((c1, c2), 99))
+    return edges, singletons
+
+
+def tree_decomposition(mol: Chem.Mol, return_vocab: bool = False):
+    """
+    Junction tree decomposition of `mol`, with the output of
+    `torch_geometric.utils.tree_decomposition`: the tree edges, the atom to clique mapping, the
+    number of cliques and, with `return_vocab`, the kind of each clique (ring, bond, bridged
+    compound, single atom).
+
+    Follows the same steps in the same order, hence also resolves ties alike, but keeps cliques
+    as sets, only compares rings when merging bridged compounds and replaces the round trip
+    through scipy's sparse matrices for the spanning tree (and the coalescing of its edges) by a
+    Kruskal pass over the clique graph.
+    """
+    num_atoms = mol.GetNumAtoms()
+    cliques, xs = _cliques(mol)
+
+    atom2cliques = [[] for _ in range(num_atoms)]
+    for c, clique in enumerate(cliques):
+        for atom in clique:
+            atom2cliques[atom].append(c)
+
+    edges, singletons = _clique_graph(cliques, atom2cliques)
+    num_cliques = len(cliques) + len(singletons)
+    for c, atom in enumerate(singletons, start=len(cliques)):
+        atom2cliques[atom].append(c)
+
+    row = [atom for atom in range(num_atoms) for _ in atom2cliques[atom]]
+    col = [c for cs in atom2cliques for c in cs]
+    atom2clique = torch.tensor([row, col], dtype=torch.long).view(2, -1)
+    edge_index = _spanning_tree(edges, num_cliques)
+
+    if return_vocab:
+        vocab = torch.tensor(xs + [3] * len(singletons), dtype=torch.long)
+        return edge_index, atom2clique, num_cliques, vocab
+    return edge_index, atom2clique, num_cliques
+
+
+class TreeDecompositionCache(object):
+    """
+    Bounded LRU cache of junction tree decompositions (with vocabulary) keyed by SMILES, so that
+    the HIMP junction tree and the junction tree levels of the reduced graphs are computed from
+    one decomposition per molecule and process. The cached tensors must be treated as read-only.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MOL_CACHE_SIZE):
+        self.max_size = max_size
+        self._trees: OrderedDict[str, tuple] = OrderedDict()
+
+    def get(self, smiles: str, mol: Chem.Mol | None = None) -> tuple:
+        try:
+            self._trees.move_to_end(smiles)
+            return self._trees[smiles]
+        except KeyError:
+            pass
+
+        tree = tree_decomposition(get_mol(smiles) if mol is None else mol, return_vocab=True)
+        self._trees[smiles] = tree
+        if len(self._trees) > self.max_size:
+            self._trees.popitem(last=False)
+        return tree
+
+    def clear(self) -> None:
+        self._trees.clear()
+
+    def __len__(self) -> int:
+        return len(self._trees)
+
+
+tree_cache = TreeDecompositionCache()
+
+
+def get_tree_decomposition(smiles: str, mol: Chem.Mol | None = None) -> tuple:
+    """
+    Junction tree decomposition of the molecule `smiles` (parsed as `mol`, if given) through the
+    process-wide cache, see `tree_decomposition`.
+    """
+    return tree_cache.get(smiles, mol)
@@ -0,0 +1,51 @@
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+
+class FusedEmbedding(torch.nn.Module):
+    """
+    Embeddings of the categorical columns of `x`, summed (`reduce="sum"`) or concatenated
+    (`reduce="cat"`), from a single table holding the table of every column one after another.
+    Offsetting every column into its table turns the lookups of all columns into one kernel.
+
+    Embeds exactly as the lookups per column, whose sums the gradients match up to the order in
+    which repeated categories are accumulated. Initialized and loaded as the `embeddings.{i}` of one
+    `Embedding` per column, so checkpoints and random streams of those carry over unchanged.
+    """
+
+    def __init__(self, num_categories: list[int], embedding_dim: int, reduce: str = "sum"):
+        super().__init__()
+        self.num_categories = list(num_categories)
+        self.embedding_dim = embedding_dim
+        self.reduce = reduce
+        self.weight = torch.nn.Parameter(torch.empty(sum(self.num_categories), embedding_dim))
+        offsets = torch.tensor([0] + self.num_categories[:-1]).cumsum(dim=0)
+        self.register_buffer("offsets", offsets, persistent=False)
+        self.reset_parameters()
+
+    def tables(self) -> tuple[Tensor, ...]:
+        """
+        Views of the embedding table of every column.
+        """
+        return self.weight.data.split(self.num_categories)
+
+    def reset_parameters(self):
+        for table in self.tables():
+            torch.nn.init.normal_(table)
+
+    def forward(self, x: Tensor) -> Tensor:
+        if x.dim() == 1:
+            x = x.unsqueeze(1)
+
+        index = x + self.offsets[: x.size(1)]
+        if self.reduce == "sum":
+            return F.embedding_bag(index, self.weight, mode="sum")
+        return F.embedding(index, self.weight).view(x.size(0), -1)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints of one `Embedding` per column
+        keys = [f"{prefix}embeddings.{i}.weight" for i in range(len(self.num_categories))]
+        if all(key in state_dict for key in keys):
+            state_dict[f"{prefix}weight"] = torch.cat([state_dict.pop(key) for key in keys])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
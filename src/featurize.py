@@ -0,0 +1,116 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+from torch_geometric.data.collate import collate
+from torch_geometric.data.separate import separate
+
+DEFAULT_CHUNK_SIZE = 64
+
+
+def resolve_num_workers(num_workers: int | None) -> int:
+    """
+    Number of featurization worker processes: 0 or None selects all available CPUs.
+    """
+    if not num_workers:
+        return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    return num_workers
+
+
+def _init_worker():
+    # Featurization is RDKit bound, intra-op threads would only oversubscribe the CPUs
+    torch.set_num_threads(1)
+
+
+def featurize_chunk(featurizer, smiles_chunk: list[str]):
+    """
+    Featurize a chunk of molecules and return them in the compact storage format of an
+    `InMemoryDataset`: one concatenated tensor per attribute plus slice pointers. Molecules without
+    atoms are dropped and reported through the returned mask.
+    """
+    data_list, valid = [], []
+    for data in featurizer.featurize_many(smiles_chunk):
+        valid.append(data is not None)
+        if data is not None:
+            data_list.append(data)
+
+    if len(data_list) == 0:
+        return valid, None, None, None
+
+    data, slices, _ = collate(
+        data_list[0].__class__, data_list=data_list, increment=False, add_batch=False
+    )
+    return valid, data.__class__, data.to_dict(), slices
+
+
+def _unpack_chunk(valid, data_cls, data_dict, slices):
+    if data_cls is None:
+        return [None] * len(valid)
+
+    batch = data_cls.from_dict(data_dict)
+    data_list, idx = [], 0
+    for is_valid in valid:
+        if is_valid:
+            data_list.append(separate(data_cls, batch, idx, slices, decrement=False))
+            idx += 1
+        else:
+            data_list.append(None)
+    return data_list
+
+
+def featurize_smiles(
+    smiles_list: list[str],
+    featurizer,
+    num_workers: int | None = 1,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    cache=None,
+) -> list:
+    """
+    Featurize `smiles_list` with `featurizer` on a pool of `num_workers` processes.
+
+    The molecules are split into chunks of `chunk_size` which are featurized independently;
+    results are returned in input order, so the output does not depend on the number of workers.
+    Molecules already present in the featurization `cache` are not sent to the workers, and newly
+    featurized ones are added to it. Entries are None for SMILES that yield no atoms.
+    """
+    out = [None] * len(smiles_list)
+    missing = []
+    for i, smiles in enumerate(smiles_list):
+        if cache is not None:
+            out[i] = cache.get(smiles)
+        if out[i] is None:
+            missing.append(i)
+
+    chunks = [missing[i : i + chunk_size] for i in range(0, len(missing), chunk_size)]
+    smiles_chunks = [[smiles_list[i] for i in chunk] for chunk in chunks]
+    num_workers = min(resolve_num_workers(num_workers), max(len(chunks), 1))
+
+    if num_workers <= 1:
+        for chunk, smiles_chunk in zip(chunks, smiles_chunks):
+            _store_chunk(out, chunk, featurizer.featurize_many(smiles_chunk))
+    else:
+        # Spawned rather than forked workers, as forking after torch has started its thread pools
+        # is not safe (and is what main_batch.py uses as well)
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        ) as executor:
+            results = executor.map(
+                featurize_chunk, [featurizer] * len(smiles_chunks), smiles_chunks
+            )
+            for chunk, result in zip(chunks, results):
+                _store_chunk(out, chunk, _unpack_chunk(*result))
+
+    if cache is not None:
+        for i in missing:
+            if out[i] is not None:
+                cache.put(smiles_list[i], out[i])
+
+    return out
+
+
+def _store_chunk(out: list, chunk: list[int], data_list) -> None:
+    for i, data in zip(chunk, data_list):
+        out[i] = data
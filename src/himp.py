@@ -2,53 +2,20 @@ import torch
 import torch.nn.functional as F
 from torch.nn import BatchNorm1d, Embedding, Linear, ModuleList, ReLU, Sequential
 from torch_geometric.nn import GINConv, GINEConv
-from torch_scatter import scatter
+from torch_geometric.utils import scatter
 
+from src.embedding import FusedEmbedding
+from src.mapping import ClusterMapping
 
-class AtomEncoder(torch.nn.Module):
-    def __init__(self, hidden_channels):
-        super(AtomEncoder, self).__init__()
-
-        self.embeddings = torch.nn.ModuleList()
-
-        for i in range(9):
-            self.embeddings.append(Embedding(100, hidden_channels))
-
-    def reset_parameters(self):
-        for embedding in self.embeddings:
-            embedding.reset_parameters()
-
-    def forward(self, x):
-        if x.dim() == 1:
-            x = x.unsqueeze(1)
 
-        out = 0
-        for i in range(x.size(1)):
-            out += self.embeddings[i](x[:, i])
-        return out
-
-
-class BondEncoder(torch.nn.Module):
+class AtomEncoder(FusedEmbedding):
     def __init__(self, hidden_channels):
-        super(BondEncoder, self).__init__()
-
-        self.embeddings = torch.nn.ModuleList()
-
-        for i in range(3):
-            self.embeddings.append(Embedding(100, hidden_channels))
-
-    def reset_parameters(self):
-        for embedding in self.embeddings:
-            embedding.reset_parameters()
+        super(AtomEncoder, self).__init__([100] * 9, hidden_channels)
 
-    def forward(self, edge_attr):
-        if edge_attr.dim() == 1:
-            edge_attr = edge_attr.unsqueeze(1)
 
-        out = 0
-        for i in range(edge_attr.size(1)):
-            out += self.embeddings[i](edge_attr[:, i])
-        return out
+class BondEncoder(FusedEmbedding):
+    def __init__(self, hidden_channels):
+        super(BondEncoder, self).__init__([100] * 3, hidden_channels)
 
 
 class Himp(torch.nn.Module):
@@ -107,34 +74,14 @@ class Himp(torch.nn.Module):
         self.clique_lin = Linear(hidden_channels, hidden_channels)
         self.lin = Linear(hidden_channels, out_channels)
 
-    def reset_parameters(self):
-        self.atom_encoder.reset_parameters()
-        self.clique_encoder.reset_parameters()
-
-        for emb, conv, batch_norm in zip(
-            self.bond_encoders, self.atom_convs, self.atom_batch_norms
-        ):
-            emb.reset_parameters()
-            conv.reset_parameters()
-            batch_norm.reset_parameters()
-
-        for conv, batch_norm in zip(self.clique_convs, self.clique_batch_norms):
-            conv.reset_parameters()
-            batch_norm.reset_parameters()
-
-        for lin1, lin2 in zip(self.atom2clique_lins, self.clique2atom_lins):
-            lin1.reset_parameters()
-            lin2.reset_parameters()
-
-        self.atom_lin.reset_parameters()
-        self.clique_lin.reset_parameters()
-        self.lin.reset_parameters()
-
     def forward(self, data):
-        x = self.atom_encoder(data.x.squeeze())
+        x = self.atom_encoder(data.x)
 
         if self.inter_message_passing:
-            x_clique = self.clique_encoder(data.x_clique.squeeze())
+            x_clique = self.clique_encoder(data.x_clique.view(-1))
+            mapping = ClusterMapping(
+                data.atom2clique_index, x.size(0), x_clique.size(0), dtype=x.dtype
+            )
 
         for i in range(self.num_layers):
             edge_attr = self.bond_encoders[i](data.edge_attr)
@@ -144,38 +91,22 @@ class Himp(torch.nn.Module):
             x = F.dropout(x, self.dropout, training=self.training)
 
             if self.inter_message_passing:
-                row, col = data.atom2clique_index
-
-                x_clique = x_clique + F.relu(
-                    self.atom2clique_lins[i](
-                        scatter(
-                            x[row], col, dim=0, dim_size=x_clique.size(0), reduce="mean"
-                        )
-                    )
-                )
+                x_clique = x_clique + F.relu(self.atom2clique_lins[i](mapping.to_clusters(x)))
 
                 x_clique = self.clique_convs[i](x_clique, data.tree_edge_index)
                 x_clique = self.clique_batch_norms[i](x_clique)
                 x_clique = F.relu(x_clique)
                 x_clique = F.dropout(x_clique, self.dropout, training=self.training)
 
-                x = x + F.relu(
-                    self.clique2atom_lins[i](
-                        scatter(
-                            x_clique[col], row, dim=0, dim_size=x.size(0), reduce="mean"
-                        )
-                    )
-                )
+                x = x + F.relu(self.clique2atom_lins[i](mapping.to_atoms(x_clique)))
 
-        x = scatter(x, data.batch, dim=0, reduce="mean")
+        x = scatter(x, data.batch, dim=0, dim_size=data.num_graphs, reduce="mean")
         x = F.dropout(x, self.dropout, training=self.training)
         x = self.atom_lin(x)
 
         if self.inter_message_passing:
-            tree_batch = torch.repeat_interleave(data.num_cliques)
-            x_clique = scatter(
-                x_clique, tree_batch, dim=0, dim_size=x.size(0), reduce="mean"
-            )
+            tree_batch = torch.repeat_interleave(data.num_cliques, output_size=x_clique.size(0))
+            x_clique = scatter(x_clique, tree_batch, dim=0, dim_size=x.size(0), reduce="mean")
             x_clique = F.dropout(x_clique, self.dropout, training=self.training)
             x_clique = self.clique_lin(x_clique)
             x = x + x_clique
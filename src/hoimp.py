@@ -2,12 +2,13 @@ import torch
 import torch.nn.functional as F
 from torch.nn import BatchNorm1d, Embedding, Linear, ModuleList, ReLU, Sequential
 from torch_geometric.nn import GINConv, GINEConv
-from torch_scatter import scatter
+from torch_geometric.utils import scatter
 
-from src.transform import ReducedGraphData
+from src.embedding import FusedEmbedding
+from src.mapping import ClusterMapping
 
 
-class AtomEncoder(torch.nn.Module):
+class AtomEncoder(FusedEmbedding):
     """
     Neural network model from the thesis.
 
@@ -18,26 +19,16 @@ class AtomEncoder(torch.nn.Module):
     """
 
     def __init__(self, hidden_channels):
-        super(AtomEncoder, self).__init__()
+        # was 100, increased for the hashing thing
+        super(AtomEncoder, self).__init__([100] * 9, hidden_channels)
 
-        self.embeddings = torch.nn.ModuleList()
+    def reset_parameters(self):
+        for table in self.tables():
+            torch.nn.init.normal_(table)
+            torch.nn.init.xavier_uniform_(table)
 
-        for i in range(9):
-            emb = Embedding(100, hidden_channels)  # was 100, increased for the hashing thing
-            torch.nn.init.xavier_uniform_(emb.weight.data)
-            self.embeddings.append(emb)
 
-    def forward(self, x):
-        if x.dim() == 1:
-            x = x.unsqueeze(1)
-
-        out = 0
-        for i in range(x.size(1)):
-            out += self.embeddings[i](x[:, i])
-        return out
-
-
-class BondEncoder(torch.nn.Module):
+class BondEncoder(FusedEmbedding):
     """
     Neural network model from the thesis.
 
@@ -48,23 +39,12 @@ class BondEncoder(torch.nn.Module):
     """
 
     def __init__(self, hidden_channels):
-        super(BondEncoder, self).__init__()
-
-        self.embeddings = torch.nn.ModuleList()
+        super(BondEncoder, self).__init__([100] * 3, hidden_channels)
 
-        for i in range(3):
-            emb = Embedding(100, hidden_channels)
-            torch.nn.init.xavier_uniform_(emb.weight.data)
-            self.embeddings.append(emb)
-
-    def forward(self, edge_attr):
-        if edge_attr.dim() == 1:
-            edge_attr = edge_attr.unsqueeze(1)
-
-        out = 0
-        for i in range(edge_attr.size(1)):
-            out += self.embeddings[i](edge_attr[:, i])
-        return out
+    def reset_parameters(self):
+        for table in self.tables():
+            torch.nn.init.normal_(table)
+            torch.nn.init.xavier_uniform_(table)
 
 
 class Hoimp(torch.nn.Module):
@@ -88,6 +68,7 @@ class Hoimp(torch.nn.Module):
         use_raw=True,
         inter_message_passing=True,
         inter_graph_message_passing=True,
+        sequential_rg2rg=True,
     ):
         super(Hoimp, self).__init__()
 
@@ -97,6 +78,7 @@ class Hoimp(torch.nn.Module):
         self.use_raw = use_raw
         self.inter_message_passing = inter_message_passing
         self.inter_graph_message_passing = inter_graph_message_passing
+        self.sequential_rg2rg = sequential_rg2rg
 
         # Atom encoder for raw graph data
         self.atom_encoder = AtomEncoder(hidden_channels)
@@ -123,8 +105,8 @@ class Hoimp(torch.nn.Module):
             self.atom_batch_norms.append(BatchNorm1d(hidden_channels))
 
         # GNN layers for reduced graphs
-        self.rg_convs = []
-        self.rg_batch_norms = []
+        self.rg_convs = ModuleList()
+        self.rg_batch_norms = ModuleList()
 
         for i in range(rg_num):
             convs = ModuleList()
@@ -144,7 +126,7 @@ class Hoimp(torch.nn.Module):
             self.rg_batch_norms.append(batch_norms)
 
         # Linear layers for mapping between raw and reduced graphs
-        self.rg2raw_lins = []
+        self.rg2raw_lins = ModuleList()
 
         for i in range(rg_num):
             rg2raw_lins = ModuleList()
@@ -156,7 +138,7 @@ class Hoimp(torch.nn.Module):
 
         # Additional linear layers for mapping between raw and reduced graphs
         if self.inter_message_passing and self.use_raw:
-            self.raw2rg_lins = []
+            self.raw2rg_lins = ModuleList()
             for i in range(rg_num):
                 raw2rg_lins = ModuleList()
 
@@ -181,34 +163,84 @@ class Hoimp(torch.nn.Module):
                     for k in range(j + 1, self.rg_num):
                         self.rg2rg_lins.append(Linear(hidden_channels, hidden_channels))
                         self.rg2rg_lins.append(Linear(hidden_channels, hidden_channels))
+        self.rg2rg_pairs = [self._rg2rg_pairs(i) for i in range(num_layers)]
 
-    def __collect_rg_from_data(self, data):
+    def _rg2rg_pairs(self, layer):
+        """
+        Pairs (j, k) of reduced graphs exchanging messages in `layer`, with the indices of the
+        linear layers transforming the messages to j and k.
         """
-        Collect reduced graph data from data object.
+        pairs = []
+        pairs_per_layer = self.rg_num * (self.rg_num - 1) // 2
+        for j in range(self.rg_num):
+            for k in range(j + 1, self.rg_num):
+                # Every pair has its own two linear layers, in the order they are created
+                pair = len(pairs)
+                global_index_j = layer * (pairs_per_layer * 2) + pair * 2
+                pairs.append((j, k, global_index_j, global_index_j + 1))
+        return pairs
+
+    def _rg2rg(self, rgs, operators, layer):
         """
-        reduced_graphs = []
-        idx = 0
-        while hasattr(data, f"rg_edge_index_{idx}"):
-            rg_data = ReducedGraphData()
-            setattr(rg_data, f"rg_edge_index", getattr(data, f"rg_edge_index_{idx}"))
-            setattr(rg_data, f"mapping", getattr(data, f"mapping_{idx}"))
-            setattr(rg_data, f"rg_num_atoms", getattr(data, f"rg_num_atoms_{idx}"))
-            setattr(rg_data, f"rg_atom_features", getattr(data, f"rg_atom_features_{idx}"))
-            reduced_graphs.append(rg_data)
-            idx += 1
-        return reduced_graphs
+        Inter message passing between the reduced graphs `rgs` in `layer`, through virtual nodes
+        on the atoms, with the `ClusterMapping` of every reduced graph in `operators`.
+
+        With `sequential_rg2rg`, as in the original model, the pairs exchange their messages one
+        after another, every pair sending from the reduced graphs as updated by the pairs before
+        it. Otherwise all messages of a layer are sent from the reduced graphs as they enter it:
+        the virtual nodes of every reduced graph are computed once per layer, and every reduced
+        graph gathers those of all others side by side in a single pass, so the number of sparse
+        products grows linearly with the number of reduced graphs. Both are the same for two
+        reduced graphs.
+        """
+        if self.sequential_rg2rg:
+            out = list(rgs)
+            for j, k, lin_j, lin_k in self.rg2rg_pairs[layer]:
+                x_virt_j = operators[j].to_atoms(out[j])
+                x_virt_k = operators[k].to_atoms(out[k])
+                out[j] = out[j] + self.rg2rg_lins[lin_j](operators[j].to_clusters(x_virt_k)).relu()
+                out[k] = out[k] + self.rg2rg_lins[lin_k](operators[k].to_clusters(x_virt_j)).relu()
+            return out
+
+        x_virt = [operator.to_atoms(rg) for rg, operator in zip(rgs, operators)]
+
+        gathered = {}
+        for j, (rg, operator) in enumerate(zip(rgs, operators)):
+            sources = [k for k in range(self.rg_num) if k != j]
+            x_sources = x_virt[sources[0]]
+            if len(sources) > 1:
+                x_sources = torch.cat([x_virt[k] for k in sources], dim=1)
+            x_sources = operator.to_clusters(x_sources)
+            for k, x_source in zip(sources, x_sources.split(rg.size(1), dim=1)):
+                gathered[j, k] = x_source
+
+        out = list(rgs)
+        for j, k, lin_j, lin_k in self.rg2rg_pairs[layer]:
+            out[j] = out[j] + self.rg2rg_lins[lin_j](gathered[j, k]).relu()
+            out[k] = out[k] + self.rg2rg_lins[lin_k](gathered[k, j]).relu()
+        return out
 
     def forward(self, data):
-        reduced_graphs = self.__collect_rg_from_data(data)
-        rg_num = len(reduced_graphs)
+        # Edge index, atom to reduced node mapping, nodes per molecule and node features of every
+        # reduced graph. Node features are kept 2-dimensional, also for a single reduced node
+        rg_edge_indices = [getattr(data, f"rg_edge_index_{i}") for i in range(self.rg_num)]
+        mappings = [getattr(data, f"mapping_{i}") for i in range(self.rg_num)]
+        rg_num_atoms = [getattr(data, f"rg_num_atoms_{i}") for i in range(self.rg_num)]
 
         # Atom encoding for raw graph
-        x = self.atom_encoder(data.node_feat.squeeze())
+        x = self.atom_encoder(data.node_feat)
 
         # Embeddings for reduced graphs
         rgs = []
         for i in range(self.rg_num):
-            rgs.append(self.rg_embeddings[i](reduced_graphs[i].rg_atom_features.squeeze()))
+            rg_atom_features = getattr(data, f"rg_atom_features_{i}").view(-1)
+            rgs.append(self.rg_embeddings[i](rg_atom_features))
+
+        # Mean aggregation between the atoms and the nodes of every reduced graph
+        operators = [
+            ClusterMapping(mapping, x.size(0), rg.size(0), dtype=x.dtype)
+            for mapping, rg in zip(mappings, rgs)
+        ]
 
         # GNN layers for raw graph
         for i in range(self.num_layers):
@@ -220,95 +252,37 @@ class Hoimp(torch.nn.Module):
                 x = F.dropout(x, self.dropout, training=self.training)
 
             # Inter message passing between reduced graphs
-            if self.inter_graph_message_passing:
-                for j in range(self.rg_num):
-                    for k in range(j + 1, self.rg_num):
-                        rg_j = rgs[j]
-                        rg_k = rgs[k]
-
-                        # Handle edge case where reduced graph has only a single atom.
-                        # Potentially, a more elegant solution can be obtained by adjusting dim_size in scatter.
-                        if len(rg_j.shape) == 1:
-                            rg_j = rg_j.unsqueeze(0)
-                        if len(rg_k.shape) == 1:
-                            rg_k = rg_k.unsqueeze(0)
-
-                        row_j, col_j = reduced_graphs[j].mapping
-                        row_k, col_k = reduced_graphs[k].mapping
-
-                        # Indexing for rg2rg transform selection
-                        pairs_per_layer = self.rg_num * (self.rg_num - 1) // 2
-                        local_index = j * (rg_num - 1) - (j * (j - 1)) // 2 + (k - j - 1) + 1
-                        global_index_j = i * (pairs_per_layer * 2) - 1
-                        global_index_k = global_index_j + (local_index - 1) * 2 + 1
-
-                        # With virtual nodes
-                        x_virt_j = scatter(
-                            rg_j[col_j], row_j, dim=0, dim_size=x.size(0), reduce="mean"
-                        )
-                        x_virt_k = scatter(
-                            rg_k[col_k], row_k, dim=0, dim_size=x.size(0), reduce="mean"
-                        )
-                        rg_j = self.rg2rg_lins[global_index_j](
-                            scatter(
-                                x_virt_k[row_j], col_j, dim=0, dim_size=rg_j.size(0), reduce="mean"
-                            )
-                        ).relu()
-                        rg_k = self.rg2rg_lins[global_index_k](
-                            scatter(
-                                x_virt_j[row_k], col_k, dim=0, dim_size=rg_k.size(0), reduce="mean"
-                            )
-                        ).relu()
-
-                        # Handle edge case where reduced graph has only a single atom
-                        if len(rgs[j].shape) == 1:
-                            rg_j = rg_j.squeeze()
-                        if len(rgs[k].shape) == 1:
-                            rg_k = rg_k.squeeze()
-
-                        rgs[j] += rg_j
-                        rgs[k] += rg_k
+            if self.inter_graph_message_passing and self.rg_num > 1:
+                rgs = self._rg2rg(rgs, operators, i)
 
             # GNN layers for reduced graphs
             for j in range(self.rg_num):
-                row, col = reduced_graphs[j].mapping
                 rg = rgs[j]
 
                 if self.inter_message_passing:
-                    rg = rg + F.relu(
-                        self.raw2rg_lins[j][i](
-                            scatter(x[row], col, dim=0, dim_size=rg.size(0), reduce="mean")
-                        )
-                    )
+                    rg = rg + F.relu(self.raw2rg_lins[j][i](operators[j].to_clusters(x)))
 
-                rg = self.rg_convs[j][i](rg, reduced_graphs[j].rg_edge_index)
+                rg = self.rg_convs[j][i](rg, rg_edge_indices[j])
                 rg = self.rg_batch_norms[j][i](rg)
                 rg = F.relu(rg)
                 rg = F.dropout(rg, self.dropout, training=self.training)
 
                 if self.inter_message_passing:
-                    x = x + F.relu(
-                        self.rg2raw_lins[j][i](
-                            scatter(rg[col], row, dim=0, dim_size=x.size(0), reduce="mean")
-                        )
-                    )
+                    x = x + F.relu(self.rg2raw_lins[j][i](operators[j].to_atoms(rg)))
 
         # Aggregation for raw graph
         if self.use_raw:
-            x = scatter(x, data.batch, dim=0, reduce="mean")
+            x = scatter(x, data.batch, dim=0, dim_size=data.num_graphs, reduce="mean")
             x = F.dropout(x, self.dropout, training=self.training)
             x = self.atom_lin(x)
 
         # Linear layers for reduced graphs
         for i in range(self.rg_num):
-            tree_batch = torch.repeat_interleave(reduced_graphs[i].rg_num_atoms.type(torch.int64))
             rg = rgs[i]
-
-            # Handle edge case where reduced graph only has a single atom
-            if len(rg.shape) == 1:
-                rg = rg.unsqueeze(0)
-
-            rg = scatter(rg, tree_batch, dim=0, dim_size=data.y.size(0), reduce="mean")
+            tree_batch = torch.repeat_interleave(
+                rg_num_atoms[i].type(torch.int64), output_size=rg.size(0)
+            )
+            rg = scatter(rg, tree_batch, dim=0, dim_size=data.num_graphs, reduce="mean")
             rg = F.dropout(rg, self.dropout, training=self.training)
             rg = self.rg_lins[i](rg)
 
@@ -0,0 +1,477 @@
+import copy
+import fcntl
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch import Tensor
+from torch_geometric.data import Batch, Data
+from torch_geometric.loader.dataloader import Collater
+from torch_geometric.utils import cumsum
+
+from src.cache import _DATA_CLASSES, atomic_save
+from src.transform import INC_SIZE, INC_VALUE
+
+_STATE_KEYS = ("num_graphs", "keys", "values", "cat_dims", "sources", "ptr_group", "ptrs")
+
+
+class CollatePlan(object):
+    """
+    How every attribute of a data layout (class and attribute names) is batched: whether it is
+    concatenated, stacked or collected into a list, along which dimension, and from which
+    attributes its per-graph increments are taken (see `ReducedGraphData.increment_sources`).
+
+    PyG's `Batch.from_data_list` asks `__cat_dim__` and `__inc__` for every attribute of every
+    graph, which for reduced graphs means string scans and fresh tensors per graph and key. The
+    plan resolves this once per layout, so that batching reduces to one `torch.cat` per attribute
+    plus vectorized offset additions. Layouts it does not cover are left to PyG.
+    """
+
+    def __init__(self, data):
+        self.cls = data.__class__
+        self.supported = "num_nodes" not in data and "x" in data
+        self.attrs = []  # (key, mode, cat_dim, increment sources)
+        for key, value in data:
+            if isinstance(value, Tensor) and value.layout == torch.strided:
+                cat_dim = data.__cat_dim__(key, value)
+                sources = self._increment_sources(data, key)
+                if cat_dim is None or value.dim() == 0:
+                    self.attrs.append((key, "stack", 0, sources))
+                else:
+                    self.attrs.append((key, "cat", cat_dim % value.dim(), sources))
+                if sources is None or (len(sources) > 1 and self.attrs[-1][2] != 1):
+                    self.supported = False
+            elif isinstance(value, (int, float)):
+                self.attrs.append((key, "number", 0, self._increment_sources(data, key)))
+                self.supported &= self.attrs[-1][3] == ()
+            elif isinstance(value, (str, bytes)) or value is None:
+                self.attrs.append((key, "list", None, ()))
+            else:
+                self.supported = False
+
+        # Attributes whose values increment others are batched first, their batched values are
+        # then the increments
+        value_sources = {
+            name for *_, sources in self.attrs for kind, name in sources or () if kind == INC_VALUE
+        }
+        self.keys = [key for key, *_ in self.attrs]
+        self.attrs.sort(key=lambda attr: attr[0] not in value_sources)
+
+    @staticmethod
+    def _increment_sources(data, key):
+        sources = data.increment_sources(key) if hasattr(data, "increment_sources") else None
+        if sources is not None:
+            return sources
+        # Data.__inc__
+        if "batch" in key:
+            return None  # Depends on the values
+        if "index" in key or key == "face":
+            return ((INC_SIZE, "x"),)
+        return ()
+
+    def collate(self, data_list) -> Batch:
+        num_graphs = len(data_list)
+        stores = [data._store for data in data_list]
+        sizes_of = {}
+
+        def sizes(name):
+            if name not in sizes_of:
+                sizes_of[name] = torch.tensor([store[name].size(0) for store in stores])
+            return sizes_of[name]
+
+        out, slice_dict, inc_dict = {}, {}, {}
+        for key, mode, cat_dim, sources in self.attrs:
+            elems = [store[key] for store in stores]
+            if mode == "list":
+                out[key] = elems
+                slice_dict[key] = torch.arange(num_graphs + 1)
+                inc_dict[key] = None
+                continue
+            if mode == "number":
+                out[key] = torch.tensor(elems)
+                slice_dict[key] = torch.arange(num_graphs + 1)
+                inc_dict[key] = torch.zeros(num_graphs, dtype=torch.long)
+                continue
+
+            if mode == "stack":
+                elems = [elem.unsqueeze(0) for elem in elems]
+            elem_sizes = torch.tensor([elem.shape[cat_dim] for elem in elems])
+            if cat_dim == 0 and mode == "cat":
+                sizes_of.setdefault(key, elem_sizes)
+            value = torch.cat(elems, dim=cat_dim)
+            slice_dict[key] = cumsum(elem_sizes)
+
+            if len(sources) == 0:
+                inc_dict[key] = torch.zeros(num_graphs, dtype=torch.long)
+            else:
+                incs = [
+                    cumsum(out[name].view(-1) if kind == INC_VALUE else sizes(name))[:-1]
+                    for kind, name in sources
+                ]
+                value, inc_dict[key] = _increment(value, cat_dim, elem_sizes, incs)
+            out[key] = value
+
+        out = {key: out[key] for key in self.keys}
+        return _make_batch(self.cls, out, slice_dict, inc_dict, sizes("x"))
+
+
+def _make_batch(cls, out: dict, slice_dict: dict, inc_dict: dict, num_nodes) -> Batch:
+    # Batch of the same form as Batch.from_data_list, given its batched attributes and node counts
+    batch = Batch(_base_cls=cls)
+    for key, value in out.items():
+        batch[key] = value
+    num_graphs = len(num_nodes)
+    batch.batch = torch.repeat_interleave(torch.arange(num_graphs), num_nodes)
+    batch.ptr = cumsum(num_nodes)
+    batch._num_graphs = num_graphs
+    batch._slice_dict = slice_dict
+    batch._inc_dict = inc_dict
+    return batch
+
+
+def _increment(value, cat_dim, elem_sizes, incs):
+    # Add the per-graph increments `incs` (one per row for multiple sources) to the batched value
+    offsets = [torch.repeat_interleave(inc, elem_sizes) for inc in incs]
+    if len(incs) == 1:
+        shape = [1] * value.dim()
+        shape[cat_dim] = -1
+        return value + offsets[0].view(shape), incs[0]
+    return value + torch.stack(offsets), torch.stack(incs, dim=1).unsqueeze(-1)
+
+
+def collate(data_list, plans: dict | None = None) -> Batch:
+    """
+    Batch `data_list` like `Batch.from_data_list`, through a `CollatePlan` taken from `plans`
+    (keyed by data layout) or created and added to it.
+    """
+    data = data_list[0]
+    layout = (data.__class__, tuple(data.keys()))
+    plans = {} if plans is None else plans
+    if layout not in plans:
+        plans[layout] = CollatePlan(data)
+    plan = plans[layout]
+    if not plan.supported:
+        return Batch.from_data_list(data_list)
+    return plan.collate(data_list)
+
+
+class ReducedGraphCollater(Collater):
+    """
+    PyG collater batching graphs through a `CollatePlan`, which additionally derives the atom to
+    cluster mappings of the coarser junction tree levels served by `ReducedGraphView`. Level `i`
+    holds parent pointers `rg_parent_i` from the clusters of level `i - 1`; its mapping consists
+    of the unique pairs `(atom, rg_parent_i[cluster])` over the pairs of level `i - 1`. As atom
+    and cluster indices are already offset per graph after batching, this is one `torch.unique`
+    per level for the whole batch, and yields the mappings in the same order as if they were
+    batched from the individual graphs.
+    """
+
+    def __init__(self, dataset, follow_batch=None, exclude_keys=None):
+        super().__init__(dataset, follow_batch, exclude_keys)
+        self.plans = {}
+
+    def __call__(self, batch):
+        if self.follow_batch or self.exclude_keys or not hasattr(batch[0], "increment_sources"):
+            batch = super().__call__(batch)
+        else:
+            batch = collate(batch, self.plans)
+        if isinstance(batch, Batch):
+            derive_mappings(batch)
+        return batch
+
+
+def derive_mappings(batch) -> None:
+    i = 1
+    while f"rg_parent_{i}" in batch:
+        row, col = batch[f"mapping_{i - 1}"]
+        rg_parent = batch[f"rg_parent_{i}"]
+        num_clusters = max(int(rg_parent.max()) + 1, 1) if rg_parent.numel() > 0 else 1
+        key = torch.unique(row * num_clusters + rg_parent[col])
+        batch[f"mapping_{i}"] = torch.stack((key // num_clusters, key % num_clusters))
+        i += 1
+
+
+class PackedDataset(object):
+    """
+    Graphs of a dataset packed into contiguous tensors, for mini-batches assembled by index.
+
+    Every attribute is concatenated over all graphs (indices local to their graph) with a pointer
+    array of where each graph's part starts, like the storage of an `InMemoryDataset`, and the
+    per-graph increments of index attributes are kept as arrays. Batching graphs `idx` gathers
+    their parts of every attribute with one `index_select` and adds the exclusive cumsum of their
+    increments, without creating a `Data` object per graph. The atom to cluster mappings of the
+    coarser junction tree levels are derived once for the whole dataset. Batches are identical to
+    those of `DataLoader` over `dataset[idx]`.
+
+    Indexing with a sequence returns a view of the selected graphs sharing the packed tensors. A
+    packed dataset can be saved and opened memory-mapped, see `open_packed`. Pickled, e.g. for a
+    worker process, a memory-mapped dataset is mapped again from its file rather than copied, see
+    also `share_memory_`.
+    """
+
+    def __init__(self, dataset):
+        self._indices = None
+        self._target = None
+        self._path = None
+        self.source = None
+        data_list = [dataset[i] for i in range(len(dataset))]
+        plan = CollatePlan(data_list[0])
+        if not plan.supported:
+            raise ValueError(f"Cannot pack graphs of layout {plan.keys}")
+        packed = plan.collate(data_list)
+        derive_mappings(packed)
+
+        self.cls = plan.cls
+        self.num_graphs = len(data_list)
+        self.keys = [key for key in packed.keys() if key not in ("batch", "ptr")]
+        self.lists = {}  # Attributes batched into lists, e.g. smiles
+        self.values, self.cat_dims, self.sources, self.ptr_group = {}, {}, {}, {}
+        self.ptrs = []  # Distinct pointer arrays, shared e.g. by all node level attributes
+        modes = {key: (mode, cat_dim, sources) for key, mode, cat_dim, sources in plan.attrs}
+        for key in self.keys:
+            if key in modes:
+                mode, cat_dim, sources = modes[key]
+                ptr = packed._slice_dict[key]
+            else:  # Derived mapping
+                mode, cat_dim, sources = "cat", 1, data_list[0].increment_sources(key)
+                counts = torch.bincount(packed.batch[packed[key][0]], minlength=self.num_graphs)
+                ptr = cumsum(counts)
+            if mode == "list":
+                self.lists[key] = np.array(packed[key], dtype=object)
+                continue
+            self.cat_dims[key] = cat_dim
+            self.sources[key] = sources
+            self.ptr_group[key] = self._ptr_group(ptr)
+            self.values[key] = packed[key]
+
+        # Increments per graph, and the indices made local to their graph
+        self.increments = {}
+        for key, sources in self.sources.items():
+            if len(sources) == 0:
+                continue
+            self.increments[key] = [
+                packed[name].view(-1) if kind == INC_VALUE else self._counts(name)
+                for kind, name in sources
+            ]
+            incs = [-cumsum(inc)[:-1] for inc in self.increments[key]]
+            counts = self._counts(key)
+            self.values[key], _ = _increment(self.values[key], self.cat_dims[key], counts, incs)
+
+    def _ptr_group(self, ptr) -> int:
+        for i, group_ptr in enumerate(self.ptrs):
+            if torch.equal(ptr, group_ptr):
+                return i
+        self.ptrs.append(ptr)
+        return len(self.ptrs) - 1
+
+    def _counts(self, key):
+        ptr = self.ptrs[self.ptr_group[key]]
+        return ptr[1:] - ptr[:-1]
+
+    def save(self, path, source=None) -> None:
+        """
+        Write the packed dataset to `path`, with an optional fingerprint `source` of the data it
+        was built from, see `open_packed`.
+        """
+        state = {key: getattr(self, key) for key in _STATE_KEYS}
+        state["source"] = source
+        state["cls"] = self.cls.__name__
+        state["lists"] = {key: values.tolist() for key, values in self.lists.items()}
+        state["increments"] = self.increments
+        atomic_save(state, Path(path))
+
+    @classmethod
+    def load(cls, path, mmap=True) -> "PackedDataset":
+        """
+        Load a packed dataset written by `save`. With `mmap`, its tensors are views of the file
+        mapped into memory rather than copies, so processes opening the same file share its pages.
+        """
+        state = torch.load(path, mmap=mmap, weights_only=True)
+        dataset = cls.__new__(cls)
+        dataset._indices = None
+        dataset._target = None
+        dataset._path = Path(path) if mmap else None
+        dataset.source = state.get("source")
+        for key in _STATE_KEYS:
+            setattr(dataset, key, state[key])
+        dataset.cls = _DATA_CLASSES.get(state["cls"], Data)
+        dataset.lists = {
+            key: np.array(values, dtype=object) for key, values in state["lists"].items()
+        }
+        dataset.increments = state["increments"]
+        return dataset
+
+    def share_memory_(self) -> "PackedDataset":
+        """
+        Move the packed tensors into shared memory, so that pickling the dataset (or a view of it)
+        for a `torch.multiprocessing` worker passes handles instead of copies. Memory-mapped
+        datasets are already shared through the page cache and left as they are.
+        """
+        if self._path is None:
+            increments = [inc for incs in self.increments.values() for inc in incs]
+            for tensor in [*self.values.values(), *self.ptrs, *increments]:
+                tensor.share_memory_()
+        return self
+
+    def __getstate__(self) -> dict:
+        if self._path is None:
+            return self.__dict__
+        return {"_path": self._path, "_indices": self._indices, "_target": self._target}
+
+    def __setstate__(self, state: dict) -> None:
+        if "keys" not in state:
+            self.__dict__.update(PackedDataset.load(state["_path"]).__dict__)
+        self.__dict__.update(state)
+
+    def __copy__(self) -> "PackedDataset":
+        # Views share the tensors, not the pickled state of memory-mapped datasets
+        dataset = self.__class__.__new__(self.__class__)
+        dataset.__dict__.update(self.__dict__)
+        return dataset
+
+    def __len__(self) -> int:
+        return self.num_graphs if self._indices is None else len(self._indices)
+
+    def __getitem__(self, idx) -> "PackedDataset":
+        return self.index_select(idx)
+
+    def index_select(self, idx) -> "PackedDataset":
+        """
+        View of the graphs `idx` (in this order).
+        """
+        idx = torch.as_tensor(idx, dtype=torch.long)
+        dataset = copy.copy(self)
+        dataset._indices = idx if self._indices is None else self._indices[idx]
+        return dataset
+
+    def select_target(self, column: int) -> "PackedDataset":
+        """
+        View of the graphs of a multi-target dataset (with labels `y` and presence mask `y_mask`
+        of one column per target) that are labelled for target `column`, with only that target
+        as `y`.
+        """
+        mask = self.values["y_mask"].index_select(
+            0, self.ptrs[self.ptr_group["y_mask"]][self._graphs()]
+        )
+        dataset = self.index_select(torch.nonzero(mask[:, column]).view(-1))
+        dataset._target = column
+        return dataset
+
+    def _graphs(self, idx=None):
+        # Indices of the packed graphs at positions `idx` of this view
+        if idx is None:
+            return torch.arange(self.num_graphs) if self._indices is None else self._indices
+        idx = torch.as_tensor(idx, dtype=torch.long)
+        return idx if self._indices is None else self._indices[idx]
+
+    @property
+    def smiles(self) -> list[str]:
+        return self.lists["smiles"][self._graphs().numpy()].tolist()
+
+    @property
+    def y(self):
+        # One row per graph
+        y = self.values["y"].index_select(0, self.ptrs[self.ptr_group["y"]][self._graphs()])
+        return y if self._target is None else y[:, self._target : self._target + 1]
+
+    def batch(self, idx) -> Batch:
+        """
+        Batch the graphs `idx` (in this order).
+        """
+        idx = self._graphs(idx)
+        groups = []
+        for ptr in self.ptrs:
+            starts = ptr[idx]
+            counts = ptr[idx + 1] - starts
+            slices = cumsum(counts)
+            elems = torch.arange(int(slices[-1])) + torch.repeat_interleave(
+                starts - slices[:-1], counts
+            )
+            groups.append((counts, slices, elems))
+
+        keys = self.keys
+        if self._target is not None:
+            keys = [key for key in keys if key != "y_mask"]
+
+        out, slice_dict, inc_dict = {}, {}, {}
+        for key, value in self.values.items():
+            if key not in keys:
+                continue
+            counts, slice_dict[key], elems = groups[self.ptr_group[key]]
+            value = value.index_select(self.cat_dims[key], elems)
+            if key == "y" and self._target is not None:
+                value = value[:, self._target : self._target + 1]
+            if key in self.increments:
+                incs = [cumsum(inc[idx])[:-1] for inc in self.increments[key]]
+                value, inc_dict[key] = _increment(value, self.cat_dims[key], counts, incs)
+            else:
+                inc_dict[key] = torch.zeros(len(idx), dtype=torch.long)
+            out[key] = value
+        for key, values in self.lists.items():
+            out[key] = values[idx.numpy()].tolist()
+            slice_dict[key] = torch.arange(len(idx) + 1)
+            inc_dict[key] = None
+
+        out = {key: out[key] for key in keys}
+        return _make_batch(self.cls, out, slice_dict, inc_dict, groups[self.ptr_group["x"]][0])
+
+    def batches(self, indices=None, batch_size=1) -> list[Batch]:
+        """
+        All batches of the graphs `indices` (all by default) in order, assembled right away.
+        """
+        indices = torch.arange(len(self)) if indices is None else torch.as_tensor(indices)
+        return [self.batch(idx) for idx in torch.split(indices, batch_size)]
+
+    def loader(self, indices=None, batch_size=1, shuffle=False):
+        """
+        Iterable over the batches of the graphs `indices` (all by default), shuffled like
+        `DataLoader(dataset[indices], batch_size, shuffle)`, i.e. from the same random stream.
+        """
+        indices = range(len(self)) if indices is None else list(indices)
+        return torch.utils.data.DataLoader(
+            indices, batch_size=batch_size, shuffle=shuffle, collate_fn=self.batch
+        )
+
+
+def open_packed(path, build, source=None) -> PackedDataset:
+    """
+    Open the packed dataset stored at `path` memory-mapped, first packing the dataset returned by
+    `build()` into it if the file does not exist yet, or was built from other data than the one
+    of fingerprint `source` (e.g. a hash of the raw file).
+
+    The file is the only copy of the graphs: every process training on it, e.g. all workers of a
+    `main_batch.py` sweep, maps the same pages of the page cache instead of featurizing and
+    holding the dataset itself. A lock file makes concurrent callers wait for the first one to
+    write it rather than packing it again.
+    """
+    path = Path(path)
+    if path.exists():
+        dataset = PackedDataset.load(path)
+        if dataset.source == source:
+            return dataset
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_suffix(".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not path.exists() or PackedDataset.load(path).source != source:
+            PackedDataset(build()).save(path, source=source)
+    return PackedDataset.load(path)
+
+
+class DataLoader(torch.utils.data.DataLoader):
+    """
+    Drop-in replacement of `torch_geometric.loader.DataLoader` batching with
+    `ReducedGraphCollater`.
+    """
+
+    def __init__(
+        self, dataset, batch_size=1, shuffle=False, follow_batch=None, exclude_keys=None, **kwargs
+    ):
+        kwargs.pop("collate_fn", None)
+        super().__init__(
+            dataset,
+            batch_size,
+            shuffle,
+            collate_fn=ReducedGraphCollater(dataset, follow_batch, exclude_keys),
+            **kwargs,
+        )
@@ -0,0 +1,88 @@
+import warnings
+
+import torch
+from torch import Tensor
+
+
+class _SparseMatmul(torch.autograd.Function):
+    """
+    `matrix @ x` for a sparse CSR `matrix`, whose gradient is computed with the precomputed CSR
+    `transpose` instead of transposing `matrix` on every backward pass.
+    """
+
+    @staticmethod
+    def forward(matrix: Tensor, transpose: Tensor, x: Tensor) -> Tensor:
+        return matrix @ x
+
+    @staticmethod
+    def setup_context(ctx, inputs, output):
+        ctx.transpose = inputs[1]
+
+    @staticmethod
+    def backward(ctx, grad: Tensor):
+        return None, None, ctx.transpose @ grad
+
+
+def _csr(row: Tensor, col: Tensor, num_rows: int, num_cols: int) -> tuple[Tensor, Tensor, Tensor]:
+    # Row pointers and column indices of the [num_rows, num_cols] pattern of the entries
+    # (row, col), and the order of the entries in it
+    order = torch.argsort(row * num_cols + col)
+    crow = torch.zeros(num_rows + 1, dtype=torch.long, device=row.device)
+    torch.cumsum(torch.bincount(row, minlength=num_rows), dim=0, out=crow[1:])
+    return crow, col[order], order
+
+
+class ClusterMapping(object):
+    """
+    Mean aggregation along the mapping `index = (atom, cluster)` of atoms to clusters, e.g. the
+    `atom2clique_index` of a junction tree or the `mapping_i` of a reduced graph, in both
+    directions: `to_clusters(x)` is `scatter(x[atom], cluster, reduce="mean")` and
+    `to_atoms(x_cluster)` is `scatter(x_cluster[cluster], atom, reduce="mean")`.
+
+    Built once per batch, as two sparse CSR matrices, cluster by atom and atom by cluster, whose
+    values are the mean normalizations of either direction, and their transposes for the
+    backward pass. Each aggregation is then a single sparse matrix product, without gathering
+    a copy of the features per mapping entry nor counting the entries again. The values are of
+    `dtype`, which has to be the one of the features.
+    """
+
+    def __init__(
+        self, index: Tensor, num_atoms: int, num_clusters: int, dtype: torch.dtype = torch.float
+    ):
+        atom, cluster = index
+        atom_degree = torch.bincount(atom, minlength=num_atoms).clamp(min=1)
+        cluster_degree = torch.bincount(cluster, minlength=num_clusters).clamp(min=1)
+        atom_weight = 1.0 / atom_degree.to(dtype)
+        cluster_weight = 1.0 / cluster_degree.to(dtype)
+
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message="Sparse CSR tensor support is in beta state")
+            self._build(atom, cluster, atom_weight, cluster_weight, num_atoms, num_clusters)
+
+    def _build(self, atom, cluster, atom_weight, cluster_weight, num_atoms, num_clusters):
+        shape = (num_clusters, num_atoms)
+        crow, col, order = _csr(cluster, atom, *shape)
+        self._to_clusters = torch.sparse_csr_tensor(
+            crow, col, cluster_weight[cluster[order]], shape
+        )
+        to_atoms_transpose = torch.sparse_csr_tensor(crow, col, atom_weight[atom[order]], shape)
+
+        shape = (num_atoms, num_clusters)
+        crow, col, order = _csr(atom, cluster, *shape)
+        self._to_atoms = torch.sparse_csr_tensor(crow, col, atom_weight[atom[order]], shape)
+        to_clusters_transpose = torch.sparse_csr_tensor(
+            crow, col, cluster_weight[cluster[order]], shape
+        )
+        self._transposes = (to_clusters_transpose, to_atoms_transpose)
+
+    def to_clusters(self, x: Tensor) -> Tensor:
+        """
+        Mean of the features `x` of the atoms of every cluster.
+        """
+        return _SparseMatmul.apply(self._to_clusters, self._transposes[0], x)
+
+    def to_atoms(self, x_cluster: Tensor) -> Tensor:
+        """
+        Mean of the features `x_cluster` of the clusters of every atom.
+        """
+        return _SparseMatmul.apply(self._to_atoms, self._transposes[1], x_cluster)
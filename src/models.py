@@ -1,12 +1,16 @@
+import math
 import sys
+from pathlib import Path
 
 import torch
 import torch_geometric.utils.smiles as pyg_smiles
-from rdkit import Chem
 from rdkit.Chem import AllChem
 from torch import nn
 from torch_geometric.nn import GAT, GCN, GIN, GraphSAGE, global_add_pool
 
+from src.cache import atomic_save
+from src.chem import get_mol
+from src.embedding import FusedEmbedding
 from src.himp import Himp
 from src.hoimp import Hoimp
 
@@ -92,6 +96,7 @@ def create_repr_model(params: dict) -> nn.Module:
                 rg_embedding_dim=[params["rg_embedding_dim"]] * rg_num,
                 inter_message_passing=imp,
                 inter_graph_message_passing=igmp,
+                sequential_rg2rg=params.get("sequential_rg2rg", True),
             )
         case _:
             raise NotImplementedError
@@ -107,6 +112,67 @@ def create_proj_model(params: dict) -> nn.Module:
     )
 
 
+# Parameters that define the architecture of a `TrainerModel` and the featurization of its input
+MODEL_PARAMS = (
+    "repr_model",
+    "hidden_channels",
+    "out_channels",
+    "num_layers",
+    "dropout",
+    "encoding_dim",
+    "radius",
+    "out_dim",
+    "proj_hidden_dim",
+    "use_jt",
+    "jt_coarsity",
+    "jt_max_coarsity",
+    "use_erg",
+    "rg_embedding_dim",
+    "task",
+    "target_task",
+)
+
+
+def save_model(model: nn.Module, params: dict, path: Path) -> None:
+    """
+    Save the weights of the `TrainerModel` `model` to `path`, together with the parameters of
+    `params` it was created from, see `MODEL_PARAMS`. The weights are packed into one tensor per
+    data type, so loading them reads a few tensors instead of every weight on its own.
+    """
+    state_dict = model.state_dict()
+    layout = [(name, str(value.dtype), list(value.shape)) for name, value in state_dict.items()]
+    packed = {}
+    for name, dtype, _ in layout:
+        packed.setdefault(dtype, []).append(state_dict[name].detach().reshape(-1))
+    state = {
+        "params": {key: params[key] for key in MODEL_PARAMS if key in params},
+        "layout": layout,
+        "packed": {dtype: torch.cat(values) for dtype, values in packed.items()},
+    }
+    atomic_save(state, Path(path))
+
+
+def load_model(path: Path, mmap: bool = True) -> tuple[nn.Module, dict]:
+    """
+    Load a `TrainerModel` saved with `save_model` for inference, returning it in eval mode with the
+    parameters it was created from. With `mmap`, its weights are views of the file mapped into
+    memory rather than copies, so processes serving the same model share its pages.
+    """
+    state = torch.load(path, map_location="cpu", mmap=mmap, weights_only=True)
+    offsets = dict.fromkeys(state["packed"], 0)
+    state_dict = {}
+    for name, dtype, shape in state["layout"]:
+        numel = math.prod(shape)
+        state_dict[name] = state["packed"][dtype][offsets[dtype] : offsets[dtype] + numel]
+        state_dict[name] = state_dict[name].view(shape)
+        offsets[dtype] += numel
+
+    params = state["params"]
+    model = TrainerModel(create_repr_model(params), create_proj_model(params))
+    model.load_state_dict(state_dict, assign=True)
+    return model.eval(), params
+
+
 class TrainerModel(nn.Module):
     def __init__(self, repr_model: nn.Module, proj_model: nn.Module):
         super().__init__()
@@ -142,10 +208,9 @@ class GINModel(nn.Module):
         self.pool = global_add_pool
 
     def forward(self, data):
-        data = self.encoding_model(data)
-        x, edge_index, edge_attr = data.x, data.edge_index, data.edge_attr
-        h = self.model(x=x, edge_index=edge_index, edge_attr=edge_attr)
-        h_G = self.pool(x=h, batch=data.batch)
+        x, edge_attr = self.encoding_model(data)
+        h = self.model(x=x, edge_index=data.edge_index, edge_attr=edge_attr)
+        h_G = self.pool(x=h, batch=data.batch, size=data.num_graphs)
 
         return h_G
 
@@ -173,10 +238,9 @@ class GCNModel(nn.Module):
         self.pool = global_add_pool
 
     def forward(self, data):
-        data = self.encoding_model(data)
-        x, edge_index, edge_attr = data.x, data.edge_index, data.edge_attr
-        h = self.model(x=x, edge_index=edge_index, edge_attr=edge_attr)
-        h_G = self.pool(x=h, batch=data.batch)
+        x, edge_attr = self.encoding_model(data)
+        h = self.model(x=x, edge_index=data.edge_index, edge_attr=edge_attr)
+        h_G = self.pool(x=h, batch=data.batch, size=data.num_graphs)
 
         return h_G
 
@@ -204,10 +268,9 @@ class GATModel(nn.Module):
         self.pool = global_add_pool
 
     def forward(self, data):
-        data = self.encoding_model(data)
-        x, edge_index, edge_attr = data.x, data.edge_index, data.edge_attr
-        h = self.model(x=x, edge_index=edge_index, edge_attr=edge_attr)
-        h_G = self.pool(x=h, batch=data.batch)
+        x, edge_attr = self.encoding_model(data)
+        h = self.model(x=x, edge_index=data.edge_index, edge_attr=edge_attr)
+        h_G = self.pool(x=h, batch=data.batch, size=data.num_graphs)
 
         return h_G
 
@@ -235,10 +298,9 @@ class GraphSAGEModel(nn.Module):
         self.pool = global_add_pool
 
     def forward(self, data):
-        data = self.encoding_model(data)
-        x, edge_index, edge_attr = data.x, data.edge_index, data.edge_attr
-        h = self.model(x=x, edge_index=edge_index, edge_attr=edge_attr)
-        h_G = self.pool(x=h, batch=data.batch)
+        x, edge_attr = self.encoding_model(data)
+        h = self.model(x=x, edge_index=data.edge_index, edge_attr=edge_attr)
+        h_G = self.pool(x=h, batch=data.batch, size=data.num_graphs)
 
         return h_G
 
@@ -276,6 +338,7 @@ class EHIMPModel(nn.Module):
         rg_embedding_dim: list,
         inter_message_passing: bool,
         inter_graph_message_passing: bool,
+        sequential_rg2rg: bool = True,
     ):
         super().__init__()
         self.model = Hoimp(
@@ -287,6 +350,7 @@ class EHIMPModel(nn.Module):
             rg_embedding_dim=rg_embedding_dim,
             inter_message_passing=inter_message_passing,
             inter_graph_message_passing=inter_graph_message_passing,
+            sequential_rg2rg=sequential_rg2rg,
         )
 
     def forward(self, data):
@@ -300,7 +364,7 @@ class ECFPModel(nn.Module):
         # print(self.fpgen.GetInfoString(), flush=True)
 
     def forward(self, data):
-        mols = [Chem.MolFromSmiles(smiles) for smiles in data.smiles]
+        mols = [get_mol(smiles) for smiles in data.smiles]
         ecfps = [list(ecfp) for ecfp in self.fpgen.GetFingerprints(mols)]
         return torch.tensor(ecfps, dtype=torch.float32)  # could also return as uint
 
@@ -331,10 +395,9 @@ class CategoricalEncodingModel(nn.Module):
         )
 
     def forward(self, data):
-        data.x = self.node_embedding(data.x)
-        data.edge_attr = self.edge_embedding(data.edge_attr)
-
-        return data
+        # Embedded node and edge features, the batch itself is left untouched as batches may be
+        # reused across epochs
+        return self.node_embedding(data.x), self.edge_embedding(data.edge_attr)
 
     def get_feature_embedding_dim(self):
         return self.node_embedding.get_node_feature_dim()
@@ -343,13 +406,12 @@ class CategoricalEncodingModel(nn.Module):
         return self.edge_embedding.get_edge_feature_dim()
 
 
-class CategoricalEmbeddingModel(nn.Module):
+class CategoricalEmbeddingModel(FusedEmbedding):
     """
     Model to embed categorical node or edge features
     """
 
     def __init__(self, category_type, embedding_dim=8):
-        super().__init__()
         if category_type == "node":
             num_categories = self._get_num_node_categories()
         elif category_type == "edge":
@@ -357,15 +419,7 @@ class CategoricalEmbeddingModel(nn.Module):
         else:
             print("Invalid category type")
             sys.exit()
-        self.embedding_dim = embedding_dim
-        self.embeddings = nn.ModuleList(
-            [nn.Embedding(num_categories[i], embedding_dim) for i in range(len(num_categories))]
-        )
-
-    def forward(self, x):
-        embedded_vars = [self.embeddings[i](x[:, i]) for i in range(len(self.embeddings))]
-
-        return torch.cat(embedded_vars, dim=-1)
+        super().__init__(num_categories, embedding_dim, reduce="cat")
 
     def get_node_feature_dim(self):
         return len(self._get_num_node_categories() * self.embedding_dim)
@@ -0,0 +1,338 @@
+import copy
+import csv
+import fcntl
+import itertools
+import math
+import numbers
+from collections import OrderedDict
+from pathlib import Path
+
+import torch
+from torch_geometric.data.collate import collate
+from torch_geometric.data.separate import separate
+
+from src.cache import _DATA_CLASSES, atomic_save, file_hash
+from src.featurize import featurize_smiles
+from src.loader import DataLoader
+
+DEFAULT_SHARD_SIZE = 10_000
+DEFAULT_SHUFFLE_BUFFER = 50_000
+
+INDEX_FILE_NAME = "index.pt"
+# Version of the shard layout, shards of another version are rebuilt
+SHARDS_VERSION = 2
+
+
+def read_csv_chunks(path, chunk_size: int):
+    """
+    Yield the header of the CSV file `path`, followed by its rows in lists of `chunk_size`.
+    """
+    with open(path, "r") as file:
+        rows = csv.reader(file)
+        yield next(rows)
+        while chunk := list(itertools.islice(rows, chunk_size)):
+            yield chunk
+
+
+def _shard_path(directory: Path, shard: int) -> Path:
+    return directory / f"shard_{shard:05d}.pt"
+
+
+def _rows_path(directory: Path, shard: int) -> Path:
+    return directory / f"rows_{shard:05d}.pt"
+
+
+def _load_rows(directory: Path, shard: int) -> dict:
+    # SMILES and label table of the graphs of a shard
+    return torch.load(_rows_path(directory, shard), weights_only=True)
+
+
+def _is_built(directory: Path, source: str) -> bool:
+    # Shards of the current layout, built from the raw data of hash `source`
+    path = directory / INDEX_FILE_NAME
+    if not path.exists():
+        return False
+    index = torch.load(path, weights_only=True)
+    return index.get("version") == SHARDS_VERSION and index.get("source") == source
+
+
+def build_shards(
+    raw_path, directory, featurizer, shard_size=DEFAULT_SHARD_SIZE, num_workers=1
+) -> None:
+    """
+    Featurize the molecules of the CSV file `raw_path` (SMILES in the first column, labels in the
+    others) into shards of `directory`, reading `shard_size` rows at a time.
+
+    Every shard holds the graphs of its rows in the storage format of an `InMemoryDataset`, next
+    to a file of their SMILES and the table of their labels (NaN where missing), so one set of
+    shards serves every target of the file. The index written last records the label columns and
+    the number of graphs per shard. Only one shard is held in memory at a time, and molecules are
+    not added to the featurization cache, which would hold a file per molecule of the library.
+    Rows whose SMILES yield no atoms are skipped.
+
+    The index records the hash of `raw_path`, and nothing is done if the shards already exist for
+    its current contents. A lock file makes concurrent callers wait for the first one to write
+    the shards rather than writing them again, like `open_packed`.
+    """
+    directory = Path(directory)
+    source = file_hash(raw_path)
+    if _is_built(directory, source):
+        return
+
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / "index.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not _is_built(directory, source):
+            _write_shards(raw_path, directory, featurizer, shard_size, num_workers, source)
+
+
+def _write_shards(raw_path, directory, featurizer, shard_size, num_workers, source) -> None:
+    chunks = read_csv_chunks(raw_path, shard_size)
+    columns = next(chunks)[1:]
+    sizes = []
+    for shard, rows in enumerate(chunks):
+        featurized = featurize_smiles([row[0] for row in rows], featurizer, num_workers=num_workers)
+        data_list, smiles_list, labels = [], [], []
+        for row, data in zip(rows, featurized):
+            if data is None:
+                continue
+            data_list.append(data)
+            smiles_list.append(row[0])
+            labels.append([float(label) if len(label) > 0 else math.nan for label in row[1:]])
+
+        if len(data_list) > 0:
+            data, slices, _ = collate(
+                data_list[0].__class__, data_list=data_list, increment=False, add_batch=False
+            )
+            atomic_save(
+                (data.__class__.__name__, data.to_dict(), slices), _shard_path(directory, shard)
+            )
+        labels = torch.tensor(labels, dtype=torch.float).view(-1, len(columns))
+        atomic_save({"smiles": smiles_list, "labels": labels}, _rows_path(directory, shard))
+        sizes.append(len(data_list))
+
+    # Shards left over from a larger library of an earlier build
+    for path in [*directory.glob("shard_*.pt"), *directory.glob("rows_*.pt")]:
+        if int(path.stem.split("_")[1]) >= len(sizes):
+            path.unlink()
+
+    index = {
+        "version": SHARDS_VERSION,
+        "source": source,
+        "columns": columns,
+        "sizes": torch.tensor(sizes, dtype=torch.long),
+    }
+    atomic_save(index, directory / INDEX_FILE_NAME)
+
+
+class _ShardStore(object):
+    """
+    Shards of a directory, loaded on demand and kept in a bounded LRU cache.
+    """
+
+    def __init__(self, directory: Path, max_loaded: int):
+        self.directory = directory
+        self.max_loaded = max_loaded
+        self._shards: OrderedDict[int, tuple] = OrderedDict()
+
+    def get(self, shard: int) -> tuple:
+        try:
+            self._shards.move_to_end(shard)
+            return self._shards[shard]
+        except KeyError:
+            pass
+
+        name, data_dict, slices = torch.load(_shard_path(self.directory, shard), weights_only=True)
+        data_cls = _DATA_CLASSES[name]
+        self._shards[shard] = (data_cls, data_cls.from_dict(data_dict), slices)
+        while len(self._shards) > self.max_loaded:
+            self._shards.popitem(last=False)
+        return self._shards[shard]
+
+
+class ShardedDataset(torch.utils.data.Dataset):
+    """
+    Molecules of a directory written by `build_shards`, with the labels of index column
+    `label_col` as targets.
+
+    Only the labels of `label_col` are held in memory; graphs are read from their shard when
+    accessed, and at most `max_loaded_shards` shards are kept loaded (or those of one shuffle
+    buffer of `buffer_size` molecules, see `loader`). SMILES are read from the shards whenever
+    `smiles` is accessed. Indexing with a sequence
+    returns a view of the selected molecules sharing the loaded shards, like the subsets of an
+    `InMemoryDataset`. Molecules without a label for `label_col` are left out; `label_transform`
+    is applied to the labels of the others.
+    """
+
+    def __init__(
+        self,
+        directory,
+        label_col: int,
+        label_transform=None,
+        transform=None,
+        max_loaded_shards=2,
+        buffer_size=DEFAULT_SHUFFLE_BUFFER,
+    ):
+        self.directory = Path(directory)
+        self.transform = transform
+        self.buffer_size = buffer_size
+        index = torch.load(self.directory / INDEX_FILE_NAME, weights_only=True)
+        self.shard_size = int(index["sizes"].max()) if len(index["sizes"]) > 0 else 1
+        self._shard_ptr = torch.cat([torch.zeros(1, dtype=torch.long), index["sizes"].cumsum(0)])
+
+        # Labels are read shard by shard, only those of `label_col` are kept
+        labels = [torch.empty(0)]
+        for shard in range(len(index["sizes"])):
+            labels.append(_load_rows(self.directory, shard)["labels"][:, label_col])
+        labels = torch.cat(labels)
+        self._indices = torch.nonzero(~labels.isnan()).view(-1)
+        labels = labels[self._indices]
+        self._labels = label_transform(labels) if label_transform is not None else labels
+        self._store = _ShardStore(self.directory, max_loaded_shards)
+
+    def share_memory_(self) -> "ShardedDataset":
+        """
+        Move the index into shared memory, see `PackedDataset.share_memory_`. The graphs stay in
+        their shards, which every process reads itself.
+        """
+        self._indices.share_memory_()
+        self._labels.share_memory_()
+        return self
+
+    def __getstate__(self) -> dict:
+        # Loaded shards are not pickled, a process loads the ones it needs
+        state = self.__dict__.copy()
+        state["_store"] = _ShardStore(self.directory, self._store.max_loaded)
+        return state
+
+    def __copy__(self) -> "ShardedDataset":
+        # Views share the loaded shards
+        dataset = self.__class__.__new__(self.__class__)
+        dataset.__dict__.update(self.__dict__)
+        return dataset
+
+    def __len__(self) -> int:
+        return len(self._indices)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, numbers.Integral) or (isinstance(idx, torch.Tensor) and idx.dim() == 0):
+            return self.get(int(idx))
+        return self.index_select(idx)
+
+    def get(self, idx: int):
+        position = int(self._indices[idx])
+        shard = int(self.shard_of(position))
+        data_cls, data, slices = self._store.get(shard)
+        data = separate(
+            data_cls, data, position - int(self._shard_ptr[shard]), slices, decrement=False
+        )
+        data.y = self._labels[idx].view(1, 1)
+        return data if self.transform is None else self.transform(data)
+
+    def index_select(self, idx) -> "ShardedDataset":
+        idx = torch.as_tensor(idx, dtype=torch.long)
+        dataset = copy.copy(self)
+        dataset._indices = self._indices[idx]
+        dataset._labels = self._labels[idx]
+        return dataset
+
+    def shard_of(self, positions):
+        """
+        Shards holding the molecules at `positions` of the shard directory.
+        """
+        return torch.searchsorted(self._shard_ptr, torch.as_tensor(positions), right=True) - 1
+
+    @property
+    def smiles(self) -> list[str]:
+        # Read shard by shard, keeping only those of the selected molecules
+        positions = self._indices
+        shards = self.shard_of(positions)
+        order = torch.argsort(shards, stable=True)
+        unique, counts = torch.unique_consecutive(shards[order], return_counts=True)
+        smiles = [None] * len(positions)
+        for shard, members in zip(unique.tolist(), torch.split(order, counts.tolist())):
+            shard_smiles = _load_rows(self.directory, shard)["smiles"]
+            offsets = (positions[members] - self._shard_ptr[shard]).tolist()
+            for i, offset in zip(members.tolist(), offsets):
+                smiles[i] = shard_smiles[offset]
+        return smiles
+
+    def smiles_chunks(self):
+        """
+        SMILES of the molecules in order, in lists of consecutive molecules of the same shard,
+        each read from its shard as they are iterated.
+        """
+        shards = self.shard_of(self._indices)
+        _, counts = torch.unique_consecutive(shards, return_counts=True)
+        start = 0
+        for count in counts.tolist():
+            shard = int(shards[start])
+            positions = self._indices[start : start + count] - self._shard_ptr[shard]
+            shard_smiles = _load_rows(self.directory, shard)["smiles"]
+            yield [shard_smiles[position] for position in positions.tolist()]
+            start += count
+
+    @property
+    def y(self):
+        return self._labels.view(-1, 1)
+
+    def batches(self, indices=None, batch_size=1):
+        """
+        Iterable over the batches of the molecules `indices` (all by default) in order, read from
+        the shards as they are iterated.
+        """
+        return self.loader(indices, batch_size=batch_size, shuffle=False)
+
+    def loader(self, indices=None, batch_size=1, shuffle=False):
+        """
+        Iterable over the batches of the molecules `indices` (all by default), shuffled through a
+        `ShardedSampler` with a window of `buffer_size` molecules worth of shards.
+        """
+        indices = torch.arange(len(self)) if indices is None else torch.as_tensor(indices)
+        window = self.buffer_size // self.shard_size
+        sampler = ShardedSampler(self.shard_of(self._indices[indices]), indices, window, shuffle)
+        # A window of shuffled shards has to stay loaded while its molecules are drawn
+        self._store.max_loaded = max(self._store.max_loaded, sampler.window + 1)
+        return DataLoader(self, batch_size=batch_size, sampler=sampler)
+
+
+class ShardedSampler(torch.utils.data.Sampler):
+    """
+    Sampler of the dataset indices `indices`, residing in the shards `shards`, which reads the
+    shards one after the other.
+
+    With `shuffle`, the shards are visited in random order, `window` of them at a time, and the
+    molecules of each window are drawn in random order. This is a shuffle buffer of `window`
+    shards: every epoch sees each molecule once and mixes molecules of different shards, while
+    only the shards of the current window need to be loaded. Without, the indices are returned
+    as given.
+    """
+
+    def __init__(self, shards, indices, window: int = 1, shuffle=False, generator=None):
+        self.shards = torch.as_tensor(shards)
+        self.indices = torch.as_tensor(indices)
+        self.window = max(window, 1)
+        self.shuffle = shuffle
+        self.generator = generator
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __iter__(self):
+        if not self.shuffle:
+            yield from self.indices.tolist()
+            return
+
+        generator = self.generator
+        if generator is None:
+            # Seeded from the global RNG, like torch's RandomSampler
+            generator = torch.Generator()
+            generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+
+        order = torch.argsort(self.shards, stable=True)
+        _, counts = torch.unique_consecutive(self.shards[order], return_counts=True)
+        groups = torch.split(self.indices[order], counts.tolist())
+        shards = torch.randperm(len(groups), generator=generator).tolist()
+        for start in range(0, len(shards), self.window):
+            members = torch.cat([groups[shard] for shard in shards[start : start + self.window]])
+            yield from members[torch.randperm(len(members), generator=generator)].tolist()
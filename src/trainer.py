@@ -1,6 +1,9 @@
+import math
 import os
 import socket
+import time
 import uuid
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
@@ -12,15 +15,38 @@ from sklearn.model_selection import StratifiedKFold
 from torch import nn
 from torch.optim import Adam, Optimizer
 from torch_geometric.data import InMemoryDataset
-from torch_geometric.loader import DataLoader
 
-from src.data import MoleculeNetDataset, PolarisDataset
-from src.models import TrainerModel, create_proj_model, create_repr_model
+from src.cache import DEFAULT_CACHE_DIR
+from src.data import MoleculeNetDataset, PolarisDataset, ShardedPolarisDataset
+from src.loader import DataLoader, PackedDataset
+from src.models import TrainerModel, create_proj_model, create_repr_model, save_model
+from src.shards import DEFAULT_SHUFFLE_BUFFER, ShardedDataset
+from src.transform import DEFAULT_JT_MAX_COARSITY
 from src.utils import PerformanceTracker, save_dict_to_csv, scaffold_split
 
+_fold_trainer = None
+_fold_scaffold = None
+
+
+def _init_fold_worker(params: dict, train_scaffold, num_threads: int) -> None:
+    global _fold_trainer, _fold_scaffold
+    # Intra-op threads of this fold, a share of the CPUs left to the concurrent folds
+    torch.set_num_threads(num_threads)
+    _fold_trainer = Trainer(params, init_dataset=False)
+    _fold_scaffold = train_scaffold
+
+
+def _train_fold(train_idx, valid_idx) -> PerformanceTracker:
+    return _fold_trainer.train_fold(_fold_scaffold, train_idx, valid_idx)
+
+
+def _snapshot(model: nn.Module) -> dict:
+    # Copy of the weights and buffers of `model`, to be restored with `load_state_dict`
+    return {key: value.detach().clone() for key, value in model.state_dict().items()}
+
 
 class Trainer:
-    def __init__(self, params: dict):
+    def __init__(self, params: dict, init_dataset: bool = True):
         self.params: dict = params
         self.performance_tracker = PerformanceTracker()
         self.train_dataset: InMemoryDataset
@@ -30,49 +56,66 @@ class Trainer:
         self.loss_fn: nn.L1Loss = nn.L1Loss()
         self.optimizer: Optimizer
         self.model: nn.Module
+        self.checkpoints: dict[int, dict] = {}  # Weights of the final model per epoch grid value
+        self._compiled_model: nn.Module | None = None
 
-        self._init()
+        self._init(init_dataset)
 
-    def _init(self):
-        self._init_dataset()
+    def _init(self, init_dataset: bool = True):
+        if init_dataset:
+            self._init_dataset()
         self._init_model()
         self._init_optimizer()
 
     def run(self):
-        smiles = self.train_scaffold.smiles
         labels = self.train_scaffold.y.view(-1).tolist()
 
         y_binned = pd.qcut(labels, q=self.params["num_cv_bins"], labels=False)
         skf = StratifiedKFold(n_splits=self.params["num_cv_folds"], shuffle=True, random_state=42)
 
-        val_loss_list = []
-
-        for train_idx, valid_idx in skf.split(smiles, y_binned):
-            self._init_model()
-            self._init_optimizer()
-            self.performance_tracker.reset()
-
-            train_fold = self.train_scaffold[train_idx]
-            valid_fold = self.train_scaffold[valid_idx]
-
-            train_fold_dataloader = DataLoader(
-                train_fold, batch_size=self.params["batch_size"], shuffle=True
-            )
-            valid_fold_dataloader = DataLoader(
-                valid_fold, batch_size=self.params["batch_size"], shuffle=False
-            )
-
-            self.train(train_fold_dataloader, valid_fold_dataloader)
-            val_loss_list.append(self.performance_tracker.valid_loss[-1])
+        # Folds and the final training run batch by index from a packed scaffold, or stream from
+        # the shards of a sharded one
+        train_scaffold = self.train_scaffold
+        if not isinstance(train_scaffold, (PackedDataset, ShardedDataset)):
+            train_scaffold = PackedDataset(train_scaffold)
+
+        # Folds only depend on the binned labels, the samples are not read
+        folds = list(skf.split(np.zeros(len(labels)), y_binned))
+        grid = self._epoch_grid()
+        if grid and self.params.get("patience"):
+            raise ValueError("An epoch grid cannot be combined with early stopping")
+        if grid:
+            self.params.update({"epochs": grid[-1]})
+
+        cv_workers = min(self.params.get("cv_workers", 1) or len(folds), len(folds))
+        if cv_workers > 1:
+            trackers = self._run_folds_parallel(train_scaffold, folds, cv_workers)
+        else:
+            trackers = [
+                self.train_fold(train_scaffold, train_idx, valid_idx)
+                for train_idx, valid_idx in folds
+            ]
+        if grid:
+            self._run_epoch_grid(train_scaffold, trackers, grid)
+            return
+
+        fold_results = [self._fold_result(tracker) for tracker in trackers]
+        val_loss_list = [valid_loss for valid_loss, _ in fold_results]
 
         self.params.update({"mean_val_loss": np.mean(val_loss_list)})
         self.params.update({"std_val_loss": np.std(val_loss_list)})
 
+        # With early stopping, the final model trains as long as the folds did on average
+        final_epochs = None
+        if self.params.get("patience"):
+            final_epochs = round(np.mean([epochs for _, epochs in fold_results]))
+            self.params.update({"final_epochs": final_epochs})
+
         # Reset model and train on train scaffold. Evaluate on test scaffold. Report MAE.
         self._init_model()
         self._init_optimizer()
 
-        self.train_final(self.train_scaffold)
+        self.train_final(train_scaffold, epochs=final_epochs)
         preds = self.predict(self.test_scaffold)
         preds = [pred[1] for pred in preds]
         mae = mean_absolute_error(preds, self.test_scaffold.y)
@@ -82,51 +125,238 @@ class Trainer:
         print(f"Average validation loss: {np.mean(val_loss_list)}")
         print(f"Mean absolute error for {self.params['target_task']} on test_scaffold: {mae:.3f}")
 
+        self._save_results([self.params])
+        self._save_model()
+
+    def _epoch_grid(self) -> list[int]:
+        grid = self.params.get("epoch_grid") or []
+        if isinstance(grid, str):
+            grid = [int(epochs) for epochs in grid.split(",")]
+        return sorted(set(grid))
+
+    def _run_epoch_grid(self, train_scaffold, trackers, grid) -> None:
+        # One results row per epoch value of the grid, as if trained for that many epochs. Runs
+        # with fewer epochs are prefixes of the one with the most, so the folds are validated and
+        # the weights of the final model are kept after each of them
+        self._init_model()
+        self._init_optimizer()
+        self.checkpoints = self.train_final(train_scaffold, checkpoints=grid)
+
+        rows = []
+        for epochs in grid:
+            val_loss_list = [tracker.checkpoint_loss[epochs] for tracker in trackers]
+            self.model.load_state_dict(self.checkpoints[epochs])
+            preds = [pred[1] for pred in self.predict(self.test_scaffold)]
+            mae = mean_absolute_error(preds, self.test_scaffold.y)
+            row = {**self.params, "epochs": epochs}
+            row.update({"mean_val_loss": np.mean(val_loss_list)})
+            row.update({"std_val_loss": np.std(val_loss_list)})
+            row.update({"mae_test_scaffold": mae})
+            rows.append(row)
+
+            print(f"Epochs {epochs}")
+            print(f"Validation losses: {val_loss_list}")
+            print(f"Average validation loss: {np.mean(val_loss_list)}")
+            print(
+                f"Mean absolute error for {self.params['target_task']} on test_scaffold: {mae:.3f}"
+            )
+
+        self._save_results(rows)
+        self._save_model()  # Trained for the largest number of epochs of the grid
+
+    def _save_results(self, rows: list[dict]) -> None:
         uniq = f"{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex[:8]}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        save_dict_to_csv([self.params], Path(f"./results/run_{uniq}.csv"))
+        save_dict_to_csv(rows, Path(f"./results/run_{uniq}.csv"))
+
+    def _save_model(self) -> None:
+        # The final model, to be loaded for inference with `load_model`
+        if self.params.get("save_model"):
+            save_model(self.model, self.params, Path(self.params["save_model"]))
+
+    def train_fold(self, train_scaffold, train_idx, valid_idx) -> PerformanceTracker:
+        """
+        Train a new model on the molecules `train_idx` of `train_scaffold`, validated on the
+        molecules `valid_idx`, and return its performance tracker.
+        """
+        self._init_model()
+        self._init_optimizer()
+        self.performance_tracker = PerformanceTracker()
+
+        train_fold_dataloader = train_scaffold.loader(
+            train_idx, batch_size=self.params["batch_size"], shuffle=True
+        )
+        # Validation batches are the same in every epoch, hence assembled only once
+        valid_fold_batches = train_scaffold.batches(valid_idx, batch_size=self.params["batch_size"])
+
+        self.train(train_fold_dataloader, valid_fold_batches)
+        return self.performance_tracker
+
+    def _fold_result(self, tracker: PerformanceTracker) -> tuple[float, int]:
+        # Validation loss of a fold, see `train`, and the number of epochs its model was trained for
+        if self.params.get("patience"):
+            return min(tracker.valid_loss), tracker.best_epoch + 1
+        return tracker.valid_loss[-1], tracker.stop_epoch + 1
+
+    def _run_folds_parallel(self, train_scaffold, folds, cv_workers: int) -> list:
+        # Every fold starts from the seeded model of `_init_model` and draws its shuffles from the
+        # RNG stream that seed starts, so a fold's losses do not depend on the process or order it
+        # is trained in. The scaffold goes to each worker once: memory-mapped stores are mapped
+        # again, in-memory ones are moved to shared memory and passed as handles
+        threads = self.params.get("fold_threads", 0) or max(
+            torch.get_num_threads() // cv_workers, 1
+        )
+        train_scaffold.share_memory_()
+        with ProcessPoolExecutor(
+            max_workers=cv_workers,
+            mp_context=torch.multiprocessing.get_context("spawn"),
+            initializer=_init_fold_worker,
+            initargs=(self.params, train_scaffold, threads),
+        ) as executor:
+            return list(executor.map(_train_fold, *zip(*folds)))
 
     def train(self, train_dataloader, valid_dataloader) -> None:
-        for epoch in range(self.params["epochs"]):
-            self.performance_tracker.log({"epoch": epoch})
+        """
+        Train for `epochs` epochs, validating every `valid_every` epochs and after the last one.
+        With a `patience`, training stops early once that many validations in a row have not
+        improved on the best validation loss, and the weights of the best validation, kept in
+        memory, are restored. The performance tracker records the epoch of the best validation
+        and the last epoch trained, and the validation loss after each epoch of the epoch grid.
+        """
+        epochs = self.params["epochs"]
+        checkpoints = self._epoch_grid()
+        valid_every = self.params.get("valid_every", 1) or 1
+        patience = self.params.get("patience", 0)
+        tracker = self.performance_tracker
+        best_loss, best_state, waited = math.inf, None, 0
+
+        for epoch in range(epochs):
+            tracker.log({"epoch": epoch})
             self._train_loop(train_dataloader)
-            self._valid_loop(valid_dataloader)
+            if (
+                (epoch + 1) % valid_every != 0
+                and epoch + 1 < epochs
+                and epoch + 1 not in checkpoints
+            ):
+                continue
 
-    def train_final(self, train_dataset) -> None:
-        train_dataloader = DataLoader(
-            train_dataset, batch_size=self.params["batch_size"], shuffle=True
-        )
-        for _ in range(self.params["epochs"]):
+            self._valid_loop(valid_dataloader)
+            if epoch + 1 in checkpoints:
+                tracker.checkpoint_loss[epoch + 1] = tracker.valid_loss[-1]
+            if tracker.valid_loss[-1] < best_loss:
+                best_loss, waited = tracker.valid_loss[-1], 0
+                tracker.best_epoch = epoch
+                if patience:
+                    best_state = _snapshot(self.model)
+            else:
+                waited += 1
+                if patience and waited >= patience:
+                    break
+
+        tracker.stop_epoch = epoch
+        if best_state is not None:
+            self.model.load_state_dict(best_state)
+
+    def train_final(self, train_dataset, epochs: int | None = None, checkpoints=()) -> dict:
+        """
+        Train on all of `train_dataset` for `epochs` epochs (`epochs` of the parameters by
+        default) and return snapshots of the weights after each epoch of `checkpoints`.
+        """
+        if not isinstance(train_dataset, (PackedDataset, ShardedDataset)):
+            train_dataset = PackedDataset(train_dataset)
+        train_dataloader = train_dataset.loader(batch_size=self.params["batch_size"], shuffle=True)
+        snapshots = {}
+        for epoch in range(self.params["epochs"] if epochs is None else epochs):
             self._train_loop(train_dataloader)
+            if epoch + 1 in checkpoints:
+                snapshots[epoch + 1] = _snapshot(self.model)
+        return snapshots
 
     def _init_model(self):
         torch.manual_seed(seed=self.params.get("seed", 42))
         repr_model = create_repr_model(self.params)
         proj_model = create_proj_model(self.params)
-        self.model = TrainerModel(repr_model, proj_model)
+        model = TrainerModel(repr_model, proj_model)
+
+        # A compiled model is built and compiled once, then loaded with the initial weights of a
+        # newly built eager model for every fold and the final model, so all of them run the same
+        # compiled graphs and start from the same weights as in an eager run
+        if self.params.get("compile") and self._compiled_model is not None:
+            self._compiled_model.load_state_dict(model.state_dict())
+            self.model = self._compiled_model
+            return
+
+        self.model = model
+        if self.params.get("compile"):
+            # Node, edge and molecule counts vary between batches. Inductor's CPU kernels for a
+            # fixed number of threads store instead of accumulate where messages are summed into
+            # repeated indices (PyTorch 2.6), those for a dynamic number add atomically
+            self.model.compile(dynamic=True, options={"cpp.dynamic_threads": True})
+            self._compiled_model = self.model
 
     def _init_optimizer(self):
+        # The foreach implementation updates all parameters with a few multi-tensor kernels and
+        # matches the per-parameter one exactly. The fused one is faster still, but rounds
+        # differently
+        if self.params.get("fused_optimizer"):
+            implementation = {"fused": True}
+        else:
+            implementation = {"foreach": True}
         self.optimizer = Adam(
             self.model.parameters(),
             lr=self.params["lr"],
             weight_decay=self.params["weight_decay"],
+            **implementation,
         )
 
     def _init_polaris_dataset(self):
         root = Path("./data") / "polaris" / self.params["task"]
 
         log_transform = True if self.params["task"] == "admet" else False
-
-        self.train_dataset = PolarisDataset(
-            root=root,
-            task=self.params["task"],
-            target_task=self.params["target_task"],
-            train=True,
-            log_transform=log_transform,
-            force_reload=True,
-            use_erg=self.params["use_erg"],
-            use_jt=self.params["use_jt"],
-            jt_coarsity=self.params["jt_coarsity"],
-        )
+        # An empty cache directory disables the persistent featurization cache
+        cache_dir = self.params.get("cache_dir", DEFAULT_CACHE_DIR) or None
+
+        if self.params.get("shard_size"):
+            self.train_dataset = ShardedPolarisDataset(
+                root=root,
+                task=self.params["task"],
+                target_task=self.params["target_task"],
+                log_transform=log_transform,
+                use_erg=self.params["use_erg"],
+                use_jt=self.params["use_jt"],
+                jt_coarsity=self.params["jt_coarsity"],
+                num_workers=self.params.get("num_workers", 1),
+                jt_max_coarsity=self.params.get("jt_max_coarsity", DEFAULT_JT_MAX_COARSITY),
+                shard_size=self.params["shard_size"],
+                buffer_size=self.params.get("shuffle_buffer", DEFAULT_SHUFFLE_BUFFER),
+            )
+        elif self.params.get("packed_store", True):
+            self.train_dataset = PolarisDataset.packed(
+                root=root,
+                task=self.params["task"],
+                target_task=self.params["target_task"],
+                log_transform=log_transform,
+                use_erg=self.params["use_erg"],
+                use_jt=self.params["use_jt"],
+                jt_coarsity=self.params["jt_coarsity"],
+                cache_dir=cache_dir,
+                num_workers=self.params.get("num_workers", 1),
+                jt_max_coarsity=self.params.get("jt_max_coarsity", DEFAULT_JT_MAX_COARSITY),
+            )
+        else:
+            self.train_dataset = PolarisDataset(
+                root=root,
+                task=self.params["task"],
+                target_task=self.params["target_task"],
+                train=True,
+                log_transform=log_transform,
+                force_reload=True,
+                use_erg=self.params["use_erg"],
+                use_jt=self.params["use_jt"],
+                jt_coarsity=self.params["jt_coarsity"],
+                cache_dir=cache_dir,
+                num_workers=self.params.get("num_workers", 1),
+                jt_max_coarsity=self.params.get("jt_max_coarsity", DEFAULT_JT_MAX_COARSITY),
+            )
 
         self.test_dataset = PolarisDataset(
             root=root,
@@ -138,25 +368,42 @@ class Trainer:
             use_erg=self.params["use_erg"],
             use_jt=self.params["use_jt"],
             jt_coarsity=self.params["jt_coarsity"],
+            cache_dir=cache_dir,
+            num_workers=self.params.get("num_workers", 1),
+            jt_max_coarsity=self.params.get("jt_max_coarsity", DEFAULT_JT_MAX_COARSITY),
         )
 
         self.train_scaffold, self.test_scaffold = scaffold_split(
-            dataset=self.train_dataset, test_size=self.params["scaffold_split_val_sz"]
+            dataset=self.train_dataset,
+            test_size=self.params["scaffold_split_val_sz"],
+            cache_dir=cache_dir,
+            num_workers=self.params.get("num_workers", 1),
         )
 
     def _init_molecule_net_dataset(self):
         root = Path("./data") / "molecule_net"
-        molecule_net_dataset = MoleculeNetDataset(
+        cache_dir = self.params.get("cache_dir", DEFAULT_CACHE_DIR) or None
+        molecule_net = MoleculeNetDataset(
             root=root,
             target_task=self.params["target_task"],
             force_reload=False,
             use_erg=self.params["use_erg"],
             use_jt=self.params["use_jt"],
             jt_coarsity=self.params["jt_coarsity"],
-        ).create_dataset()
+            cache_dir=cache_dir,
+            num_workers=self.params.get("num_workers", 1),
+            jt_max_coarsity=self.params.get("jt_max_coarsity", DEFAULT_JT_MAX_COARSITY),
+        )
+        if self.params.get("packed_store", True):
+            molecule_net_dataset = molecule_net.create_packed_dataset()
+        else:
+            molecule_net_dataset = molecule_net.create_dataset()
 
         self.train_scaffold, self.test_scaffold = scaffold_split(
-            dataset=molecule_net_dataset, test_size=self.params["scaffold_split_val_sz"]
+            dataset=molecule_net_dataset,
+            test_size=self.params["scaffold_split_val_sz"],
+            cache_dir=cache_dir,
+            num_workers=self.params.get("num_workers", 1),
         )
 
     def _init_dataset(self):
@@ -172,30 +419,38 @@ class Trainer:
 
     def _train_loop(self, dataloader):
         self.model.train()
-        epoch_loss = 0
+        # Losses are summed on-tensor, in double precision like the Python floats they replace,
+        # and read once per epoch instead of synchronizing on every batch
+        epoch_loss = torch.zeros((), dtype=torch.float64)
+        num_molecules = 0
+        start = time.perf_counter()
 
         for data in dataloader:
             out = self.model(data)
             loss = self.loss_fn(out, data.y)
             loss.backward()
             self.optimizer.step()
-            self.optimizer.zero_grad()
-            epoch_loss += loss.item()
+            self.optimizer.zero_grad(set_to_none=True)
+            epoch_loss += loss.detach()
+            num_molecules += data.num_graphs
 
-        average_loss = epoch_loss / len(dataloader)
+        average_loss = epoch_loss.item() / len(dataloader)
+        elapsed = time.perf_counter() - start
         self.performance_tracker.log({"train_loss": average_loss})
+        self.performance_tracker.log({"steps_per_sec": len(dataloader) / elapsed})
+        self.performance_tracker.log({"molecules_per_sec": num_molecules / elapsed})
 
     def _valid_loop(self, dataloader):
         self.model.eval()
-        epoch_loss = 0
+        epoch_loss = torch.zeros((), dtype=torch.float64)
 
-        with torch.no_grad():
+        with torch.inference_mode():
             for data in dataloader:
                 out = self.model(data)
                 loss = self.loss_fn(out, data.y)
-                epoch_loss += loss.item()
+                epoch_loss += loss
 
-        average_loss = epoch_loss / len(dataloader)
+        average_loss = epoch_loss.item() / len(dataloader)
         self.performance_tracker.log({"valid_loss": average_loss})
 
     def predict(self, dataset) -> list[tuple]:
@@ -206,11 +461,16 @@ class Trainer:
         self.model.eval()
         smiles = dataset.smiles
 
-        dataloader = DataLoader(dataset, batch_size=len(dataset), shuffle=False)
+        # Sharded datasets are predicted batch by batch, as they need not fit into memory
+        if isinstance(dataset, ShardedDataset):
+            batches = dataset.batches(batch_size=self.params["batch_size"])
+        elif isinstance(dataset, PackedDataset):
+            batches = dataset.batches(batch_size=len(dataset))
+        else:
+            batches = DataLoader(dataset, batch_size=len(dataset), shuffle=False)
 
-        with torch.no_grad():
-            data = next(iter(dataloader))
-            pred = self.model(data)
+        with torch.inference_mode():
+            pred = torch.cat([self.model(data) for data in batches])
 
         pred = [p.item() for p in pred]
 
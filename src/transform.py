@@ -1,21 +1,130 @@
+import re
+
 import numpy as np
 import torch
 from rdkit import Chem
-from rdkit.Chem.rdchem import BondType
 from rdkit.Chem.rdReducedGraphs import GenerateMolExtendedReducedGraph
 from torch_geometric.data import Data
-from torch_geometric.utils import tree_decomposition
+from torch_geometric.utils import from_rdmol
 
-bonds = [bond for bond in BondType.__dict__.values() if isinstance(bond, BondType)]
+from src.chem import get_mol, mols_to_data_list
+from src.decomposition import get_tree_decomposition
 
+# Bump whenever a change to this module alters the featurized output of a molecule. It is part
+# of the key of the persistent featurization cache, so stale entries are never served.
+TRANSFORM_VERSION = 3
 
-class ReducedGraph(object):
-    def __init__(self, use_erg, use_jt, jt_coarsity):
+# Number of junction tree resolutions featurized by default. Any `jt_coarsity` up to it is served
+# from the same featurized molecules, see `ReducedGraphView`.
+DEFAULT_JT_MAX_COARSITY = 3
+
+
+class MoleculeFeaturizer(object):
+    """
+    Turns a SMILES string into the graph consumed by the models: a HIMP junction tree if neither
+    reduced graph abstraction is requested, and the extended reduced graphs otherwise.
+    """
+
+    def __init__(
+        self, use_erg=False, use_jt=False, jt_coarsity=0, jt_max_coarsity=DEFAULT_JT_MAX_COARSITY
+    ):
         self.use_erg = use_erg
         self.use_jt = use_jt
         self.jt_coarsity = jt_coarsity
+        self.jt_max_coarsity = max(jt_coarsity, jt_max_coarsity) if use_jt else 0
+        self.use_himp_preprocessing = not (use_jt or use_erg)
+        self.junction_tree = JunctionTree()
+        self.reduced_graph = ReducedGraph(
+            use_erg=use_erg, use_jt=use_jt, jt_max_coarsity=self.jt_max_coarsity
+        )
+        # Featurized molecules hold the full junction tree pyramid, which is cut down to
+        # `jt_coarsity` levels whenever a molecule is accessed
+        self.view = (
+            None
+            if self.use_himp_preprocessing
+            else ReducedGraphView(
+                use_erg=use_erg,
+                use_jt=use_jt,
+                jt_coarsity=jt_coarsity,
+                jt_max_coarsity=self.jt_max_coarsity,
+            )
+        )
+
+    @property
+    def config(self) -> dict:
+        """
+        Every setting that influences the output, used to key the featurization cache. The
+        `jt_coarsity` is not part of it, as it only selects a view of the featurized molecules.
+        """
+        if self.use_himp_preprocessing:
+            return {"transform": "JunctionTree", "version": TRANSFORM_VERSION}
+        return {
+            "transform": "ReducedGraph",
+            "use_erg": bool(self.use_erg),
+            "use_jt": bool(self.use_jt),
+            "jt_max_coarsity": int(self.jt_max_coarsity),
+            "version": TRANSFORM_VERSION,
+        }
+
+    def transform(self, data, mol=None):
+        """
+        Add the junction tree or reduced graphs to the molecular graph `data`. `mol` is the parsed
+        molecule, looked up by `data.smiles` if not given.
+        """
+        if self.use_himp_preprocessing:
+            # HIMP Graph
+            return self.junction_tree(data, mol)
+        # Extended IMP Graphs
+        return self.reduced_graph(data, mol)
+
+    def __call__(self, smiles):
+        """
+        Featurize a SMILES string, parsing it only once for all stages. Returns None if it does not
+        yield any atom.
+        """
+        mol = get_mol(smiles)
+        if mol is None or mol.GetNumAtoms() == 0:
+            return None
+        data = from_rdmol(mol)
+        data.smiles = smiles
+        return self.transform(data, mol)
+
+    def featurize_many(self, smiles_list: list[str]) -> list:
+        """
+        Featurize a list of SMILES strings like `__call__`, building their molecular graphs in
+        bulk with `mols_to_data_list`.
+        """
+        mols = [get_mol(smiles) for smiles in smiles_list]
+        valid = [i for i, mol in enumerate(mols) if mol is not None and mol.GetNumAtoms() > 0]
+        out = [None] * len(smiles_list)
+        for i, data in zip(valid, mols_to_data_list([mols[i] for i in valid])):
+            data.smiles = smiles_list[i]
+            out[i] = self.transform(data, mols[i])
+        return out
+
+
+class ReducedGraph(object):
+    """
+    Adds the reduced graphs to a molecular graph: the junction tree at `jt_max_coarsity`
+    resolutions and/or the ErG.
+
+    The junction tree pyramid is stored compactly. Level 0 is stored in full, every coarser level
+    `i` by its edges, node features and `rg_parent_i`, the cluster of level `i` each cluster of
+    level `i - 1` is merged into. Its atom to cluster mapping follows from the mapping of level
+    `i - 1` and is only derived once molecules are batched, see `ReducedGraphCollater`. Levels
+    identical to their predecessor are stored empty; `rg_depth` holds the number of distinct
+    levels. The ErG is stored at index `jt_max_coarsity`.
+    """
+
+    def __init__(self, use_erg, use_jt, jt_max_coarsity):
+        self.use_erg = use_erg
+        self.use_jt = use_jt
+        self.jt_max_coarsity = jt_max_coarsity
+
+    def __call__(self, data, mol=None):
+        if mol is None:
+            mol = get_mol(data.smiles)
 
-    def __call__(self, data):
         offset = 0
         data = ReducedGraphData(**{k: v for k, v in data})
         data.node_feat = (
@@ -23,21 +132,31 @@ class ReducedGraph(object):
         )  # Compatibility w/ EHimp TODO change EHIMP to adherence to naming convention
         data.edge_feat = data.edge_attr  # Compatibility EHimp
 
-        if self.use_jt:
-            mol = Chem.MolFromSmiles(data.smiles)
-            out = tree_decomposition(mol, return_vocab=True)
+        if self.use_jt and self.jt_max_coarsity > 0:
+            out = get_tree_decomposition(data.smiles, mol)
             data.rg_edge_index_0, data.mapping_0, data.rg_num_atoms_0, data.rg_atom_features_0 = (
                 out  # TODO base case should also be encapsulated by addFeatureTreeWithLowerResolution
             )
             data.raw_num_atoms_0 = data.x.size(0)
-            for i in range(1, self.jt_coarsity):
-                data = add_feature_tree_with_lower_res(
-                    data, i
-                )  # The i here is just for naming the attributes
-            offset = self.jt_coarsity
+            levels = junction_tree_pyramid(*out, num_levels=self.jt_max_coarsity - 1)
+            empty_level = (
+                torch.empty(0, dtype=torch.long),
+                torch.empty((2, 0), dtype=torch.long),
+                0,
+                torch.empty(0, dtype=torch.long),
+            )
+            for i in range(1, self.jt_max_coarsity):
+                # Levels identical to their predecessor are stored empty
+                level = levels[i - 1] if i <= len(levels) else empty_level
+                rg_parent, rg_edge_index, rg_num_atoms, rg_atom_features = level
+                setattr(data, f"rg_parent_{i}", rg_parent)
+                setattr(data, f"rg_edge_index_{i}", rg_edge_index)
+                setattr(data, f"rg_num_atoms_{i}", rg_num_atoms)
+                setattr(data, f"rg_atom_features_{i}", rg_atom_features)
+            data.rg_depth = len(levels) + 1
+            offset = self.jt_max_coarsity
         if self.use_erg:
             # Generate ErG fingerprint
-            mol = Chem.MolFromSmiles(data.smiles)
             erg = get_erg_data(
                 mol, data.x.size(0)
             )  # TODO standardize so it adds graphs just as addFeatureTreeWithLowerResolution
@@ -50,6 +169,61 @@ class ReducedGraph(object):
         return data
 
 
+_LEVEL_KEY = re.compile(
+    r"(rg_edge_index|mapping|rg_num_atoms|rg_atom_features|raw_num_atoms|rg_parent)_(\d+)"
+)
+
+
+class ReducedGraphView(object):
+    """
+    Transform serving the reduced graphs stored by `ReducedGraph` with `jt_max_coarsity` junction
+    tree levels at any `jt_coarsity <= jt_max_coarsity`: the first `jt_coarsity` levels are kept,
+    deduplicated levels are filled in from their predecessor and the ErG is moved to index
+    `jt_coarsity`. Only tensors are selected, nothing is recomputed. The mappings of the levels
+    above 0 are derived when batching by `ReducedGraphCollater`.
+    """
+
+    def __init__(self, use_erg, use_jt, jt_coarsity, jt_max_coarsity):
+        if use_jt and jt_coarsity > jt_max_coarsity:
+            raise ValueError(
+                f"jt_coarsity {jt_coarsity} exceeds the featurized "
+                f"jt_max_coarsity {jt_max_coarsity}"
+            )
+        self.use_erg = use_erg
+        self.jt_coarsity = jt_coarsity if use_jt else 0
+        self.jt_max_coarsity = jt_max_coarsity if use_jt else 0
+
+    def __call__(self, data):
+        view = ReducedGraphData()
+        levels = {}
+        for key, value in data:
+            match = _LEVEL_KEY.fullmatch(key)
+            if match is not None:
+                levels[match[1], int(match[2])] = value
+            elif key != "rg_depth":
+                view[key] = value
+
+        depth = int(data.rg_depth) if self.jt_coarsity > 0 else 0
+        for i in range(self.jt_coarsity):
+            level = min(i, depth - 1)
+            view[f"rg_edge_index_{i}"] = levels["rg_edge_index", level]
+            view[f"rg_num_atoms_{i}"] = levels["rg_num_atoms", level]
+            view[f"rg_atom_features_{i}"] = levels["rg_atom_features", level]
+            view[f"raw_num_atoms_{i}"] = levels["raw_num_atoms", 0]
+            if i == 0:
+                view.mapping_0 = levels["mapping", 0]
+            elif i < depth:
+                view[f"rg_parent_{i}"] = levels["rg_parent", i]
+            else:
+                view[f"rg_parent_{i}"] = torch.arange(int(levels["rg_num_atoms", level]))
+
+        if self.use_erg:
+            for name in ("rg_edge_index", "mapping", "rg_num_atoms", "rg_atom_features"):
+                view[f"{name}_{self.jt_coarsity}"] = levels[name, self.jt_max_coarsity]
+            view[f"raw_num_atoms_{self.jt_coarsity}"] = view.x.size(0)
+        return view
+
+
 class ReducedGraphData(Data):
     """
     Custom data class for storing information related to the Reduced Graph.
@@ -63,6 +237,7 @@ class ReducedGraphData(Data):
     Methods:
         - __cat_dim__(self, key, value, *args, **kwargs): Custom implementation for concatenation dimension.
         - __inc__(self, key, value, *args, **kwargs): Custom implementation for incremental value.
+        - increment_sources(self, key): Attributes the increments of `__inc__` are taken from.
 
     """
 
@@ -74,23 +249,51 @@ class ReducedGraphData(Data):
             return 0
 
     def __inc__(self, key, value, *args, **kwargs):
+        sources = self.increment_sources(key)
+        if sources is None:
+            return super().__inc__(key, value, *args, **kwargs)
+        return resolve_increment(self, sources)
+
+    def increment_sources(self, key):
+        """
+        Per row of `key`, the attribute holding its increment when batching, as pairs of
+        (INC_VALUE, name) or (INC_SIZE, name). None if `Data.__inc__` applies.
+        """
         idx = key.split("_")[-1]
         if key == "edge_index":
-            return getattr(
-                self, f"raw_num_atoms_0"
-            )  # self.raw_num_atoms, always the same of teh original graph
-        elif "rg_edge_index" in key:
-            return getattr(self, f"rg_num_atoms_{idx}")
+            # self.raw_num_atoms, always the same of teh original graph
+            return ((INC_VALUE, "raw_num_atoms_0"),)
+        elif "rg_edge_index" in key or "rg_parent" in key:
+            return ((INC_VALUE, f"rg_num_atoms_{idx}"),)
         elif "mapping" in key:
-            # return torch.tensor([[torch.sum(getattr(self, f'raw_num_atoms_{idx}'))], [getattr(self, f'rg_num_atoms_{idx}')]])
-            x = torch.tensor(getattr(self, f"raw_num_atoms_{idx}"))
-            y = torch.tensor(getattr(self, f"rg_num_atoms_{idx}"))
-            return torch.tensor([[torch.sum(x)], [y]])
-        else:
-            return super().__inc__(key, value, *args, **kwargs)
+            return ((INC_VALUE, f"raw_num_atoms_{idx}"), (INC_VALUE, f"rg_num_atoms_{idx}"))
+        return None
+
+
+# Kinds of increment sources: the value of an integer attribute, or the size of a tensor attribute
+INC_VALUE = "value"
+INC_SIZE = "size"
+
+
+def resolve_increment(data, sources):
+    """
+    Increment of an attribute of `data` with the given `increment_sources`: an integer for a
+    single source, a [num_sources, 1] tensor otherwise.
+    """
+    incs = [
+        getattr(data, name) if kind == INC_VALUE else getattr(data, name).size(0)
+        for kind, name in sources
+    ]
+    if len(incs) == 1:
+        return incs[0]
+    return torch.tensor([[int(inc)] for inc in incs])
 
 
 def add_feature_tree_with_lower_res(tree, resolution=1):
+    """
+    Reference implementation of one junction tree coarsening step, merging every leaf into its
+    parent one at a time. Used for the rare trees `coarsen_junction_tree` does not vectorize.
+    """
     rg_edge_index = getattr(tree, f"rg_edge_index_{resolution - 1}")
     rg_num_atoms = getattr(tree, f"rg_num_atoms_{resolution - 1}")
     raw_num_atoms = getattr(tree, f"raw_num_atoms_{resolution - 1}")
@@ -176,233 +379,326 @@ def add_feature_tree_with_lower_res(tree, resolution=1):
     return reduced_tree
 
 
-def molecule_atoms_props(molecule):
+def coarsen_junction_tree(rg_edge_index, mapping, rg_num_atoms, rg_atom_features, num_levels):
     """
-    Extracts atom properties from a given RDKit Mol object using SMARTS patterns.
+    Compute `num_levels` successively coarser versions of a junction tree by repeatedly merging
+    its leaves into their parents. Produces exactly the levels of repeated calls to
+    `add_feature_tree_with_lower_res`, but per level only with vectorized tensor operations:
+        - node relabeling through a prefix sum over the removed leaves,
+        - the atom to cluster mapping through a leaf -> parent lookup table,
+        - parent features through a scatter-min over their leaves,
+    and without copying the data object.
 
     Parameters:
-        - molecule (Chem.rdchem.Mol): RDKit Mol object representing a molecule.
+        - rg_edge_index (Tensor): Edges of the junction tree, sorted by source node.
+        - mapping (Tensor): Pairs of (atom, cluster) of the junction tree, shape [2, *].
+        - rg_num_atoms (int): Number of clusters in the junction tree.
+        - rg_atom_features (Tensor): Clique type of every cluster.
+        - num_levels (int): Number of coarser levels to compute.
 
     Returns:
-        - properties (numpy.ndarray): Array containing tuples representing atom properties.
-          Each tuple indicates the atom indices that match specific chemical patterns.
-          The order of patterns corresponds to the following:
-          0: Donor atoms
-          1: Acceptor atoms
-          2: Positively charged atoms
-          3: Negatively charged atoms
-          4: Hydrophobic atoms
+        - levels (list): One tuple (rg_edge_index, mapping, rg_num_atoms, rg_atom_features) per
+          coarser level.
     """
+    levels = []
+    for _ in range(num_levels):
+        level = _coarsen_junction_tree_level(rg_edge_index, mapping, rg_num_atoms, rg_atom_features)
+        rg_edge_index, mapping, rg_num_atoms, rg_atom_features, _ = level
+        levels.append((rg_edge_index, mapping, rg_num_atoms, rg_atom_features))
+    return levels
 
-    # Define SMARTS patterns for different atom properties
-    donor_pattern = Chem.MolFromSmarts(r"[$([N;!H0;v3,v4&+1]),$([O,S;H1;+0]),n&H1&+0]")
-    acceptor_pattern = Chem.MolFromSmarts(
-        r"[$([O,S;H1;v2;!$(*-*=[O,N,P,S])]),$([O;H0;v2]),$([O,S;v1;-]),$([N;v3;!$(N-*=[O,N,P,S])]),n&H0&+0,$([o;+0;!$([o]:n);!$([o]:c:n)])]"
-    )
-    positive_pattern = Chem.MolFromSmarts(
-        r"[#7;+,$([N;H2&+0][$([C,a]);!$([C,a](=O))]),$([N;H1&+0]([$([C,a]);!$([C,a](=O))])[$([C,a]);!$([C,a](=O))]),$([N;H0&+0]([C;!$(C(=O))])([C;!$(C(=O))])[C;!$(C(=O))])]"
-    )
-    negative_pattern = Chem.MolFromSmarts(r"[$([C,S](=[O,S,P])-[O;H1,-1])]")
-    hydrophobic_pattern = Chem.MolFromSmarts(r"[$([C;D3,D4](-[CH3])-[CH3]),$([S;D2](-C)-C)]")
-
-    # Array to store atom properties
-    properties = np.empty(5, dtype=tuple)
-
-    # List of SMARTS patterns
-    atom_property_patterns = [
-        donor_pattern,
-        acceptor_pattern,
-        positive_pattern,
-        negative_pattern,
-        hydrophobic_pattern,
-    ]
-
-    # Check if the atom matches any of the specified patterns
-    for i, pattern in enumerate(atom_property_patterns):
-        properties[i] = molecule.GetSubstructMatches(pattern)
-
-    return properties
 
-
-def find_recognized_rings(mol):
+def junction_tree_pyramid(rg_edge_index, mapping, rg_num_atoms, rg_atom_features, num_levels):
     """
-    Finds rings in a molecule with a ring size less than 8.
-
-    Parameters:
-        - mol (Chem.rdchem.Mol): RDKit Mol object representing a molecule.
+    Compute up to `num_levels` successively coarser versions of a junction tree like
+    `coarsen_junction_tree`, but encode each level by a parent pointer array instead of its atom
+    to cluster mapping, and stop as soon as a level is identical to its predecessor (all further
+    levels would be identical as well). The mapping of level `i` consists of the unique pairs
+    `(atom, rg_parent[cluster])` over the pairs `(atom, cluster)` of level `i - 1`.
 
     Returns:
-        - recognized_rings (list): List of atom indices representing rings in the molecule.
-          Only rings with a size (number of atoms) less than 8 are included in the result.
+        - levels (list): One tuple (rg_parent, rg_edge_index, rg_num_atoms, rg_atom_features) per
+          distinct coarser level.
     """
-    recognized_rings = [ring for ring in mol.GetRingInfo().AtomRings() if len(ring) < 8]
-    return recognized_rings
-
-
-def construct_erg_from_fp(erg_fp):
-    """
-    Construct an ErG (Extended Graph) from a given fingerprint.
-
-    Parameters:
-        - erg_fp (Chem.AllChem.GetErGFingerprint): ErG fingerprint obtained using RDKit.
-
-    Returns:
-        - atom_features (numpy.ndarray): Array of atom features:
-            - 0: No feature
-            - [1, 2, 3, 4, 5, 6]: Specific feature
-            - 7: Newly introduced node
-        - erg_edge_index (numpy.ndarray): Array of edges of ErG.
-        - num_of_rings (int): Number of rings in the ErG.
-    """
-
-    # Array of atom features
-    # 0: No feature, [1, 2, 3, 4, 5, 6]: Specific feature, 7: Newly introduced node
-    atom_features = np.zeros(erg_fp.GetNumAtoms(), dtype=int)
-
-    # Array of edges of ErG
-    erg_edge_index = np.empty((2, 2 * erg_fp.GetNumBonds()), dtype=int)
-
-    num_of_rings = 0
-    edge_count = 0
-
-    for i, atom in enumerate(erg_fp.GetAtoms()):
-        # Assign features to atoms and edges and construct a graph
-        if atom.GetSymbol() == "*":
-            num_of_rings += 1
-
-        for prop in atom.GetProp("_ErGAtomTypes"):
-            if prop in ["0", "1", "2", "4", "5", "3"]:
-                atom_features[i] = int(prop) + 1
-
-        for bond in atom.GetBonds():
-            # Construct edges of a graph
-            erg_edge_index[0, edge_count] = i
-            if i == bond.GetBeginAtomIdx():
-                erg_edge_index[1, edge_count] = bond.GetEndAtomIdx()
-            else:
-                erg_edge_index[1, edge_count] = bond.GetBeginAtomIdx()
-
-            edge_count += 1  # Each edge is counted twice
-
-    return atom_features, erg_edge_index, num_of_rings
-
-
-def create_erg_ring_mapping(molecule, erg_num_atoms, num_of_rings):
-    """
-    Create ring mapping from the original graph to ErG.
+    levels = []
+    for _ in range(num_levels):
+        new_rg_edge_index, mapping, new_rg_num_atoms, new_rg_atom_features, rg_parent = (
+            _coarsen_junction_tree_level(rg_edge_index, mapping, rg_num_atoms, rg_atom_features)
+        )
+        if (
+            new_rg_num_atoms == rg_num_atoms
+            and torch.equal(rg_parent, torch.arange(int(rg_num_atoms)))
+            and torch.equal(new_rg_edge_index, rg_edge_index)
+            and torch.equal(new_rg_atom_features, rg_atom_features)
+        ):
+            break
+        rg_edge_index, rg_num_atoms, rg_atom_features = (
+            new_rg_edge_index,
+            new_rg_num_atoms,
+            new_rg_atom_features,
+        )
+        levels.append((rg_parent, rg_edge_index, rg_num_atoms, rg_atom_features))
+    return levels
+
+
+def _coarsen_junction_tree_level(rg_edge_index, mapping, rg_num_atoms, rg_atom_features):
+    unique_values, counts = torch.unique(rg_edge_index[0], return_counts=True)
 
-    Parameters:
-        - molecule (Chem.rdchem.Mol): RDKit Mol object representing a molecule.
-        - erg_num_atoms (int): Number of atoms of ErG
-        - num_of_rings (int): Number of rings in the molecule.
+    leaf_idxs = unique_values[counts == 1]  # Leaf nodes
+    non_leaf_idxs = unique_values[counts > 1]  # Inner nodes
+    if rg_edge_index.shape[1] == 2:  # in case of one edge, the second node is kept
+        leaf_idxs = leaf_idxs[1:]
+        non_leaf_idxs = leaf_idxs[:1]
 
-    Returns:
-        - rings_map (numpy.ndarray): Array with two rows representing the mapping of nodes of the original graph to rings in ErG.
-          The first row contains indices of atoms from the original graph mapped to a ring atoms of ErG.
-          The second row contains indices of the corresponding ring nodes in the resulting ErG.
-    """
-    recognized_rings = find_recognized_rings(molecule)
+    new_rg_num_atoms = rg_num_atoms - len(leaf_idxs)
+    if new_rg_num_atoms < 1:  # Prevents graphs with 0 nodes
+        return (
+            torch.clone(rg_edge_index),
+            torch.clone(mapping),
+            rg_num_atoms,
+            torch.clone(rg_atom_features),
+            torch.arange(int(rg_num_atoms)),
+        )
+
+    parents = rg_edge_index[1, torch.isin(rg_edge_index[0], leaf_idxs)]  # Parents of leaves
+
+    # Leaves are merged one after the other. That is order dependent only if a parent is a leaf
+    # itself, which happens for forests with a single-edge component next to larger ones. Such
+    # trees, and the levels derived from them, are left to the sequential implementation.
+    if torch.isin(parents, leaf_idxs).any() or (mapping.numel() > 0 and mapping.min() < 0):
+        tree = ReducedGraphData(
+            rg_edge_index_0=rg_edge_index,
+            mapping_0=mapping,
+            rg_num_atoms_0=rg_num_atoms,
+            rg_atom_features_0=rg_atom_features,
+            raw_num_atoms_0=0,
+        )
+        # The parent pointers are the mapping of every cluster onto itself after coarsening
+        nodes = torch.arange(int(rg_num_atoms))
+        identity = tree.clone()
+        identity.mapping_0 = torch.stack((nodes, nodes))
+        rg_parent = add_feature_tree_with_lower_res(identity, 1).mapping_1[1]
+
+        tree = add_feature_tree_with_lower_res(tree, 1)
+        return (
+            tree.rg_edge_index_1,
+            tree.mapping_1,
+            tree.rg_num_atoms_1,
+            tree.rg_atom_features_1,
+            rg_parent,
+        )
+
+    num_nodes = int(rg_num_atoms)
+
+    # Gap between the index of a node in the original and the new tree
+    is_leaf = torch.zeros(num_nodes, dtype=torch.int64)
+    is_leaf[leaf_idxs] = 1
+    idx_reduction = torch.cumsum(is_leaf, dim=0)
+
+    # Edges that are not connecting leaf nodes
+    non_leaf_edges = torch.logical_and(
+        torch.isin(rg_edge_index[0], non_leaf_idxs), torch.isin(rg_edge_index[1], non_leaf_idxs)
+    )
+    new_rg_edge_index = rg_edge_index[:, non_leaf_edges]
+    new_rg_edge_index = new_rg_edge_index - idx_reduction[new_rg_edge_index]
+
+    # Map atoms that are mapped to a leaf to its parent and delete multiple occurrences. The
+    # pairs are unique'd through a scalar key to keep their lexicographic order.
+    cluster = torch.arange(num_nodes)
+    cluster[leaf_idxs] = parents
+    key = torch.unique(mapping[0] * num_nodes + cluster[mapping[1]])
+    new_mapping = torch.stack((key // num_nodes, key % num_nodes))
+    new_mapping[1] -= idx_reduction[new_mapping[1]]
+
+    # A parent takes the smallest feature of itself and its leaves
+    new_rg_atom_features = rg_atom_features.scatter_reduce(
+        0, parents, rg_atom_features[leaf_idxs], reduce="amin", include_self=True
+    )
+    unconnected = torch.ones(num_nodes, dtype=torch.bool)
+    unconnected[unique_values] = False
+    kept = torch.cat((non_leaf_idxs, unconnected.nonzero().view(-1)))
+    new_rg_atom_features = new_rg_atom_features[kept]
 
-    cumulative_ring_sizes = np.append(0, np.cumsum(list(map(len, recognized_rings))))
+    rg_parent = cluster - idx_reduction[cluster]
 
-    rings_map = np.empty((2, int(cumulative_ring_sizes[-1])), dtype=int)
-    rings_map_idx = 0
+    return new_rg_edge_index, new_mapping, new_rg_num_atoms, new_rg_atom_features, rg_parent
 
-    for i, ring in enumerate(recognized_rings):
-        idcs = np.arange(cumulative_ring_sizes[i], cumulative_ring_sizes[i + 1])
-        rings_map[0, idcs] = ring
 
-        # Nodes of ErG representing rings are inserted at the end of the list of nodes
-        rings_map[1, idcs] = erg_num_atoms - num_of_rings + i
+# SMARTS patterns of the atom properties considered by ErG, in this order:
+# donor, acceptor, positively charged, negatively charged and hydrophobic atoms
+ERG_PROPERTY_SMARTS = (
+    r"[$([N;!H0;v3,v4&+1]),$([O,S;H1;+0]),n&H1&+0]",
+    r"[$([O,S;H1;v2;!$(*-*=[O,N,P,S])]),$([O;H0;v2]),$([O,S;v1;-]),$([N;v3;!$(N-*=[O,N,P,S])]),n&H0&+0,$([o;+0;!$([o]:n);!$([o]:c:n)])]",
+    r"[#7;+,$([N;H2&+0][$([C,a]);!$([C,a](=O))]),$([N;H1&+0]([$([C,a]);!$([C,a](=O))])[$([C,a]);!$([C,a](=O))]),$([N;H0&+0]([C;!$(C(=O))])([C;!$(C(=O))])[C;!$(C(=O))])]",
+    r"[$([C,S](=[O,S,P])-[O;H1,-1])]",
+    r"[$([C;D3,D4](-[CH3])-[CH3]),$([S;D2](-C)-C)]",
+)
 
-    return rings_map
+# Rings with at least this many atoms are not abstracted to a single ErG node
+ERG_MAX_RING_SIZE = 8
 
 
-def create_erg_mapping(molecule, num_of_rings, erg_num_atoms, atoms_with_properties_flattened):
+class ErGFeaturizer(object):
     """
-    Create a mapping for the Extended Graph (ErG) from a given molecule.
-
-    Parameters:
-        - molecule (Chem.rdchem.Mol): RDKit Mol object representing a molecule.
-        - num_of_rings (int): Number of rings in the molecule.
-        - erg_num_atoms (int): Number of atoms in the resulting ErG.
-        - atoms_with_properties_flattened (list): List of atom indices with specific properties.
-
-    Returns:
-        - erg_mapping (numpy.ndarray): Array representing the mapping of atoms to ErG.
-            - The first row contains indices of atoms from the original graph mapped to ErG atoms.
-            - The second row contains indices of the corresponding ErG atoms.
-        - unmapped (bool): Flag denoting if some atoms of raw graph are not mapped to any ErG node
+    Builds the Extended Reduced Graph (ErG) of molecules: its edges, node features and the
+    mapping of the atoms of the raw graph onto the ErG nodes.
+
+    ErG nodes are numbered like in RDKit's `GenerateMolExtendedReducedGraph`: atoms kept from the
+    molecule come first, followed by one node per ring with less than ERG_MAX_RING_SIZE atoms.
+    Atoms that are part of larger rings only and carry no property are mapped to an additional,
+    artificial node at the end. Node features are:
+        - 0: No feature
+        - [1, 2, 3, 4, 5, 6]: Specific feature
+        - 7: Artificial node
+
+    The SMARTS patterns are compiled once per featurizer and the mapping is assembled from NumPy
+    masks over all atoms, so that the per-molecule cost is dominated by RDKit.
     """
 
-    # Create a mapping for atoms that are part of recognized rings
-    rings_map = create_erg_ring_mapping(molecule, erg_num_atoms, num_of_rings)
-
-    # Mapping for atoms with specific properties
-    prop_map = np.empty((2, molecule.GetNumAtoms()), dtype=int)
-    prop_map_idx = 0
-
-    # Mapping for unmapped atoms that are part of rings of length >= 8 and don't have specific properties
-    unmapped = False
-    unmapped_map = np.empty((2, molecule.GetNumAtoms()), dtype=int)
-    unm_map_idx = 0
-
-    for i, atom in enumerate(molecule.GetAtoms()):
-        if not atom.IsInRing() or atom.GetDegree() != 2 or i in atoms_with_properties_flattened:
-            # Atoms with specific properties
-            prop_map[0, prop_map_idx] = i
-            prop_map[1, prop_map_idx] = prop_map_idx
-            prop_map_idx += 1
-        elif molecule.GetRingInfo().MinAtomRingSize(i) >= 8:
-            # Atoms without specific properties that are part of rings of length >= 8 are not mapped to any ErG atom.
-            # All those atoms are mapped to and artifically introduced node of ErG with feature 7.
-            unmapped_map[0, unm_map_idx] = i
-            unmapped_map[1, unm_map_idx] = erg_num_atoms
-            unm_map_idx += 1
-            unmapped = True
-
-    # Concatenate mappings
-    erg_mapping = np.concatenate(
-        (prop_map[:, :prop_map_idx], rings_map, unmapped_map[:, :unm_map_idx]), axis=1
-    )
-
-    return erg_mapping, unmapped
-
-
-def get_erg_data(molecule, num_of_nodes):
+    def __init__(self):
+        self.property_patterns = [Chem.MolFromSmarts(smarts) for smarts in ERG_PROPERTY_SMARTS]
+
+    def atoms_with_properties(self, mol) -> np.ndarray:
+        """
+        Boolean mask of the atoms matching any of the ErG property patterns.
+        """
+        mask = np.zeros(mol.GetNumAtoms(), dtype=bool)
+        for pattern in self.property_patterns:
+            matches = mol.GetSubstructMatches(pattern)
+            if len(matches) > 0:
+                mask[np.fromiter((i for match in matches for i in match), dtype=np.int64)] = True
+        return mask
+
+    @staticmethod
+    def _erg_graph(erg_fp):
+        """
+        Edges (both directions, grouped by source node), node features and number of ring nodes
+        of an ErG fingerprint molecule.
+        """
+        num_atoms = erg_fp.GetNumAtoms()
+
+        atom_features = np.zeros(num_atoms, dtype=np.int64)
+        num_of_rings = 0
+        for i, atom in enumerate(erg_fp.GetAtoms()):
+            if atom.GetSymbol() == "*":
+                num_of_rings += 1
+            # The last property listed in e.g. "[0,1,2]" determines the feature
+            types = atom.GetProp("_ErGAtomTypes").rstrip("]").replace("[", "")
+            if types:
+                atom_features[i] = int(types.rsplit(",", 1)[-1]) + 1
+
+        bonds = np.array(
+            [(bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()) for bond in erg_fp.GetBonds()],
+            dtype=np.int64,
+        ).reshape(-1, 2)
+        src = np.concatenate((bonds[:, 0], bonds[:, 1]))
+        dst = np.concatenate((bonds[:, 1], bonds[:, 0]))
+        # Bonds of an atom in order of their index, as returned by atom.GetBonds()
+        bond_idx = np.concatenate((np.arange(len(bonds)), np.arange(len(bonds))))
+        perm = np.lexsort((bond_idx, src))
+        erg_edge_index = np.stack((src[perm], dst[perm]))
+
+        return erg_edge_index, atom_features, num_of_rings
+
+    def featurize(self, mol):
+        """
+        Featurize a single molecule.
+
+        Returns:
+            - erg_edge_index (numpy.ndarray): Edges of the ErG, shape [2, num_edges].
+            - erg_mapping (numpy.ndarray): Pairs of (atom of raw graph, ErG node), shape [2, *].
+            - atom_features (numpy.ndarray): Feature of every ErG node.
+            - erg_num_atoms (int): Number of ErG nodes.
+        """
+        erg_fp = GenerateMolExtendedReducedGraph(mol)
+        erg_num_atoms = erg_fp.GetNumAtoms()
+        erg_edge_index, atom_features, num_of_rings = self._erg_graph(erg_fp)
+
+        num_atoms = mol.GetNumAtoms()
+        atom_rings = mol.GetRingInfo().AtomRings()
+        in_ring = np.zeros(num_atoms, dtype=bool)
+        for ring in atom_rings:
+            in_ring[list(ring)] = True
+
+        # Rings small enough to be abstracted, their nodes are appended after the kept atoms
+        recognized_rings = [ring for ring in atom_rings if len(ring) < ERG_MAX_RING_SIZE]
+        ring_sizes = np.fromiter(map(len, recognized_rings), dtype=np.int64)
+        in_recognized_ring = np.zeros(num_atoms, dtype=bool)
+        rings_map = np.empty((2, int(ring_sizes.sum())), dtype=np.int64)
+        if len(recognized_rings) > 0:
+            rings_map[0] = np.concatenate(recognized_rings)
+            rings_map[1] = np.repeat(
+                erg_num_atoms - num_of_rings + np.arange(len(recognized_rings)), ring_sizes
+            )
+            in_recognized_ring[rings_map[0]] = True
+
+        # Atoms outside of rings, ring atoms with other than two neighbours, and atoms with
+        # specific properties are kept as ErG nodes
+        degree = Chem.GetAdjacencyMatrix(mol).sum(axis=1) if num_atoms > 0 else np.zeros(0)
+        kept = ~in_ring | (degree != 2) | self.atoms_with_properties(mol)
+        kept_atoms = np.flatnonzero(kept)
+        prop_map = np.stack((kept_atoms, np.arange(len(kept_atoms), dtype=np.int64)))
+
+        # Atoms without specific properties that are part of rings of length >= 8 only are not
+        # mapped to any ErG atom. All those atoms are mapped to an artificially introduced node.
+        unmapped_atoms = np.flatnonzero(~kept & ~in_recognized_ring)
+        unmapped_map = np.stack(
+            (unmapped_atoms, np.full(len(unmapped_atoms), erg_num_atoms, dtype=np.int64))
+        )
+
+        erg_mapping = np.concatenate((prop_map, rings_map, unmapped_map), axis=1)
+
+        if len(unmapped_atoms) > 0:
+            erg_num_atoms += 1
+            atom_features = np.append(atom_features, 7)
+
+        return erg_edge_index, erg_mapping, atom_features, erg_num_atoms
+
+    def featurize_many(self, mols) -> dict[str, np.ndarray]:
+        """
+        Featurize a batch of molecules into concatenated arrays. Node and atom indices stay local
+        to each molecule; the `*_ptr` arrays hold the offsets of every molecule into the
+        concatenated `edge_index`, `mapping` and `atom_features`, e.g. the edges of molecule `i`
+        are `edge_index[:, edge_ptr[i]:edge_ptr[i + 1]]`.
+        """
+        edge_indices, mappings, atom_features = [], [], []
+        for mol in mols:
+            erg_edge_index, erg_mapping, features, _ = self.featurize(mol)
+            edge_indices.append(erg_edge_index)
+            mappings.append(erg_mapping)
+            atom_features.append(features)
+
+        def ptr(arrays, axis):
+            sizes = [array.shape[axis] for array in arrays]
+            return np.concatenate(([0], np.cumsum(sizes, dtype=np.int64)))
+
+        return {
+            "edge_index": np.concatenate(edge_indices or [np.empty((2, 0), np.int64)], axis=1),
+            "edge_ptr": ptr(edge_indices, axis=1),
+            "mapping": np.concatenate(mappings or [np.empty((2, 0), np.int64)], axis=1),
+            "mapping_ptr": ptr(mappings, axis=1),
+            "atom_features": np.concatenate(atom_features or [np.empty(0, np.int64)]),
+            "atom_ptr": ptr(atom_features, axis=0),
+        }
+
+
+erg_featurizer = ErGFeaturizer()
+
+
+def get_erg_data(molecule, num_of_nodes, featurizer=None):
     """
     Get data for the Extended Reduced Graph (ErG) from a given molecule.
 
     Parameters:
         - molecule (Chem.rdchem.Mol): RDKit Mol object representing a molecule.
         - num_of_nodes (int): Number of nodes in the raw graph.
+        - featurizer (ErGFeaturizer): Featurizer to use, the module-wide one if not given.
 
     Returns:
         - data (ReducedGraphData): Data for the ErG in the form of ReducedGraphData, containing features and mapping.
     """
-
-    # Generate ErG fingerprint
-    erg_fp = GenerateMolExtendedReducedGraph(molecule)
-    erg_num_atoms = erg_fp.GetNumAtoms()
-
-    # Construct ErG features and edges
-    atom_features, erg_edge_index, num_of_rings = construct_erg_from_fp(erg_fp)
-
-    # Find atoms with specific properties in the molecule
-    atoms_with_properties = molecule_atoms_props(molecule)
-    atoms_with_properties_flattened = np.unique(
-        np.array([index for tpl in atoms_with_properties for index in tpl]).flatten()
-    )
-
-    # Create mapping for ErG
-    erg_mapping, unmapped = create_erg_mapping(
-        molecule, num_of_rings, erg_num_atoms, atoms_with_properties_flattened
-    )
-
-    if unmapped:
-        # If there are unmapped atoms, insert and artificall node
-        erg_num_atoms += 1
-        atom_features = np.append(atom_features, 7)
+    featurizer = erg_featurizer if featurizer is None else featurizer
+    erg_edge_index, erg_mapping, atom_features, erg_num_atoms = featurizer.featurize(molecule)
 
     # Transform ErG graph into ReducedGraphData
     data = ReducedGraphData()
@@ -415,32 +711,6 @@ def get_erg_data(molecule, num_of_nodes):
     return data
 
 
-def mol_from_data(data):
-    """
-    Converts a PyG Data object to an RDKit Mol object.
-    TBD: Remove this function as there exists a PyG variant: https://pytorch-geometric.readthedocs.io/en/2.6.1/_modules/torch_geometric/utils/smiles.html
-    """
-    mol = Chem.RWMol()
-
-    x = data.x if data.x.dim() == 1 else data.x[:, 0]
-    for z in x.tolist():
-        mol.AddAtom(Chem.Atom(z))
-
-    row, col = data.edge_index
-    mask = row < col
-    row, col = row[mask].tolist(), col[mask].tolist()
-
-    bond_type = data.edge_attr
-    bond_type = bond_type if bond_type.dim() == 1 else bond_type[:, 0]
-    bond_type = bond_type[mask].tolist()
-
-    for i, j, bond in zip(row, col, bond_type):
-        # assert bond >= 1 and bond <= 4
-        mol.AddBond(i, j, bonds[bond - 1])
-
-    return mol.GetMol()
-
-
 class JunctionTreeData(Data):
     """
     Neural network model from the thesis.
@@ -452,12 +722,21 @@ class JunctionTreeData(Data):
     """
 
     def __inc__(self, key, item, *args):
+        sources = self.increment_sources(key)
+        if sources is None:
+            return super(JunctionTreeData, self).__inc__(key, item, *args)
+        return resolve_increment(self, sources)
+
+    def increment_sources(self, key):
+        """
+        Per row of `key`, the attribute holding its increment when batching, see
+        `ReducedGraphData.increment_sources`.
+        """
         if key == "tree_edge_index":
-            return self.x_clique.size(0)
+            return ((INC_SIZE, "x_clique"),)
         elif key == "atom2clique_index":
-            return torch.tensor([[self.x.size(0)], [self.x_clique.size(0)]])
-        else:
-            return super(JunctionTreeData, self).__inc__(key, item, *args)
+            return ((INC_SIZE, "x"), (INC_SIZE, "x_clique"))
+        return None
 
 
 class JunctionTree(object):
@@ -470,9 +749,10 @@ class JunctionTree(object):
     Github: https://github.com/rusty1s/himp-gnn/blob/master/model.py
     """
 
-    def __call__(self, data):
-        mol = mol_from_data(data)
-        out = tree_decomposition(mol, return_vocab=True)
+    def __call__(self, data, mol=None):
+        if mol is None:
+            mol = get_mol(data.smiles)
+        out = get_tree_decomposition(data.smiles, mol)
         tree_edge_index, atom2clique_index, num_cliques, x_clique = out
 
         data = JunctionTreeData(**{k: v for k, v in data})
@@ -1,14 +1,22 @@
 import argparse
 import csv
+import hashlib
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-from rdkit import Chem
+import torch
 from rdkit.Chem.Scaffolds import MurckoScaffold
 from torch_geometric.data import InMemoryDataset
 
+from src.cache import atomic_save
+from src.chem import get_mol
+from src.featurize import DEFAULT_CHUNK_SIZE, resolve_num_workers
+
 
 def generate_scaffold(smiles) -> str | None:
-    mol = Chem.MolFromSmiles(smiles)
+    mol = get_mol(smiles)
     if mol is None:
         print(f"{smiles} is not a valid SMILES. Could not generate scaffold. Returning None.")
         return None
@@ -16,17 +24,88 @@ def generate_scaffold(smiles) -> str | None:
     return scaffold
 
 
-def scaffold_split(dataset: InMemoryDataset, test_size=0.2):
+def _scaffold_chunk(smiles_chunk: list[str]) -> list[str | None]:
+    return [generate_scaffold(smiles) for smiles in smiles_chunk]
+
+
+def _smiles_key(smiles_list) -> str:
+    # Hash of the SMILES joined by newlines, fed one by one rather than joined
+    digest = hashlib.sha1()
+    for i, smiles in enumerate(smiles_list):
+        digest.update(smiles.encode() if i == 0 else b"\n" + smiles.encode())
+    return digest.hexdigest()
+
+
+def _smiles_chunks(dataset):
+    # Sharded datasets are read shard by shard, others have their SMILES in memory
+    if hasattr(dataset, "smiles_chunks"):
+        return dataset.smiles_chunks()
+    return [dataset.smiles]
+
+
+def scaffold_index(
+    smiles_list: list[str], num_workers=1, cache_dir=None, chunk_size=4 * DEFAULT_CHUNK_SIZE
+) -> list[str | None]:
+    """
+    Murcko scaffold of every molecule of `smiles_list` (None for invalid SMILES), computed from
+    the SMILES alone on `num_workers` processes, each distinct SMILES once. With a `cache_dir` the
+    index is stored in <cache_dir>/scaffolds/, keyed by the SMILES list, and reused by every later
+    run on the same molecules.
+    """
+    path = None
+    if cache_dir is not None:
+        path = Path(cache_dir) / "scaffolds" / f"{_smiles_key(smiles_list)}.pt"
+        try:
+            return torch.load(path, weights_only=True)
+        except Exception:
+            pass  # Missing or unreadable: recompute
+
+    unique = list(dict.fromkeys(smiles_list))
+    chunks = [unique[i : i + chunk_size] for i in range(0, len(unique), chunk_size)]
+    num_workers = min(resolve_num_workers(num_workers), max(len(chunks), 1))
+    if num_workers <= 1:
+        scaffolds = [scaffold for chunk in chunks for scaffold in _scaffold_chunk(chunk)]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            scaffolds = [s for result in executor.map(_scaffold_chunk, chunks) for s in result]
+    scaffold_of = dict(zip(unique, scaffolds))
+    index = [scaffold_of[smiles] for smiles in smiles_list]
+
+    if path is not None:
+        atomic_save(index, path)
+    return index
+
+
+def scaffold_split(dataset: InMemoryDataset, test_size=0.2, cache_dir=None, num_workers=1):
     """
     Apply a mask to the provided dataset according to their scaffold groups.
     Return a train/test scaffold split.
+
+    The scaffolds come from `scaffold_index`. With a `cache_dir` the split indices are stored in
+    <cache_dir>/splits/, keyed by the SMILES of the dataset and `test_size`, so that a repeated
+    split does not compute any scaffold. The SMILES of sharded datasets are read one shard at a
+    time.
     """
+    path = None
+    if cache_dir is not None:
+        key = _smiles_key(itertools.chain.from_iterable(_smiles_chunks(dataset)))
+        path = Path(cache_dir) / "splits" / f"{key}_{test_size}.pt"
+        try:
+            train_idx, test_idx = torch.load(path, weights_only=True)
+            return dataset[train_idx], dataset[test_idx]
+        except Exception:
+            pass  # Missing or unreadable: recompute
 
     # Group molecule indices by their scaffolds
     scaffold_groups = {}
-    for idx, data in enumerate(dataset):
-        scaffold = generate_scaffold(data.smiles)
-        scaffold_groups.setdefault(scaffold, []).append(idx)
+    offset = 0
+    for smiles_list in _smiles_chunks(dataset):
+        scaffolds = scaffold_index(smiles_list, num_workers=num_workers, cache_dir=cache_dir)
+        for idx, scaffold in enumerate(scaffolds, start=offset):
+            scaffold_groups.setdefault(scaffold, []).append(idx)
+        offset += len(smiles_list)
 
     # Sort groups by size, largest first
     sorted_groups = sorted(scaffold_groups.values(), key=len, reverse=True)
@@ -42,6 +121,8 @@ def scaffold_split(dataset: InMemoryDataset, test_size=0.2):
         else:
             test_idx.extend(group)
 
+    if path is not None:
+        atomic_save((train_idx, test_idx), path)
     return dataset[train_idx], dataset[test_idx]
 
 
@@ -50,13 +131,23 @@ class PerformanceTracker:
         self.epoch = []
         self.train_loss = []
         self.valid_loss = []
+        self.steps_per_sec = []  # Training throughput per epoch
+        self.molecules_per_sec = []
         self.test_pred = {}
+        self.best_epoch = None  # Epoch of the lowest validation loss
+        self.stop_epoch = None  # Last epoch trained, earlier than planned if stopped early
+        self.checkpoint_loss = {}  # Validation loss after each epoch of the epoch grid
 
     def reset(self):
         self.epoch = []
         self.train_loss = []
         self.valid_loss = []
+        self.steps_per_sec = []
+        self.molecules_per_sec = []
         self.test_pred = {}
+        self.best_epoch = None
+        self.stop_epoch = None
+        self.checkpoint_loss = {}
 
     def log(self, data: dict[str, int | float]) -> None:
         for key, value in data.items():
@@ -0,0 +1,57 @@
+import pytest
+import torch
+from rdkit import Chem
+from torch_geometric.utils import from_smiles
+
+from src.chem import mols_to_data_list, mols_to_graphs
+
+SMILES = [
+    # Invalid and empty SMILES, which `from_smiles` turns into the empty molecule
+    "C1CC",
+    "not a molecule",
+    "",
+    # Single atoms and charged atoms
+    "C",
+    "[Na+].[Cl-]",
+    "C[N+](C)(C)C",
+    "CC(=O)[O-]",
+    "[NH3+]CC([O-])=O",
+    # Aromatic and conjugated bonds
+    "c1ccccc1",
+    "c1ccc2[nH]ccc2c1",
+    "CC(=O)Oc1ccccc1C(=O)O",
+    # Stereochemistry, radicals and mixtures
+    "C/C=C/C",
+    "C[C@H](N)C(=O)O",
+    "[CH3]",
+    "Cc1ccccc1.CCC(C)CC",
+]
+
+
+def parse(smiles):
+    # Same fallback as `from_smiles`
+    mol = Chem.MolFromSmiles(smiles)
+    return Chem.MolFromSmiles("") if mol is None else mol
+
+
+def test_mols_to_graphs():
+    x, edge_index, edge_attr, node_ptr, edge_ptr = mols_to_graphs([parse(s) for s in SMILES])
+
+    assert node_ptr.tolist()[-1] == x.size(0) and edge_ptr.tolist()[-1] == edge_index.size(1)
+    for i, smiles in enumerate(SMILES):
+        expected = from_smiles(smiles)
+        nodes = slice(int(node_ptr[i]), int(node_ptr[i + 1]))
+        edges = slice(int(edge_ptr[i]), int(edge_ptr[i + 1]))
+        assert torch.equal(x[nodes], expected.x), smiles
+        assert torch.equal(edge_index[:, edges], expected.edge_index), smiles
+        assert torch.equal(edge_attr[edges], expected.edge_attr), smiles
+
+
+@pytest.mark.parametrize("smiles", SMILES)
+def test_mols_to_data_list(smiles):
+    expected = from_smiles(smiles)
+    (actual,) = mols_to_data_list([parse(smiles)])
+
+    for key in ["x", "edge_index", "edge_attr"]:
+        assert actual[key].dtype == expected[key].dtype, key
+        assert torch.equal(actual[key], expected[key]), key
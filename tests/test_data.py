@@ -0,0 +1,47 @@
+import csv
+import shutil
+from pathlib import Path
+
+import torch
+
+from src.data import PolarisDataset
+
+RAW_DIR = Path("data") / "polaris" / "potency" / "raw"
+TARGET_TASK = "pIC50 (MERS-CoV Mpro)"
+
+
+def write_rows(path, header, rows):
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def packed(root):
+    return PolarisDataset.packed(
+        root=root, task="potency", target_task=TARGET_TASK, log_transform=False, cache_dir=None
+    )
+
+
+def test_packed_follows_raw_data(tmp_path):
+    shutil.copytree(RAW_DIR, tmp_path / "raw")
+    with open(RAW_DIR / "train_polaris.csv", "r") as file:
+        lines = csv.reader(file)
+        header = next(lines)
+        rows = [row for row in lines if len(row[1]) > 0][:20]
+    train_path = tmp_path / "raw" / "train_polaris.csv"
+
+    write_rows(train_path, header, rows)
+    before = packed(tmp_path)
+    assert before.smiles == [row[0] for row in rows]
+
+    # Fewer molecules with other labels
+    rows = [[row[0], str(float(row[1]) + 1.0), row[2]] for row in rows[:15]]
+    write_rows(train_path, header, rows)
+    after = packed(tmp_path)
+    assert after.smiles == [row[0] for row in rows]
+    assert torch.equal(after.y.view(-1), torch.tensor([float(row[1]) for row in rows]))
+
+    # Unchanged raw data reuses the store
+    assert packed(tmp_path).source == after.source
+    assert len(list((tmp_path / "packed").glob("*.pt"))) == 2
@@ -0,0 +1,85 @@
+import pytest
+import torch
+from torch_geometric.utils import scatter
+
+from src.hoimp import Hoimp
+from src.mapping import ClusterMapping
+
+NUM_ATOMS = 40
+HIDDEN_CHANNELS = 8
+
+
+@pytest.mark.parametrize("rg_num", [2, 3, 4])
+def test_rg2rg_pairs(rg_num):
+    model = Hoimp(8, 8, num_layers=3, rg_num=rg_num, rg_embedding_dim=[4] * rg_num)
+
+    pairs = [pair for layer in model.rg2rg_pairs for pair in layer]
+    lins = [lin for _, _, lin_j, lin_k in pairs for lin in (lin_j, lin_k)]
+    # Every linear layer transforms the messages of exactly one pair and direction
+    assert sorted(lins) == list(range(len(model.rg2rg_lins)))
+    for layer, layer_pairs in enumerate(model.rg2rg_pairs):
+        assert [(j, k) for j, k, _, _ in layer_pairs] == [
+            (j, k) for j in range(rg_num) for k in range(j + 1, rg_num)
+        ]
+
+
+def reduced_graphs(rg_num, generator):
+    # Node features and atom to node mappings of reduced graphs of different sizes, every atom
+    # in at least one node, some in two
+    rgs, mappings = [], []
+    for i in range(rg_num):
+        num_nodes = 5 + 4 * i
+        row = torch.cat(
+            [torch.arange(NUM_ATOMS), torch.randint(NUM_ATOMS, (10,), generator=generator)]
+        )
+        col = torch.randint(num_nodes, (row.numel(),), generator=generator)
+        mappings.append(torch.unique(torch.stack((row, col)), dim=1))
+        rgs.append(torch.randn(num_nodes, HIDDEN_CHANNELS, generator=generator))
+    return rgs, mappings
+
+
+def reference_rg2rg(model, rgs, mappings, layer):
+    # The per-pair loop of the original model, every pair sending from the reduced graphs as
+    # updated by the pairs before it
+    rgs = [rg.clone() for rg in rgs]
+    for j, k, lin_j, lin_k in model.rg2rg_pairs[layer]:
+        rg_j, rg_k = rgs[j], rgs[k]
+        row_j, col_j = mappings[j]
+        row_k, col_k = mappings[k]
+        x_virt_j = scatter(rg_j[col_j], row_j, dim=0, dim_size=NUM_ATOMS, reduce="mean")
+        x_virt_k = scatter(rg_k[col_k], row_k, dim=0, dim_size=NUM_ATOMS, reduce="mean")
+        rg_j = model.rg2rg_lins[lin_j](
+            scatter(x_virt_k[row_j], col_j, dim=0, dim_size=rg_j.size(0), reduce="mean")
+        ).relu()
+        rg_k = model.rg2rg_lins[lin_k](
+            scatter(x_virt_j[row_k], col_k, dim=0, dim_size=rg_k.size(0), reduce="mean")
+        ).relu()
+        rgs[j] += rg_j
+        rgs[k] += rg_k
+    return rgs
+
+
+@pytest.mark.parametrize("rg_num", [2, 3, 4])
+@pytest.mark.parametrize("sequential", [True, False])
+def test_rg2rg(rg_num, sequential):
+    torch.manual_seed(0)
+    model = Hoimp(
+        HIDDEN_CHANNELS,
+        HIDDEN_CHANNELS,
+        num_layers=2,
+        rg_num=rg_num,
+        rg_embedding_dim=[4] * rg_num,
+        sequential_rg2rg=sequential,
+    )
+    rgs, mappings = reduced_graphs(rg_num, torch.Generator().manual_seed(rg_num))
+    operators = [
+        ClusterMapping(mapping, NUM_ATOMS, rg.size(0)) for mapping, rg in zip(mappings, rgs)
+    ]
+
+    for layer in range(model.num_layers):
+        expected = reference_rg2rg(model, rgs, mappings, layer)
+        actual = model._rg2rg(rgs, operators, layer)
+        same = [torch.allclose(exp, act, atol=1e-6) for exp, act in zip(expected, actual)]
+        # Messages sent from the reduced graphs entering the layer differ from those of the
+        # original order once a reduced graph takes part in more than one pair
+        assert all(same) == (sequential or rg_num == 2)
@@ -0,0 +1,160 @@
+import pickle
+
+import pytest
+import torch
+from torch_geometric.data import Batch
+
+from src.loader import DataLoader, PackedDataset, ReducedGraphCollater, collate
+from src.transform import MoleculeFeaturizer
+
+SMILES = [
+    "CC(=O)Oc1ccccc1C(=O)O",
+    "c1ccc2[nH]ccc2c1",
+    "CCO",
+    "C",
+    "CC",
+    "[Na+].[Cl-]",
+    # Mixtures, except those of a ring system next to a chain, whose coarser junction tree levels
+    # hold negative cluster indices from the reference coarsening (see tests/test_transform.py)
+    "CC.CCC",
+    "C1CC1.C1CC1C",
+    "CC(C)C[C@@H]1NC(=O)[C@H](CC(C)C)N(C)C(=O)[C@H](C)N(C)C1=O",
+    "O=C(Nc1cccnc1)c1ccc(F)cc1Cl",
+    "CCCCCCCCCCCCCCCC(C)(C)CC(CC)CC(C)(C)C",
+]
+
+CONFIGS = {
+    "HIMP": {},
+    "ErG": {"use_erg": True},
+    "JT(2)": {"use_jt": True, "jt_coarsity": 2},
+    "JT(3)+ErG": {"use_jt": True, "jt_coarsity": 3, "use_erg": True},
+}
+
+
+def featurize(config):
+    featurizer = MoleculeFeaturizer(**config)
+    graphs = [featurizer(smiles) for smiles in SMILES]
+    return graphs if featurizer.view is None else [featurizer.view(data) for data in graphs]
+
+
+def with_mappings(data):
+    # The graph with the mappings of the coarser junction tree levels, derived per graph
+    data = data.clone()
+    i = 1
+    while f"rg_parent_{i}" in data:
+        row, col = data[f"mapping_{i - 1}"]
+        mapping = torch.stack((row, data[f"rg_parent_{i}"][col]))
+        data[f"mapping_{i}"] = torch.unique(mapping, dim=1)
+        i += 1
+    return data
+
+
+def assert_equal(expected, actual):
+    assert set(expected.keys()) == set(actual.keys())
+    for key in expected.keys():
+        if isinstance(expected[key], torch.Tensor):
+            assert expected[key].dtype == actual[key].dtype, key
+            assert torch.equal(expected[key], actual[key]), key
+        else:
+            assert expected[key] == actual[key], key
+    assert expected.num_graphs == actual.num_graphs
+
+
+@pytest.mark.parametrize("name", CONFIGS)
+def test_collate(name):
+    graphs = featurize(CONFIGS[name])
+    for data_list in [graphs, graphs[::-1], graphs[3:4]]:
+        expected = Batch.from_data_list(data_list)
+        assert_equal(expected, collate(data_list))
+
+
+@pytest.mark.parametrize("name", CONFIGS)
+def test_reduced_graph_collater(name):
+    graphs = featurize(CONFIGS[name])
+    collater = ReducedGraphCollater(graphs)
+    for data_list in [graphs, graphs[::-1], graphs[3:4]]:
+        expected = Batch.from_data_list([with_mappings(data) for data in data_list])
+        actual = collater(data_list)
+        assert_equal(expected, actual)
+        # Increments of the batched attributes, used to separate the batch again. Derived
+        # mappings have none
+        for key, inc in actual._inc_dict.items():
+            if isinstance(inc, torch.Tensor):
+                assert torch.equal(inc, expected._inc_dict[key]), key
+
+
+def labelled(config):
+    # Graphs of two targets, the first missing for every third molecule, the second for every
+    # other one
+    graphs = featurize(config)
+    for i, data in enumerate(graphs):
+        y = torch.tensor([[float(i), -float(i)]])
+        y[0, 0] = float("nan") if i % 3 == 0 else y[0, 0]
+        y[0, 1] = float("nan") if i % 2 == 0 else y[0, 1]
+        data.y = y
+        data.y_mask = ~y.isnan()
+    return graphs
+
+
+def assert_batches_equal(expected, actual):
+    expected, actual = list(expected), list(actual)
+    assert len(expected) == len(actual)
+    for expected_batch, actual_batch in zip(expected, actual):
+        # NaN labels compare equal in place
+        for batch in (expected_batch, actual_batch):
+            batch.y = torch.nan_to_num(batch.y, nan=1e6)
+        assert_equal(expected_batch, actual_batch)
+
+
+@pytest.mark.parametrize("name", CONFIGS)
+def test_packed_batches(name):
+    graphs = labelled(CONFIGS[name])
+    packed = PackedDataset(graphs)
+    assert len(packed) == len(graphs)
+    assert packed.smiles == SMILES
+    assert_batches_equal(DataLoader(graphs, batch_size=4), packed.batches(batch_size=4))
+
+    idx = [7, 2, 9, 0]
+    assert_batches_equal(DataLoader([graphs[i] for i in idx]), packed.batches(idx))
+    assert_batches_equal(
+        DataLoader([graphs[i] for i in idx], batch_size=3), packed[idx].batches(batch_size=3)
+    )
+
+    torch.manual_seed(0)
+    expected = list(DataLoader(graphs, batch_size=3, shuffle=True))
+    torch.manual_seed(0)
+    assert_batches_equal(expected, packed.loader(batch_size=3, shuffle=True))
+
+
+@pytest.mark.parametrize("column", [0, 1])
+def test_packed_select_target(column):
+    graphs = labelled(CONFIGS["JT(3)+ErG"])
+    selected = [data.clone() for data in graphs if data.y_mask[0, column]]
+    for data in selected:
+        data.y = data.y[:, column : column + 1]
+        del data.y_mask
+
+    packed = PackedDataset(graphs).select_target(column)
+    assert packed.smiles == [data.smiles for data in selected]
+    assert torch.equal(packed.y, torch.cat([data.y for data in selected]))
+    assert not packed.y.isnan().any()
+    assert_batches_equal(DataLoader(selected, batch_size=2), packed.batches(batch_size=2))
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_packed_save_load(tmp_path, mmap):
+    graphs = labelled(CONFIGS["JT(3)+ErG"])
+    packed = PackedDataset(graphs)
+    packed.save(tmp_path / "packed.pt", source="abc")
+    loaded = PackedDataset.load(tmp_path / "packed.pt", mmap=mmap)
+    assert loaded.source == "abc"
+    assert loaded.smiles == packed.smiles
+    assert torch.equal(loaded.y.isnan(), packed.y.isnan())
+    assert_batches_equal(packed.batches(batch_size=4), loaded.batches(batch_size=4))
+    assert_batches_equal(
+        packed.select_target(1).batches(batch_size=4), loaded.select_target(1).batches(batch_size=4)
+    )
+
+    # Pickled, e.g. for a worker process
+    view = pickle.loads(pickle.dumps(loaded[[5, 1, 3]]))
+    assert_batches_equal(packed[[5, 1, 3]].batches(), view.batches())
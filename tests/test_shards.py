@@ -0,0 +1,56 @@
+import csv
+import hashlib
+import itertools
+from pathlib import Path
+
+import torch
+
+from src.shards import ShardedDataset, build_shards
+from src.transform import MoleculeFeaturizer
+from src.utils import _smiles_key
+
+RAW_PATH = Path("data") / "polaris" / "potency" / "raw" / "train_polaris.csv"
+
+
+def write_rows(path, header, rows):
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def test_shards_follow_raw_data(tmp_path):
+    with open(RAW_PATH, "r") as file:
+        lines = csv.reader(file)
+        header = next(lines)
+        rows = list(itertools.islice(lines, 25))
+    raw_path, directory = tmp_path / "train.csv", tmp_path / "shards"
+    featurizer = MoleculeFeaturizer()
+
+    write_rows(raw_path, header, rows)
+    build_shards(raw_path, directory, featurizer, shard_size=10)
+    dataset = ShardedDataset(directory, label_col=1)
+    assert len(list(directory.glob("shard_*.pt"))) == 3
+    assert dataset.smiles == [row[0] for row in rows if len(row[2]) > 0]
+
+    # Fewer molecules with other labels are sharded anew
+    rows = [[row[0], row[2], row[1]] for row in rows[:12]]
+    write_rows(raw_path, header, rows)
+    build_shards(raw_path, directory, featurizer, shard_size=10)
+    dataset = ShardedDataset(directory, label_col=0)
+    assert len(list(directory.glob("shard_*.pt"))) == 2
+    labelled = [row for row in rows if len(row[1]) > 0]
+    assert dataset.smiles == [row[0] for row in labelled]
+    assert torch.equal(dataset.y.view(-1), torch.tensor([float(row[1]) for row in labelled]))
+    assert list(itertools.chain.from_iterable(dataset.smiles_chunks())) == dataset.smiles
+
+    # Views keep the order of their molecules
+    view = dataset[torch.tensor([3, 0, 1])]
+    assert list(itertools.chain.from_iterable(view.smiles_chunks())) == view.smiles
+
+
+def test_smiles_key():
+    smiles_list = ["CCO", "c1ccccc1", "", "C"]
+    expected = hashlib.sha1("\n".join(smiles_list).encode()).hexdigest()
+    assert _smiles_key(smiles_list) == expected
+    assert _smiles_key(iter(smiles_list)) == expected
@@ -0,0 +1,55 @@
+import pytest
+import torch
+from torch_geometric.utils import tree_decomposition
+
+from src.chem import get_mol
+from src.transform import ReducedGraphData, add_feature_tree_with_lower_res, coarsen_junction_tree
+
+SMILES = [
+    # Single edge trees
+    "CCO",
+    "c1ccccc1C",
+    # Trees without edges
+    "CC",
+    # Deeper trees
+    "CC(=O)Oc1ccccc1C(=O)O",
+    "CC(C)C[C@@H]1NC(=O)[C@H](CC(C)C)N(C)C(=O)[C@H](C)N(C)C1=O",
+    "CCCCCCCCCCCCCCCC(C)(C)CC(CC)CC(C)(C)C",
+    # Forests, with single edge components next to larger ones
+    "CC.CCC",
+    "C1CC1.C1CC1C",
+    "Cc1ccccc1.CCC(C)CC",
+    "c1ccccc1C.CC(C)C",
+    "c1ccccc1Cc1ccccc1.CCC",
+]
+
+KEYS = ["rg_edge_index", "mapping", "rg_num_atoms", "rg_atom_features"]
+
+
+def reference_levels(tree_0, num_levels):
+    tree = ReducedGraphData(raw_num_atoms_0=0, **dict(zip([f"{key}_0" for key in KEYS], tree_0)))
+    for i in range(1, num_levels + 1):
+        tree = add_feature_tree_with_lower_res(tree, i)
+    return [tuple(getattr(tree, f"{key}_{i}") for key in KEYS) for i in range(1, num_levels + 1)]
+
+
+@pytest.mark.parametrize("smiles", SMILES)
+@pytest.mark.parametrize("num_levels", [1, 3])
+def test_coarsen_junction_tree(smiles, num_levels):
+    tree_0 = tree_decomposition(get_mol(smiles), return_vocab=True)
+    try:
+        expected = reference_levels(tree_0, num_levels)
+    except IndexError:
+        # Some forests make the reference implementation fail, which has to be kept
+        with pytest.raises(IndexError):
+            coarsen_junction_tree(*tree_0, num_levels=num_levels)
+        return
+    actual = coarsen_junction_tree(*tree_0, num_levels=num_levels)
+
+    assert len(actual) == len(expected)
+    for expected_level, actual_level in zip(expected, actual):
+        for key, a, b in zip(KEYS, expected_level, actual_level):
+            if isinstance(a, torch.Tensor):
+                assert a.dtype == b.dtype and torch.equal(a, b), key
+            else:
+                assert a == b, key